@@ -30,8 +30,9 @@ D = {
     'serialized-profile': (
             ['-d', '--serialized-profile'],
             {'metavar': "PROFILE",
-             'help': "Serialized profile (PROFILE.cp). This file would be a result of a previous\
-                      anvi'o profiling run. It is faster, and can be used to refine previously obtained results."}
+             'help': "Serialized profile (PROFILE.h5, or PROFILE.cp from earlier versions of anvi'o). This file would be\
+                      a result of a previous anvi'o profiling run. It is faster, and can be used to refine previously\
+                      obtained results."}
                 ),
     'samples-information-db': (
             ['-s', '--samples-information-db'],
@@ -122,6 +123,50 @@ D = {
                       will instruct profiler to skip that step. Please remember that parameters and flags must be\
                       identical between different profiles using the same contigs database for them to merge properly."}
                 ),
+    'skip-serialized-profile': (
+            ['--skip-serialized-profile'],
+            {'default': False,
+             'action': 'store_true',
+             'help': "By default, anvi'o serializes the profile of every contig into PROFILE.h5 in the output directory,\
+                      so it can be profiled again later with different parameters without the BAM file (see\
+                      '--serialized-profile'). The use of this flag will instruct profiler to skip that step, which saves\
+                      time and disk space if you will not need it."}
+                ),
+    'joint-profile': (
+            ['--joint-profile'],
+            {'default': False,
+             'action': 'store_true',
+             'help': "Profile all input BAM files together into a single merged profile in the output directory, rather than\
+                      profiling each of them into its own profile to be merged later with 'anvi-merge'. Every contig is piled\
+                      up in all BAM files at once, and the merged profile is written directly. Its sample name comes from the\
+                      output directory, unless you declare one. With '--cluster-contigs', contigs are clustered and binned\
+                      with CONCOCT the way 'anvi-merge' does."}
+                ),
+    'checkpoint': (
+            ['--checkpoint'],
+            {'default': False,
+             'action': 'store_true',
+             'help': "Record profiled contigs in the output directory every now and then while profiling, so if the run dies\
+                      before it is finished (i.e., due to a time limit on a cluster), it can be resumed later without profiling\
+                      those contigs again (see '--resume'). Checkpoints are removed once the profile is complete."}
+                ),
+    'resume': (
+            ['--resume'],
+            {'default': False,
+             'action': 'store_true',
+             'help': "Resume a run that was started with '--checkpoint' and did not finish. Use the same output directory\
+                      and the same parameters with the previous run. Contigs found in checkpoints will not be profiled again,\
+                      and everything else in the output directory will be generated from scratch."}
+                ),
+    'shard': (
+            ['--shard'],
+            {'metavar': 'I/N',
+             'default': None,
+             'help': "Profile only the I'th of N shards of contigs (i.e., '2/8'), so a single BAM file can be profiled\
+                      by N separate jobs on different computers. Contigs are distributed to shards so every shard gets about\
+                      the same number of nucleotides, and the same contigs always end up in the same shards. Once all\
+                      shards are profiled, 'anvi-merge-shards' puts them together into a single profile."}
+                ),
     'skip-mindful-splitting': (
             ['--skip-mindful-splitting'],
             {'default': False,
@@ -637,6 +682,21 @@ D = {
                       that contains 4 files: (1) genes.hmm.gz, (2) genes.txt, (3) kind.txt, and (4)\
                       reference.txt. Please see the documentation for specifics of these files."}
                 ),
+    'hmm-cache-dir': (
+            ['--hmm-cache-dir'],
+            {'metavar': 'PATH',
+             'help': "Directory to keep pressed HMM models in, so searches against the same model do not have to\
+                      unpack and press it again in every run. The default is '~/.anvio/hmm_cache'. Entries are\
+                      verified before they are used, and least recently used ones are evicted when the cache grows\
+                      too large."}
+                ),
+    'skip-hmm-cache': (
+            ['--skip-hmm-cache'],
+            {'default': False,
+             'action': 'store_true',
+             'help': "Do not read pressed HMM models from, or add them to the cache, and press every model in a\
+                      temporary directory instead."}
+                ),
     'min-contig-length': (
             ['-M', '--min-contig-length'],
             {'metavar': 'INT',
@@ -669,6 +729,28 @@ D = {
                       not attempt to make sense of variation in a given nucleotide position if it is covered less than\
                       %(default)dX. You can change that minimum using this parameter."}
                 ),
+    'max-depth-for-SNV-profiling': (
+            ['--max-depth-for-SNV-profiling'],
+            {'metavar': 'INT',
+             'default': 0,
+             'type': int,
+             'help': "Nucleotide positions that are covered more than this are profiled for SNVs using only this many reads,\
+                      picked at random (the same ones every time), while their true coverage is still reported. For splits\
+                      that are too deep for anvi'o to count nucleotides from reads directly (more than 8000X), nucleotides\
+                      are read only from the sampled reads, which puts an upper limit on the cost of SNV profiling for\
+                      extremely deep samples. Positions with ordinary coverage are not affected. The number of capped\
+                      positions is reported at the end of profiling. By default there is no limit."}
+                ),
+    'num-threads': (
+            ['-T', '--num-threads'],
+            {'metavar': 'NUM_THREADS',
+             'default': 1,
+             'type': int,
+             'help': "Maximum number of threads to use for multithreading whenever possible. Very conservatively, the default\
+                      is %(default)d. It is a good idea to not exceed the number of CPUs / cores on your system. Plus, please\
+                      be careful with this option if you are running your commands on a SGE --if you are clusterizing your code,\
+                      asking for multiple threads to use may deplete your resources very fast."}
+                ),
     'contigs-and-positions': (
             ['-P', '--contigs-and-positions'],
             {'metavar': 'TAB_DELIM_FILE',
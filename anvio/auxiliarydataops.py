@@ -54,17 +54,23 @@ class HDF5_IO(object):
                 raise HDF5Error, "The database at '%s' does not have the hash the client requested."
 
 
-    def add_integer_list(self, path, l, data_type = 'uint16'):
+    def add_integer_list(self, path, l, data_type = 'uint16', compress = False):
         """Add an array into the the HDF5 file.
         
             >>> h = HDF5_IO('test.h5')
             >>> l = [1, 2, 3, 4, 5]
             >>> h.add_integer_list('/split_1/sample_x', l)
             >>> h.close()
+
+           If `compress` is True, the array is stored in a chunked, gzip compressed dataset (empty
+           arrays can't be chunked, so they are always stored as is).
         """
 
-        new_data_obj = self.fp.create_dataset(path, (len(l),), dtype=np.dtype(data_type))
-        new_data_obj[...] = np.array(l)
+        if compress and len(l):
+            self.fp.create_dataset(path, data=np.asarray(l, dtype=np.dtype(data_type)), chunks=True, compression='gzip')
+        else:
+            new_data_obj = self.fp.create_dataset(path, (len(l),), dtype=np.dtype(data_type))
+            new_data_obj[...] = np.array(l)
 
 
     def get_integer_list(self, path):
@@ -97,6 +103,16 @@ class AuxiliaryDataForSplitCoverages(HDF5_IO):
         self.add_integer_list('/data/coverages/%s/%s' % (split_name, sample_id), coverage_list)
 
 
+    def extend(self, split_coverages):
+        """Copies coverage values of every split in another `AuxiliaryDataForSplitCoverages` into this one"""
+        if '/data/coverages' not in split_coverages.fp:
+            return
+
+        coverages = self.fp.require_group('/data/coverages')
+        for split_name in split_coverages.fp['/data/coverages']:
+            split_coverages.fp.copy('/data/coverages/%s' % split_name, coverages, name = split_name)
+
+
     def get(self, split_name):
         self.is_known_split(split_name)
 
@@ -124,7 +140,7 @@ class AuxiliaryDataForNtPositions(HDF5_IO):
 
 
     def append(self, contig_name, position_info_list):
-        self.add_integer_list('/data/nt_position_info/%s' % contig_name, position_info_list, data_type = 'uint8')
+        self.add_integer_list('/data/nt_position_info/%s' % contig_name, position_info_list, data_type = 'uint8', compress = True)
 
 
     def get(self, contig_name):
@@ -48,7 +48,9 @@ class Completeness:
         self.hmm_hits_table = contigs_db.db.get_table_as_dict(t.hmm_hits_table_name)
 
         # read search table (which holds hmmscan hits for splits).
-        self.hmm_hits_splits_table = utils.get_filtered_dict(contigs_db.db.get_table_as_dict(t.hmm_hits_splits_table_name), 'source', singlecopy_sources)
+        self.hmm_hits_splits_table = contigs_db.db.get_table_as_dict(t.hmm_hits_splits_table_name,
+                                                                     where_clause = 'source IN (%s)' % ', '.join(['?'] * len(singlecopy_sources)),
+                                                                     where_values = list(singlecopy_sources))
 
         # an example entry in self.hmm_hits_splits_table looks loke this:
         #
@@ -1,12 +1,18 @@
 # -*- coding: utf-8
 """Classes and functions for handling, storing, and retrieving atomic data from contigs and splits"""
 
+import os
+import h5py
+import numpy
+
 import anvio
+import anvio.auxiliarydataops as auxiliarydataops
 
-from anvio.sequence import Coverage
+from anvio.sequence import Coverage, SlottedObject
 from anvio.terminal import Run, Progress
 from anvio.terminal import pretty_print as pp
-from anvio.variability import VariablityTestFactory
+from anvio.variability import VariablityTestFactory, SplitColumnProfiles
+from anvio.pileup import SplitPileup, SplitPileupFromReads, ContigCoverageFromReads, PYSAM_VERSION_IS_VERIFIED
 
 import anvio.tables as t
 
@@ -14,12 +20,6 @@ run = Run()
 progress = Progress()
 progress.verbose = False
 
-try:
-    from anvio.columnprofile import ColumnProfile
-except ImportError:
-    run.info_single('C extension for ColumnProfile failed to load, falling back to the Python implementation...', mc = 'gray', nl_after = 1)
-    from anvio.variability import ColumnProfile
-
 
 __author__ = "A. Murat Eren"
 __copyright__ = "Copyright 2015, The anvio Project"
@@ -35,28 +35,15 @@ variability_test_class_default = VariablityTestFactory(params = {'b': 2, 'm': 1.
 variability_test_class_null = VariablityTestFactory(params = None) # get everything for every coverage level
 
 
-def set_contigs_abundance(contigs):
-    """takes a list of contigs (of Contig class) and sets abundance values. a better way to do this is to implement
-       a Contigs wrapper .. maybe later."""
-
-    # first calculate the mean coverage
-    total_length_of_all_contigs = sum([c.length for c in contigs.values()])
-    total_coverage_values_for_all_contigs = sum([c.coverage.mean * c.length for c in contigs.values()])
-    overall_mean_coverage = total_coverage_values_for_all_contigs / total_length_of_all_contigs
-
-    # set normalized abundance factor for each contig
-    for contig in contigs:
-        contigs[contig].abundance = contigs[contig].coverage.mean / overall_mean_coverage if overall_mean_coverage else 0
-        for split in contigs[contig].splits:
-            split.abundance = split.coverage.mean / overall_mean_coverage if overall_mean_coverage else 0
-
-
 def gen_split_name(parent_name, order):
     return '_'.join([parent_name, 'split', '%05d' % (order + 1)])
 
 
-class Contig:
-    def __init__(self, name):
+class Contig(SlottedObject):
+    __slots__ = ['name', 'sequence', 'parent', 'splits', 'length', 'abundance', 'coverage', 'split_length',
+                 'min_coverage_for_variability', 'max_depth_for_SNV_profiling', 'skip_SNV_profiling', 'report_variability_full']
+
+    def __init__(self, name = None):
         self.name = name
         self.sequence = None
         self.parent = None
@@ -65,7 +52,9 @@ class Contig:
         self.abundance = 0.0
         self.coverage = Coverage()
 
+        self.split_length = 0
         self.min_coverage_for_variability = 10
+        self.max_depth_for_SNV_profiling = 0
         self.skip_SNV_profiling = False
         self.report_variability_full = False
 
@@ -85,23 +74,72 @@ class Contig:
 
 
     def analyze_coverage(self, bam, progress):
-        contig_coverage = []
+        """Goes through the reads of every split only once. Coverage values for each split are
+           recovered from that single traversal, and if SNV profiling is not skipped, nucleotide
+           counts from the same traversal are sent to `Auxiliary` to be profiled for variability.
+
+           With a version of pysam reads were not compared to the pileup for, every split goes
+           through the pileup instead (see `pileup.PYSAM_VERSION_IS_VERIFIED`)."""
+        split_coverages = []
         num_splits = len(self.splits)
         counter = 1
 
+        # if SNVs are not going to be profiled, coverage values for the entire contig can be recovered
+        # from a single pass over its reads (see `ContigCoverageFromReads`):
+        coverage_from_reads = None
+        if self.skip_SNV_profiling and PYSAM_VERSION_IS_VERIFIED:
+            progress.update('Coverage from reads')
+            coverage_from_reads = ContigCoverageFromReads(self)
+            coverage_from_reads.run(bam)
+
+            if not coverage_from_reads.is_identical_to_pileup:
+                coverage_from_reads = None
+
         for split in self.splits:
-            progress.update('Coverage (split: %d of %d)' % (counter, num_splits))
+            progress.update('Coverage and auxiliary stats (split: %d of %d)' % (counter, num_splits))
 
             split.coverage = Coverage()
-            split.coverage.run(bam, split)
-            contig_coverage.extend(split.coverage.c)
+
+            if coverage_from_reads:
+                split.coverage.c = coverage_from_reads.c[split.start:split.end]
+            else:
+                pileup = None
+                if PYSAM_VERSION_IS_VERIFIED:
+                    pileup = SplitPileupFromReads(split, skip_SNV_profiling = self.skip_SNV_profiling, max_depth = self.max_depth_for_SNV_profiling)
+                    pileup.run(bam)
+
+                if not pileup or not pileup.is_identical_to_pileup:
+                    pileup = SplitPileup(split, skip_SNV_profiling = self.skip_SNV_profiling, max_depth = self.max_depth_for_SNV_profiling)
+                    pileup.run(bam)
+
+                split.coverage.c = pileup.c
+
+            if split.coverage.c.size:
+                split.explicit_length = split.coverage.c.size
+                split.coverage.process_c(split.coverage.c)
+
+            split_coverages.append(split.coverage.c)
+
+            if not self.skip_SNV_profiling:
+                split.auxiliary = Auxiliary(split,
+                                            pileup.nt_counts,
+                                            nt_depths = pileup.nt_depths,
+                                            num_capped_columns = pileup.num_capped_columns,
+                                            min_coverage = self.min_coverage_for_variability,
+                                            report_variability_full = self.report_variability_full)
+
+                # nucleotide counts are profiled, we don't need them anymore:
+                pileup.nt_counts, pileup.nt_depths = None, None
 
             counter += 1
 
-        self.coverage.process_c(contig_coverage)
+        self.coverage.process_c(numpy.concatenate(split_coverages))
 
 
-    def analyze_auxiliary(self, bam, progress):
+    def analyze_auxiliary(self, progress):
+        """Column profiles are generated during `analyze_coverage`, but whether a variable position
+           is a coverage outlier in the contig can only be known once the coverage of the entire
+           contig is known. This function fills in that missing bit."""
         num_splits = len(self.splits)
         counter = 1
 
@@ -109,17 +147,23 @@ class Contig:
             progress.update('Auxiliary stats (split: %d of %d) CMC: %.1f :: SMC: %.1f'\
                                  % (counter, num_splits, self.coverage.mean, split.coverage.mean))
 
-            split.auxiliary = Auxiliary(split,
-                                        bam,
-                                        parent_outlier_positions = self.coverage.outlier_positions,
-                                        min_coverage = self.min_coverage_for_variability,
-                                        report_variability_full = self.report_variability_full)
+            split.auxiliary.mark_parent_outlier_positions(self.coverage.outlier_positions)
 
             counter += 1
 
 
-class Split:
-    def __init__(self, name, sequence, parent, order, start = 0, end = 0):
+class Split(SlottedObject):
+    """A split of a contig. Variable positions in it are kept in `column_profiles`, a record array with one record
+       for each of them in the order of their positions (see `column_profiles_dtype`)."""
+
+    column_profiles_dtype = SplitColumnProfiles.variable_positions_dtype + [('pos_in_contig', 'i8'),
+                                                                           ('cov_outlier_in_split', 'bool'),
+                                                                           ('cov_outlier_in_contig', 'bool')]
+
+    __slots__ = ['name', 'sequence', 'parent', 'end', 'order', 'start', 'length', 'explicit_length', 'abundance',
+                 'column_profiles', 'auxiliary', 'coverage']
+
+    def __init__(self, name = None, sequence = None, parent = None, order = 0, start = 0, end = 0):
         self.name = name
         self.sequence = sequence
         self.parent = parent
@@ -129,8 +173,18 @@ class Split:
         self.length = end - start
         self.explicit_length = 0
         self.abundance = 0.0
-        self.column_profiles = {}
+        self.column_profiles = get_column_profiles_array([])
         self.auxiliary = None
+        self.coverage = None
+
+
+    def __setstate__(self, state):
+        SlottedObject.__setstate__(self, state)
+
+        # pickles of earlier versions keep a dict of column profile dicts for variable positions:
+        if isinstance(self.column_profiles, dict):
+            self.column_profiles = get_column_profiles_array([self.column_profiles[p] for p in sorted(self.column_profiles)])
+
 
     def get_atomic_data_dict(self):
         d = {'std_coverage': self.coverage.std,
@@ -146,99 +200,152 @@ class Split:
         return d
 
 
-class Auxiliary:
-    def __init__(self, split, bam, parent_outlier_positions, min_coverage = 10, report_variability_full = False):
-        self.v = []
-        self.rep_seq = ''
+class Auxiliary(SlottedObject):
+    """Profiles variable positions of a split into `split.column_profiles`. Everything else about positions in
+       the split (`v`, `rep_seq`, and `competing_nucleotides`) is recovered from there when it is asked for."""
+
+    __slots__ = ['split', 'variation_density', 'min_coverage', 'num_capped_columns', 'report_variability_full']
+
+    def __init__(self, split = None, nt_counts = None, nt_depths = None, num_capped_columns = 0, min_coverage = 10, report_variability_full = False):
         self.split = split
         self.variation_density = 0.0
-        self.parent_outlier_positions = parent_outlier_positions
-        self.competing_nucleotides = {}
         self.min_coverage = min_coverage
-        self.column_profile = self.split.column_profiles
+        self.num_capped_columns = num_capped_columns
         self.report_variability_full = report_variability_full 
 
-        self.run(bam)
+        # there will be no nucleotide counts for splits that are read back from a serialized profile:
+        if nt_counts is not None:
+            self.run(nt_counts, nt_depths)
 
 
-    def run(self, bam):
-        ratios = []
+    def run(self, nt_counts, nt_depths = None):
+        # columns deeper than max depth come from the pileup engines with nucleotide counts of a random sample
+        # of their reads, and with their true depths in `nt_depths`:
+        coverage = nt_depths if nt_depths is not None else nt_counts.sum(axis = 1)
 
-        for pileupcolumn in bam.pileup(self.split.parent, self.split.start, self.split.end):
-            pos_in_contig = pileupcolumn.pos
-            if pos_in_contig < self.split.start or pos_in_contig >= self.split.end:
-                continue
+        column_profiles = SplitColumnProfiles(nt_counts,
+                                              self.split.sequence,
+                                              min_coverage = self.min_coverage,
+                                              test_class = variability_test_class_null if self.report_variability_full else variability_test_class_default)
 
-            valid_nts = [pileupread.alignment.seq[pileupread.query_position] for pileupread in pileupcolumn.pileups if not pileupread.is_del and not pileupread.is_refskip]
+        variable_positions = column_profiles.variable_positions
 
-            coverage = len(valid_nts)
-            if coverage < self.min_coverage:
-                continue
+        cp = numpy.zeros(variable_positions.size, dtype = Split.column_profiles_dtype).view(numpy.recarray)
+        for field in variable_positions.dtype.names:
+            cp[field] = variable_positions[field]
 
-            column = ''.join(valid_nts)
+        cp.coverage = coverage[variable_positions.pos] # the true coverage, even if the column was capped
+        cp.pos_in_contig = variable_positions.pos + self.split.start
+        cp.cov_outlier_in_split = numpy.in1d(variable_positions.pos, self.split.coverage.outlier_positions)
+        cp.cov_outlier_in_contig = False # will be set by `mark_parent_outlier_positions`
 
-            pos_in_split = pos_in_contig - self.split.start
-            consensus_base_in_contig = self.split.sequence[pos_in_split]
+        self.split.column_profiles = cp
 
-            cp = ColumnProfile(column,
-                               consensus = consensus_base_in_contig,
-                               coverage = coverage,
-                               split_name = self.split.name,
-                               pos = pos_in_split,
-                               test_class = variability_test_class_null if self.report_variability_full else variability_test_class_default).profile
+        # variation density = number of SNPs per kb
+        self.variation_density = len(variable_positions) * 1000.0 / self.split.length
 
-            if cp['departure_from_consensus']:
-                ratios.append((cp['departure_from_consensus'], cp['coverage']), )
-                cp['pos_in_contig'] = pos_in_contig
-                cp['cov_outlier_in_split'] = pos_in_split in self.split.coverage.outlier_positions
-                cp['cov_outlier_in_contig'] = pos_in_contig in self.parent_outlier_positions
-                self.column_profile[pos_in_contig] = cp
 
-        # variation density = number of SNPs per kb
-        self.variation_density = len(ratios) * 1000.0 / self.split.length
+    def mark_parent_outlier_positions(self, parent_outlier_positions):
+        cp = self.split.column_profiles
+        cp.cov_outlier_in_contig = numpy.in1d(cp.pos_in_contig, parent_outlier_positions)
 
-        for i in range(self.split.start, self.split.end):
-            if self.column_profile.has_key(i):
-                self.rep_seq += self.column_profile[i]['consensus']
-                self.v.append(self.column_profile[i]['departure_from_consensus'])
-                self.competing_nucleotides[self.column_profile[i]['pos']] = self.column_profile[i]['competing_nts']
-            else:
-                self.rep_seq += 'N'
-                self.v.append(0)
+
+    @property
+    def column_profile(self):
+        return self.split.column_profiles
+
+
+    @property
+    def v(self):
+        """Departure from consensus for every position in the split (0 for positions that are not variable)"""
+        v = numpy.zeros(self.split.length)
+        v[self.column_profile.pos] = self.column_profile.departure_from_consensus
+        return v
+
+
+    @property
+    def rep_seq(self):
+        """Consensus nucleotides of variable positions in the split, and 'N' for every other position"""
+        rep_seq = numpy.empty(self.split.length, dtype = 'S1')
+        rep_seq.fill('N')
+        rep_seq[self.column_profile.pos] = self.column_profile.consensus
+        return rep_seq.tostring()
+
+
+    @property
+    def competing_nucleotides(self):
+        return dict(zip(self.column_profile.pos.tolist(), self.column_profile.competing_nts.tolist()))
+
+
+def get_column_profiles_array(column_profiles):
+    """Returns a record array of column profiles for `Split.column_profiles` from a list of column profile dicts"""
+    fields = [f[0] for f in Split.column_profiles_dtype]
+    records = [tuple([cp[f] for f in fields]) for cp in column_profiles]
+    return numpy.array(records, dtype = Split.column_profiles_dtype).view(numpy.recarray)
 
 
 class AtomicContigSplitData:
+    """Collects atomic data for contigs and splits as they are profiled (see `add_contig`), and stores
+       them all at once. Abundance values depend on the mean coverage of every contig, so they are set
+       at the very end."""
     def __init__(self, p=progress):
         self.atomic_data_contigs = {}
         self.atomic_data_splits = {}
+        self.contig_lengths = {}
         self.progress = p
 
 
-    def store_atomic_data_for_contigs_and_splits(self, sample_id, contigs, db):
-        self.progress.new('Storing atomic_data')
-
-        num_contigs = pp(len(contigs))
-        cur_contig = 1
+    def add_contig(self, contig):
+        contig_atomic_data = contig.get_atomic_data_dict()
 
-        # this loop will get atomic_data information from Contig instanes and store them into the db
-        # at once. this was broken down into about 10 functions, but this structure seems to be the most efficient
-        # although it looks crappy:
-        for contig_name in contigs:
-            self.progress.update("Processing contig %s of %s" % (pp(cur_contig), num_contigs))
-            contig = contigs[contig_name]
-            contig_atomic_data = contig.get_atomic_data_dict()
+        self.atomic_data_contigs[contig.name] = {'contig': contig.name}
+        for atomic_data_field in t.atomic_data_table_structure[1:]:
+            self.atomic_data_contigs[contig.name][atomic_data_field] = contig_atomic_data[atomic_data_field]
 
-            self.atomic_data_contigs[contig.name] = {'contig': contig.name}
+        # contig is done, deal with splits in it:
+        for split in contig.splits:
+            split_atomic_data = split.get_atomic_data_dict()
+            self.atomic_data_splits[split.name] = {'contig': split.name}
             for atomic_data_field in t.atomic_data_table_structure[1:]:
-                self.atomic_data_contigs[contig.name][atomic_data_field] = contig_atomic_data[atomic_data_field]
+                self.atomic_data_splits[split.name][atomic_data_field] = split_atomic_data[atomic_data_field]
+
+        self.contig_lengths[contig.name] = contig.length
+
+
+    def add_atomic_data_from_db(self, db, contig_lengths):
+        """Adds atomic data for contigs and splits that were already stored in a profile database (i.e., in a
+           partial profile for a shard of contigs). `contig_lengths` must know every contig in it."""
+        atomic_data_splits = db.get_table_as_dict('atomic_data_splits')
+        atomic_data_contigs = db.get_table_as_dict('atomic_data_contigs')
 
-            # contig is done, deal with splits in it:
-            for split in contig.splits:
-                split_atomic_data = split.get_atomic_data_dict()
-                self.atomic_data_splits[split.name] = {'contig': split.name}
-                for atomic_data_field in t.atomic_data_table_structure[1:]:
-                    self.atomic_data_splits[split.name][atomic_data_field] = split_atomic_data[atomic_data_field]
+        # atomic data for contigs are stored for each split they contain:
+        for split_name in atomic_data_splits:
+            contig_name = atomic_data_splits[split_name]['__parent__']
 
+            self.atomic_data_splits[split_name] = atomic_data_splits[split_name]
+            self.atomic_data_splits[split_name]['contig'] = split_name
+
+            self.atomic_data_contigs[contig_name] = atomic_data_contigs[split_name]
+            self.atomic_data_contigs[contig_name]['contig'] = contig_name
+
+            self.contig_lengths[contig_name] = contig_lengths[contig_name]
+
+
+    def set_abundances(self):
+        # first calculate the mean coverage
+        total_length_of_all_contigs = sum(self.contig_lengths.values())
+        total_coverage_values_for_all_contigs = sum([self.atomic_data_contigs[c]['mean_coverage'] * self.contig_lengths[c] for c in self.contig_lengths])
+        overall_mean_coverage = total_coverage_values_for_all_contigs / total_length_of_all_contigs if total_length_of_all_contigs else 0
+
+        # set normalized abundance factor for each contig and split
+        for atomic_data in self.atomic_data_contigs.values() + self.atomic_data_splits.values():
+            atomic_data['abundance'] = atomic_data['mean_coverage'] / overall_mean_coverage if overall_mean_coverage else 0
+
+
+    def store_atomic_data_for_contigs_and_splits(self, db):
+        self.progress.new('Storing atomic_data')
+        self.progress.update("Setting abundances ...")
+        self.set_abundances()
 
         self.progress.update("Generating tables ...")
         gen_atomic_data_tables_for_contigs_and_splits(self.atomic_data_splits, self.atomic_data_contigs, db)
@@ -257,3 +364,210 @@ def gen_atomic_data_tables_for_contigs_and_splits(atomic_data_splits, atomic_dat
     db._exec_many('''INSERT INTO atomic_data_contigs VALUES (?,?,?,?,?,?,?,?,?,?)''', db_entries)
 
     db.commit()
+
+
+class SerializedProfile(auxiliarydataops.HDF5_IO):
+    """Serializes profiled contigs into an HDF5 file, and reads them back.
+
+       Contigs, splits, coverage values, and column profiles are kept in four tables with a row for each
+       contig, split, nucleotide position, and variable position, respectively. Rows are appended to these
+       tables as contigs come (see `append`), and a contig is read back by reading only the slices of the
+       tables that belong to it (see `get`), so neither writing nor reading the file requires all contigs
+       to be in memory."""
+
+    coverage_stats = ['min', 'max', 'std', 'mean', 'median', 'portion_covered', 'mean_Q1Q3']
+    coverage_stats_dtype = [(stat, 'f8') for stat in coverage_stats]
+
+    contigs_dtype = [('name', h5py.special_dtype(vlen = str)), ('length', 'i8'), ('first_split', 'i8'),
+                     ('num_splits', 'i8')] + coverage_stats_dtype
+
+    splits_dtype = [('name', h5py.special_dtype(vlen = str)), ('order', 'i8'), ('start', 'i8'), ('end', 'i8'),
+                    ('first_coverage', 'i8'), ('num_coverages', 'i8'), ('first_column_profile', 'i8'),
+                    ('num_column_profiles', 'i8'), ('variation_density', 'f8')] + coverage_stats_dtype
+
+    column_profiles_dtype = Split.column_profiles_dtype
+
+    def __init__(self, file_path, db_hash, create_new = False, ignore_hash = False, contig_parameters = {}):
+        auxiliarydataops.HDF5_IO.__init__(self, file_path, db_hash, create_new = create_new, ignore_hash = ignore_hash)
+
+        if create_new:
+            # these are the same for every contig in a profile:
+            for parameter in ['split_length', 'min_coverage_for_variability', 'skip_SNV_profiling', 'report_variability_full']:
+                self.fp.attrs[parameter] = contig_parameters[parameter]
+
+            for table, dtype in [('contigs', self.contigs_dtype), ('splits', self.splits_dtype),
+                                 ('coverages', 'uint32'), ('column_profiles', self.column_profiles_dtype)]:
+                self.fp.create_dataset('/data/%s' % table, (0, ), dtype = numpy.dtype(dtype), maxshape = (None, ),
+                                       chunks = True, compression = 'gzip', shuffle = True)
+
+        self.contigs = self.fp['/data/contigs']
+        self.splits = self.fp['/data/splits']
+        self.coverages = self.fp['/data/coverages']
+        self.column_profiles = self.fp['/data/column_profiles']
+
+        self.contig_names, self.contig_lengths, self.contig_name_to_index = [], {}, {}
+        if not create_new:
+            contigs = self.contigs[...]
+            self.contig_names = contigs['name'].tolist()
+            self.contig_lengths = dict(zip(self.contig_names, contigs['length'].tolist()))
+            self.contig_name_to_index = dict(zip(self.contig_names, range(0, len(self.contig_names))))
+
+
+    def append_rows(self, table, rows):
+        num_rows = table.shape[0]
+
+        if len(rows):
+            table.resize((num_rows + len(rows), ))
+            table[num_rows:] = rows
+
+        return num_rows
+
+
+    def extend(self, serialized_profile, chunk_size = 10000000):
+        """Appends every contig in another serialized profile to this one. Tables are copied in chunks of
+           `chunk_size` rows, and only the row offsets that point to other tables are changed on the way."""
+        first_split = self.splits.shape[0]
+        first_coverage = self.coverages.shape[0]
+        first_column_profile = self.column_profiles.shape[0]
+
+        for table in ['coverages', 'column_profiles']:
+            source, target = getattr(serialized_profile, table), getattr(self, table)
+            for start in range(0, source.shape[0], chunk_size):
+                self.append_rows(target, source[start:start + chunk_size])
+
+        splits = serialized_profile.splits[...]
+        splits['first_coverage'] += first_coverage
+        splits['first_column_profile'] += first_column_profile
+        self.append_rows(self.splits, splits)
+
+        contigs = serialized_profile.contigs[...]
+        contigs['first_split'] += first_split
+        num_contigs = self.append_rows(self.contigs, contigs)
+
+        for contig_name in serialized_profile.contig_names:
+            self.contig_name_to_index[contig_name] = num_contigs + serialized_profile.contig_name_to_index[contig_name]
+            self.contig_names.append(contig_name)
+            self.contig_lengths[contig_name] = serialized_profile.contig_lengths[contig_name]
+
+
+    def get_coverage_stats(self, coverage):
+        return tuple([getattr(coverage, stat) for stat in self.coverage_stats])
+
+
+    def set_coverage_stats(self, coverage, record):
+        for stat in self.coverage_stats:
+            setattr(coverage, stat, record[stat])
+
+
+    def append(self, contig):
+        splits = []
+        first_coverage = self.coverages.shape[0]
+        first_column_profile = self.column_profiles.shape[0]
+
+        for split in contig.splits:
+            column_profiles = split.column_profiles
+
+            self.append_rows(self.coverages, split.coverage.c)
+            self.append_rows(self.column_profiles, column_profiles)
+
+            splits.append((split.name, split.order, split.start, split.end, first_coverage, split.coverage.c.size,
+                           first_column_profile, len(column_profiles),
+                           split.auxiliary.variation_density if split.auxiliary else 0.0) + self.get_coverage_stats(split.coverage))
+
+            first_coverage += split.coverage.c.size
+            first_column_profile += len(column_profiles)
+
+        first_split = self.append_rows(self.splits, numpy.array(splits, dtype = self.splits_dtype))
+
+        contig_row = (contig.name, contig.length, first_split, len(splits)) + self.get_coverage_stats(contig.coverage)
+        self.append_rows(self.contigs, numpy.array([contig_row], dtype = self.contigs_dtype))
+
+
+    def get(self, contig_name):
+        contig_record = self.contigs[self.contig_name_to_index[contig_name]]
+
+        contig = Contig(contig_name)
+        contig.length = int(contig_record['length'])
+        self.set_coverage_stats(contig.coverage, contig_record)
+
+        for parameter in ['split_length', 'min_coverage_for_variability', 'skip_SNV_profiling', 'report_variability_full']:
+            setattr(contig, parameter, self.fp.attrs[parameter].item())
+
+        first_split = contig_record['first_split']
+        splits = self.splits[first_split:first_split + contig_record['num_splits']]
+        if not len(splits):
+            return contig
+
+        coverages = self.coverages[splits[0]['first_coverage']:splits[-1]['first_coverage'] + splits[-1]['num_coverages']]
+        column_profiles = self.column_profiles[splits[0]['first_column_profile']:splits[-1]['first_column_profile'] + splits[-1]['num_column_profiles']]
+        coverages_offset, column_profiles_offset = splits[0]['first_coverage'], splits[0]['first_column_profile']
+
+        for split_record in splits:
+            split = Split(split_record['name'], None, contig_name, int(split_record['order']), int(split_record['start']), int(split_record['end']))
+
+            split.coverage = Coverage()
+            first_coverage = split_record['first_coverage'] - coverages_offset
+            split.coverage.c = coverages[first_coverage:first_coverage + split_record['num_coverages']]
+            split.explicit_length = split.coverage.c.size
+            self.set_coverage_stats(split.coverage, split_record)
+
+            if not contig.skip_SNV_profiling:
+                first_column_profile = split_record['first_column_profile'] - column_profiles_offset
+                split.column_profiles = column_profiles[first_column_profile:first_column_profile + split_record['num_column_profiles']].view(numpy.recarray)
+
+                split.auxiliary = Auxiliary(split, None)
+                split.auxiliary.variation_density = float(split_record['variation_density'])
+
+            contig.splits.append(split)
+
+        return contig
+
+
+class ProfileCheckpoint(SerializedProfile):
+    """A serialized profile for a batch of contigs that were profiled during a checkpointed run.
+
+       The file is written under a temporary name and gets its real name only when it is closed, so a run that
+       dies while writing a checkpoint does not leave a partial one behind. Besides the profiled contigs, a
+       checkpoint knows which contigs were discarded (so they are not profiled again), and the parameters of
+       the run that wrote it (so a run can not be resumed with different ones)."""
+
+    def __init__(self, file_path, db_hash, create_new = False, contig_parameters = {}, checkpoint_parameters = {}):
+        self.final_path = file_path
+
+        SerializedProfile.__init__(self, file_path + '.tmp' if create_new else file_path, db_hash,
+                                   create_new = create_new, contig_parameters = contig_parameters)
+
+        if create_new:
+            for parameter in checkpoint_parameters:
+                self.fp.attrs[parameter] = checkpoint_parameters[parameter]
+
+            self.discarded_contig_names = []
+            self.num_columns_capped_for_SNV_profiling = 0
+        else:
+            self.discarded_contig_names = self.fp['/data/discarded_contigs'][...].tolist()
+            self.num_columns_capped_for_SNV_profiling = int(self.fp.attrs['num_columns_capped_for_SNV_profiling'])
+
+
+    def get_parameter(self, parameter):
+        value = self.fp.attrs[parameter]
+        return value.item() if hasattr(value, 'item') else value
+
+
+    def discard(self, contig_name):
+        self.discarded_contig_names.append(contig_name)
+
+
+    def close(self):
+        if self.fp.mode == 'r':
+            self.fp.close()
+            return
+
+        discarded_contigs = self.fp.create_dataset('/data/discarded_contigs', (len(self.discarded_contig_names), ),
+                                                   dtype = h5py.special_dtype(vlen = str))
+        if len(self.discarded_contig_names):
+            discarded_contigs[...] = self.discarded_contig_names
+        self.fp.attrs['num_columns_capped_for_SNV_profiling'] = self.num_columns_capped_for_SNV_profiling
+
+        self.fp.close()
+        os.rename(self.file_path, self.final_path)
+
@@ -5,8 +5,11 @@
 
 import os
 import sqlite3
+import itertools
+import contextlib
 
 import anvio
+import anvio.terminal as terminal
 import anvio.filesnpaths as filesnpaths
 
 from anvio.errors import ConfigError
@@ -21,11 +24,28 @@ __maintainer__ = "A. Murat Eren"
 __email__ = "a.murat.eren@gmail.com"
 __status__ = "Development"
 
+
+run = terminal.Run()
+
+
 class DB:
-    def __init__(self, db_path, client_version, new_database=False, ignore_version=False):
+    def __init__(self, db_path, client_version, new_database=False, ignore_version=False, bulk_load=False):
         self.db_path = db_path
         self.version = None
 
+        # number of rows _exec_many sends to sqlite at once:
+        self.batch_size = 10000
+
+        # pragmas for the bulk-load mode, which is on only when `bulk_load` is set. they trade durability for
+        # speed, which is OK for a database that is being created from scratch (if the process dies half way,
+        # the database is useless anyway), but not for much else:
+        self.bulk_load_page_size = 16384
+        self.bulk_load_cache_size_in_kb = 102400
+        self.bulk_load_mode = False
+
+        # commits are deferred while this is larger than 0 (see `transaction`):
+        self.transaction_depth = 0
+
         if new_database:
             filesnpaths.is_output_file_writable(db_path)
         else:
@@ -40,6 +60,11 @@ class DB:
         self.cursor = self.conn.cursor()
 
         if new_database:
+            if bulk_load:
+                # page size has to be set before anything is written into the new database file:
+                self._exec('PRAGMA page_size = %d' % self.bulk_load_page_size)
+                self.set_bulk_load_mode()
+
             self.create_self()
             self.set_version(client_version)
         else:
@@ -52,6 +77,9 @@ class DB:
                                     version %s :/"\
                                             % (self.db_path, self.version, client_version, client_version)
 
+            if bulk_load:
+                self.set_bulk_load_mode()
+
 
     def get_version(self):
         try:
@@ -108,12 +136,68 @@ class DB:
         return val
 
 
+    def set_bulk_load_mode(self):
+        """Switches on pragmas that make writing lots of data much faster: write-ahead logging instead of
+           a rollback journal, no fsync after every transaction, and a larger page cache. The database
+           goes back to the default journal mode when it is disconnected."""
+
+        self._exec('PRAGMA journal_mode = WAL')
+        self._exec('PRAGMA synchronous = OFF')
+        self._exec('PRAGMA cache_size = -%d' % self.bulk_load_cache_size_in_kb)
+        self.bulk_load_mode = True
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """A context manager to run many statements in a single transaction:
+
+               with database.transaction():
+                   for entry in entries:
+                       database._exec('''INSERT INTO ...''', entry)
+
+           Nothing is committed until the outermost `with` block ends, and whatever is not committed
+           yet is rolled back if it ends with an exception. Beware that the sqlite3 module of Python 2
+           commits the open transaction on its own before any statement that is not an INSERT, UPDATE,
+           DELETE, REPLACE or SELECT, so any CREATE, DROP or ALTER statement in the block (including the
+           ones `get_rows_from_table` runs for a temporary table when it is given keys of interest)
+           commits everything up to that point, and a rollback can only undo what came after it."""
+
+        self.transaction_depth += 1
+        try:
+            yield self
+        except:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.conn.rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if not self.transaction_depth:
+            self.conn.commit()
+
+
     def commit(self):
+        if self.transaction_depth:
+            return
+
         self.conn.commit()
 
 
     def disconnect(self):
         self.conn.commit()
+
+        if self.bulk_load_mode:
+            try:
+                self._exec('PRAGMA journal_mode = DELETE')
+            except sqlite3.OperationalError as e:
+                # most likely some other connection is still using the database. nothing is lost, but
+                # the database stays in WAL mode, and the -wal and -shm files next to it must stay with it.
+                run.warning("Anvi'o could not switch the database '%s' back to its usual journal mode after\
+                             writing into it in bulk (sqlite said: '%s'). The data is safe, but the database\
+                             will stay in write-ahead-log mode, so if you move or copy it, please move or copy\
+                             the files '%s-wal' and '%s-shm' next to it along with it, if they are\
+                             there." % (self.db_path, e, self.db_path, self.db_path))
+
         self.conn.close()
 
 
@@ -127,8 +211,22 @@ class DB:
         return ret_val
 
 
-    def _exec_many(self, sql_query, values):
-        return self.cursor.executemany(sql_query, values)
+    def _exec_many(self, sql_query, values, batch_size=None):
+        """Runs `sql_query` for every item in `values` (which can be any iterable, including a generator),
+           sending them to sqlite in batches of `batch_size` (`self.batch_size` by default)"""
+
+        if not batch_size:
+            batch_size = self.batch_size
+
+        values = iter(values)
+        while True:
+            batch = list(itertools.islice(values, batch_size))
+            if not batch:
+                break
+
+            self.cursor.executemany(sql_query, batch)
+
+        return self.cursor
 
 
     def get_all_rows_from_table(self, table):
@@ -136,6 +234,70 @@ class DB:
         return response.fetchall()
 
 
+    def get_rows_from_table(self, table, columns = None, where_clause = None, where_values = None, keys_of_interest = None, key_column = None):
+        """Returns rows from `table` as a list of tuples, asking SQLite only for what is needed.
+
+           `columns` is the list of columns to return (all of them by default). `where_clause` is a
+           condition with '?' placeholders for `where_values` (i.e., 'source = ?'). When there are
+           `keys_of_interest`, only rows with a `key_column` (the first column by default) value among
+           them are returned. Keys are put into a temporary table, so there is no limit to how many of
+           them there can be."""
+
+        conditions = []
+        values = []
+
+        if where_clause:
+            conditions.append('(%s)' % where_clause)
+            values.extend(where_values or [])
+
+        if keys_of_interest:
+            if not key_column:
+                key_column = self.get_table_structure(table)[0]
+
+            self.create_temporary_keys_table(table, key_column, keys_of_interest)
+            conditions.append('%s IN (SELECT key FROM temp.keys_of_interest)' % key_column)
+
+        sql_query = '''SELECT %s FROM %s''' % (', '.join(columns) if columns else '*', table)
+        if conditions:
+            sql_query += ''' WHERE %s''' % ' AND '.join(conditions)
+
+        rows = self._exec(sql_query, values).fetchall()
+
+        if keys_of_interest:
+            self._exec('''DROP TABLE temp.keys_of_interest''')
+
+        return rows
+
+
+    def create_temporary_keys_table(self, table, key_column, keys):
+        # the column gets the type of `key_column`, so keys are converted the same way the values in `table` were:
+        key_column_type = dict(zip(self.get_table_structure(table), self.get_table_column_types(table)))[key_column]
+
+        self._exec('''DROP TABLE IF EXISTS temp.keys_of_interest''')
+        self._exec('''CREATE TEMP TABLE keys_of_interest (key %s)''' % key_column_type)
+        self._exec_many('''INSERT INTO temp.keys_of_interest VALUES (?)''', ((key,) for key in set(keys)))
+
+
+    def get_aggregate_from_table(self, table, aggregate, column = '*', where_clause = None, where_values = None):
+        """Returns the result of an aggregate function (such as MAX, or COUNT) on a column of `table`,
+           optionally for rows that match `where_clause` (see `get_rows_from_table`)"""
+
+        sql_query = '''SELECT %s(%s) FROM %s''' % (aggregate, column, table)
+        if where_clause:
+            sql_query += ''' WHERE %s''' % where_clause
+
+        return self._exec(sql_query, where_values).fetchone()[0]
+
+
+    def get_max_value_in_column(self, table, column, where_clause = None, where_values = None):
+        """Returns the largest value in `column`, or None if there are no rows"""
+        return self.get_aggregate_from_table(table, 'MAX', column, where_clause, where_values)
+
+
+    def get_row_counts_from_table(self, table, where_clause = None, where_values = None):
+        return self.get_aggregate_from_table(table, 'COUNT', '*', where_clause, where_values)
+
+
     def get_single_column_from_table(self, table, column):
         response = self._exec('''SELECT %s FROM %s''' % (column, table))
         return [t[0] for t in response.fetchall()]
@@ -147,7 +309,7 @@ class DB:
 
 
     def get_table_structure(self, table):
-        response = self._exec('''SELECT * FROM %s''' % table)
+        response = self._exec('''SELECT * FROM %s LIMIT 0''' % table)
         return [t[0] for t in response.description]
 
 
@@ -155,21 +317,25 @@ class DB:
         return self.get_all_rows_from_table(table)
 
 
-    def get_table_as_dict(self, table, table_structure = None, string_the_key = False, columns_of_interest = None, keys_of_interest = None, omit_parent_column = False, error_if_no_data = True):
+    def get_table_as_dict(self, table, table_structure = None, string_the_key = False, columns_of_interest = None, keys_of_interest = None, omit_parent_column = False, error_if_no_data = True, where_clause = None, where_values = None):
+        """Returns `table` as a dictionary of dictionaries keyed by the values in its first column.
+
+           Only the columns and the rows of interest are read from the database: columns that are not
+           in `columns_of_interest` (and the '__parent__' column if `omit_parent_column` is True) are
+           not selected, and rows are limited to those with keys in `keys_of_interest`, and to those
+           that match `where_clause` (see `get_rows_from_table`)."""
+
         if not table_structure:
             table_structure = self.get_table_structure(table)
 
-        columns_to_return = range(0, len(table_structure))
+        columns_to_return = list(table_structure)
 
         if omit_parent_column:
-            if '__parent__' in table_structure:
-                columns_to_return.remove(table_structure.index('__parent__'))
-                table_structure.remove('__parent__')
+            if '__parent__' in columns_to_return:
+                columns_to_return.remove('__parent__')
 
         if columns_of_interest:
-            for col in table_structure[1:]:
-                if col not in columns_of_interest:
-                    columns_to_return.remove(table_structure.index(col))
+            columns_to_return = columns_to_return[0:1] + [col for col in columns_to_return[1:] if col in columns_of_interest]
 
         if len(columns_to_return) == 1:
             if error_if_no_data:
@@ -178,61 +344,28 @@ class DB:
             else:
                 return {}
 
-        if keys_of_interest:
-            keys_of_interest = set(keys_of_interest)
-
         results_dict = {}
 
-        rows = self.get_all_rows_from_table(table)
+        rows = self.get_rows_from_table(table, columns = columns_to_return, where_clause = where_clause,
+                                        where_values = where_values, keys_of_interest = keys_of_interest)
 
         for row in rows:
-            entry = {}
-
-            if keys_of_interest:
-                if row[0] in keys_of_interest:
-                    # so we are interested in keeping this, reduce the size of the
-                    # hash size to improve the next inquiry, and keep going.
-                    keys_of_interest.remove(row[0])
-                else:
-                    # we are not intersted in this one, continue:
-                    continue
-
-            for i in columns_to_return[1:]:
-                entry[table_structure[i]] = row[i]
-
-            if string_the_key:
-                results_dict[str(row[0])] = entry
-            else:
-                results_dict[row[0]] = entry
+            key = str(row[0]) if string_the_key else row[0]
 
-        return results_dict
-
-
-    def get_some_rows_from_table_as_dict(self, table, where_clause, error_if_no_data = True, string_the_key = False):
-        """This is similar to get_table_as_dict, but much less general.
-        
-           get_table_as_dict can do a lot, but it first reads all data into the memory to operate on it.
-           In some cases the programmer may like to access to only a small fraction of entries in a table
-           by using `WHERE column = value` notation, which is not possible with the more generalized
-           function."""
-
-        results_dict = {}
+            if keys_of_interest and key in results_dict:
+                # when keys of interest are given, the first row for a given key is the one to keep:
+                continue
 
-        table_structure = self.get_table_structure(table)
-        columns_to_return = range(0, len(table_structure))
+            results_dict[key] = dict(zip(columns_to_return[1:], row[1:]))
 
-        rows = self._exec('''SELECT * FROM %s WHERE %s''' % (table, where_clause)).fetchall()
+        return results_dict
 
-        for row in rows:
-            entry = {}
 
-            for i in columns_to_return[1:]:
-                entry[table_structure[i]] = row[i]
+    def get_some_rows_from_table_as_dict(self, table, where_clause, error_if_no_data = True, string_the_key = False, where_values = None):
+        """This is similar to get_table_as_dict with a `where_clause`, but it complains if nothing matches
+           the clause (unless `error_if_no_data` is False)."""
 
-            if string_the_key:
-                results_dict[str(row[0])] = entry
-            else:
-                results_dict[row[0]] = entry
+        results_dict = self.get_table_as_dict(table, string_the_key = string_the_key, where_clause = where_clause, where_values = where_values)
 
         if error_if_no_data and not len(results_dict):
             raise ConfigError, "Query on %s with the where clause of '%s' did not return anything." % (table, where_clause)
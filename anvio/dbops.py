@@ -5,15 +5,18 @@
 
 import os
 import time
+import zlib
 import copy
 import numpy
+import Queue
 import random
 import hashlib
 import datetime
 import operator
 import textwrap
+import multiprocessing
 from itertools import chain
-from collections import Counter
+from collections import Counter, OrderedDict
 
 import anvio
 import anvio.db as db
@@ -29,9 +32,10 @@ import anvio.genecalling as genecalling
 import anvio.auxiliarydataops as auxiliarydataops
 
 from anvio.errors import ConfigError
-from anvio.hmmops import HMMSearch
+from anvio.hmmops import HMMSearch, PressedHMMCache
 from anvio.parsers import parser_modules
 from anvio.tableops import Table
+from anvio.sequence import CoverageIndex
 
 
 __author__ = "A. Murat Eren"
@@ -49,6 +53,15 @@ progress = terminal.Progress()
 pp = terminal.pretty_print
 
 
+# (in_partial_gene_call, in_complete_gene_call, pos_in_codon) for every value an entry in the nt position info
+# array can take (see `compress_nt_position_info`). values that are not used there resolve to (0, 0, 0):
+nt_position_info_lookup = numpy.zeros((256, 3), dtype = numpy.uint8)
+nt_position_info_lookup[8] = (1, 0, 0)
+nt_position_info_lookup[4] = (0, 1, 1)
+nt_position_info_lookup[2] = (0, 1, 2)
+nt_position_info_lookup[1] = (0, 1, 3)
+
+
 class ContigsSuperclass(object):
     def __init__(self, args, r = run, p = progress):
         self.run = r
@@ -61,6 +74,7 @@ class ContigsSuperclass(object):
         self.split_sequences = {}
         self.contigs_basic_info = {}
         self.contig_sequences = {}
+        self.contig_sequences_store = None
 
         self.genes_in_contigs_dict = {}
         self.contig_name_to_genes = {}
@@ -73,6 +87,11 @@ class ContigsSuperclass(object):
         self.auxiliary_contigs_data_available = False
         self.nt_positions_info = None
 
+        # nt position info arrays of the most recently used contigs, so we don't go to the HDF5 file every time
+        # we need to know about a position (see `get_nt_position_info_array`):
+        self.nt_positions_info_cache = OrderedDict()
+        self.nt_positions_info_cache_size = 100
+
         self.gene_function_call_sources = []
         self.gene_function_calls_dict = {}
         self.gene_function_calls_initiated = False
@@ -179,19 +198,39 @@ class ContigsSuperclass(object):
         contigs_shorter_than_M = set([c for c in self.contigs_basic_info if self.contigs_basic_info[c]['length'] < min_contig_length])
 
         self.progress.update('Reading contig sequences')
-        contigs_db = ContigsDatabase(self.contigs_db_path)
-        self.contig_sequences = contigs_db.db.get_table_as_dict(t.contig_sequences_table_name, string_the_key = True)
-        contigs_db.disconnect()
-
-        self.progress.update('Filtering out shorter contigs')
-        for contig_name in contigs_shorter_than_M:
-            self.contig_sequences.pop(contig_name)
+        contig_sequences_store = ContigSequences(self.contigs_db_path)
+        if contigs_shorter_than_M:
+            self.contig_sequences = contig_sequences_store.get_sequences([c for c in self.contigs_basic_info if c not in contigs_shorter_than_M])
+        else:
+            self.contig_sequences = contig_sequences_store.get_sequences()
+        contig_sequences_store.close()
 
         self.progress.end()
 
         return contigs_shorter_than_M
 
 
+    def get_contig_subsequence(self, contig_name, start, stop):
+        """Returns a piece of a contig without loading all contig sequences into memory (unless they
+           are already there, of course)."""
+
+        if contig_name in self.contig_sequences:
+            return self.contig_sequences[contig_name]['sequence'][start:stop]
+
+        if not self.contig_sequences_store:
+            self.contig_sequences_store = ContigSequences(self.contigs_db_path)
+
+        return self.contig_sequences_store.get_subsequence(contig_name, start, stop)
+
+
+    def close_contig_sequences_store(self):
+        """Closes the connection `get_contig_subsequence` opened to the contigs database (if there is one)"""
+
+        if self.contig_sequences_store:
+            self.contig_sequences_store.close()
+            self.contig_sequences_store = None
+
+
     def init_split_sequences(self, min_contig_length = 0):
         contigs_shorter_than_M = self.init_contig_sequences(min_contig_length)
 
@@ -234,8 +273,9 @@ class ContigsSuperclass(object):
             non_singlecopy_gene_hmm_info_dict[source] = self.hmm_sources_info[source]
 
         contigs_db = ContigsDatabase(self.contigs_db_path)
-        non_singlecopy_gene_hmm_results_dict = utils.get_filtered_dict(contigs_db.db.get_table_as_dict(t.hmm_hits_splits_table_name), 'source', self.non_singlecopy_gene_hmm_sources)
-        hmm_hits_table = utils.get_filtered_dict(contigs_db.db.get_table_as_dict(t.hmm_hits_table_name), 'source', self.non_singlecopy_gene_hmm_sources)
+        where_clause = 'source IN (%s)' % ', '.join(['?'] * len(self.non_singlecopy_gene_hmm_sources))
+        non_singlecopy_gene_hmm_results_dict = contigs_db.db.get_table_as_dict(t.hmm_hits_splits_table_name, where_clause = where_clause, where_values = list(self.non_singlecopy_gene_hmm_sources))
+        hmm_hits_table = contigs_db.db.get_table_as_dict(t.hmm_hits_table_name, where_clause = where_clause, where_values = list(self.non_singlecopy_gene_hmm_sources))
 
         if split_names_of_interest:
             non_singlecopy_gene_hmm_results_dict = utils.get_filtered_dict(non_singlecopy_gene_hmm_results_dict, 'split', set(split_names_of_interest))
@@ -279,6 +319,28 @@ class ContigsSuperclass(object):
         self.progress.end()
 
 
+    def get_nt_position_info_array(self, contig_name):
+        """Returns the nt position info array for a contig (or None if the contig is not known). Arrays for up to
+           `self.nt_positions_info_cache_size` contigs are kept in memory, and the least recently used one is
+           forgotten when there is no more room."""
+
+        if not self.nt_positions_info:
+            raise ConfigError, "get_nt_position_info: I am asked to return stuff, but self.nt_position_info is None!\
+                                Anvi'o needs an adult :("
+
+        if contig_name in self.nt_positions_info_cache:
+            position_info = self.nt_positions_info_cache.pop(contig_name)
+        else:
+            position_info = self.nt_positions_info.get(contig_name) if self.nt_positions_info.is_known_contig(contig_name) else None
+
+            if len(self.nt_positions_info_cache) >= self.nt_positions_info_cache_size:
+                self.nt_positions_info_cache.popitem(last = False)
+
+        self.nt_positions_info_cache[contig_name] = position_info
+
+        return position_info
+
+
     def get_nt_position_info(self, contig_name, pos_in_contig):
         """This function returns a tuple with three items for each nucleotide position.
         
@@ -286,25 +348,24 @@ class ContigsSuperclass(object):
         
         See `init_nt_position_info_dict` for more info."""
 
-        if not self.nt_positions_info:
-            raise ConfigError, "get_nt_position_info: I am asked to return stuff, but self.nt_position_info is None!\
-                                Anvi'o needs an adult :("
+        position_info = self.get_nt_position_info_array(contig_name)
 
-        if not self.nt_positions_info.is_known_contig(contig_name):
+        if position_info is None:
             return (0, 0, 0)
 
-        position_info = self.nt_positions_info.get(contig_name)[pos_in_contig]
+        return tuple(nt_position_info_lookup[position_info[pos_in_contig]].tolist())
 
-        if not position_info:
-            return (0, 0, 0)
-        if position_info == 8:
-            return (1, 0, 0)
-        if position_info == 4:
-            return (0, 1, 1)
-        if position_info == 2:
-            return (0, 1, 2)
-        if position_info == 1:
-            return (0, 1, 3)
+
+    def get_nt_position_info_many(self, contig_name, positions_in_contig):
+        """Same as `get_nt_position_info`, but returns a list of tuples for a list of positions in the same
+           contig at once."""
+
+        position_info = self.get_nt_position_info_array(contig_name)
+
+        if position_info is None:
+            return [(0, 0, 0)] * len(positions_in_contig)
+
+        return [tuple(info) for info in nt_position_info_lookup[position_info[positions_in_contig]].tolist()]
 
 
     def init_functions(self):
@@ -401,9 +462,6 @@ class ContigsSuperclass(object):
         except:
             raise ConfigError, "List of IDs for gene calls contains non-integer values :/"
 
-        if not len(self.contig_sequences):
-            self.init_contig_sequences()
-
         sequences_dict = {}
 
         self.progress.new('Getting sequences')
@@ -414,7 +472,7 @@ class ContigsSuperclass(object):
             contig_name = gene_call['contig']
             start, stop = gene_call['start'], gene_call['stop']
             direction = gene_call['direction']
-            sequence = self.contig_sequences[contig_name]['sequence'][start:stop]
+            sequence = self.get_contig_subsequence(contig_name, start, stop)
 
             if direction == 'r' and reverse_complement_if_necessary:
                 sequence = utils.rev_comp(sequence)
@@ -430,6 +488,8 @@ class ContigsSuperclass(object):
                                                'rev_compd': rev_compd,
                                                'length': stop - start}
 
+        self.close_contig_sequences_store()
+
         self.progress.end()
 
         return (gene_caller_ids_list, sequences_dict)
@@ -575,7 +635,7 @@ class ProfileSuperclass(object):
                                 in the right database?" % split_name
 
         profile_db = ProfileDatabase(self.profile_db_path)
-        split_variability_information = profile_db.db.get_some_rows_from_table_as_dict(t.variable_nts_table_name, '''split_name = "%s"''' % split_name, error_if_no_data = False).values()
+        split_variability_information = profile_db.db.get_some_rows_from_table_as_dict(t.variable_nts_table_name, 'split_name = ?', error_if_no_data = False, where_values = (split_name, )).values()
         profile_db.disconnect()
 
         if return_raw_results:
@@ -784,6 +844,11 @@ class ContigsDatabase:
         self.quiet = quiet
 
         self.meta = {}
+
+        # South Loop processes contigs in batches; a batch is full when it hits either of these:
+        self.max_contigs_per_batch = 1000
+        self.max_nts_per_batch = 10000000
+
         self.init()
 
 
@@ -818,6 +883,7 @@ class ContigsDatabase:
         kmer_size = A('kmer_size')
         skip_gene_calling = A('skip_gene_calling')
         skip_mindful_splitting = A('skip_mindful_splitting')
+        num_threads = A('num_threads') or 1
         debug = A('debug')
  
         filesnpaths.is_file_fasta_formatted(contigs_fasta)
@@ -869,10 +935,18 @@ class ContigsDatabase:
             raise ConfigError, "We like our k-mer sizes between 2 and 8, sorry! (but then you can always change the\
                                 source code if you are not happy to be told what you can't do, let us know how it goes!)."
 
+        try:
+            num_threads = int(num_threads)
+        except:
+            raise ConfigError, "Number of threads must be an integer."
+
+        if num_threads < 1:
+            raise ConfigError, "Number of threads can't be smaller than 1. Anvi'o needs at least one thread to work with."
+
         if skip_gene_calling:
             skip_mindful_splitting = True
 
-        self.db = db.DB(self.db_path, anvio.__contigs__version__, new_database = True)
+        self.db = db.DB(self.db_path, anvio.__contigs__version__, new_database = True, bulk_load = True)
 
         # creating empty default tables
         self.db.create_table(t.hmm_hits_table_name, t.hmm_hits_table_structure, t.hmm_hits_table_types)
@@ -885,7 +959,6 @@ class ContigsDatabase:
         self.db.create_table(t.genes_in_contigs_table_name, t.genes_in_contigs_table_structure, t.genes_in_contigs_table_types)
         self.db.create_table(t.genes_in_splits_table_name, t.genes_in_splits_table_structure, t.genes_in_splits_table_types)
         self.db.create_table(t.splits_taxonomy_table_name, t.splits_taxonomy_table_structure, t.splits_taxonomy_table_types)
-        self.db.create_table(t.contig_sequences_table_name, t.contig_sequences_table_structure, t.contig_sequences_table_types)
         self.db.create_table(t.gene_function_calls_table_name, t.gene_function_calls_table_structure, t.gene_function_calls_table_types)
         self.db.create_table(t.gene_protein_sequences_table_name, t.gene_protein_sequences_table_structure, t.gene_protein_sequences_table_types)
         self.db.create_table(t.genes_in_splits_summary_table_name, t.genes_in_splits_summary_table_structure, t.genes_in_splits_summary_table_types)
@@ -907,11 +980,11 @@ class ContigsDatabase:
             # temporarily disconnect to perform gene calls
             self.db.disconnect()
 
-            gene_calls_tables = TablesForGeneCalls(self.db_path, contigs_fasta, debug = debug)
+            gene_calls_tables = TablesForGeneCalls(self.db_path, contigs_fasta, debug = debug, num_threads = num_threads)
             gene_calls_tables.call_genes_and_populate_genes_in_contigs_table()
 
             # reconnect and learn about what's done
-            self.db = db.DB(self.db_path, anvio.__contigs__version__)
+            self.db = db.DB(self.db_path, anvio.__contigs__version__, bulk_load = True)
 
             genes_in_contigs_dict = self.db.get_table_as_dict(t.genes_in_contigs_table_name)
 
@@ -925,7 +998,6 @@ class ContigsDatabase:
 
         # here we will process each item in the contigs fasta file.
         fasta = u.SequenceSource(contigs_fasta)
-        db_entries_contig_sequences = []
 
         contigs_kmer_table = KMerTablesForContigsAndSplits('kmer_contigs', k=kmer_size)
         splits_kmer_table = KMerTablesForContigsAndSplits('kmer_splits', k=kmer_size)
@@ -937,61 +1009,46 @@ class ContigsDatabase:
 
         contigs_info_table = InfoTableForContigs(split_length)
         splits_info_table = InfoTableForSplits()
+        contig_sequences_table = SequencesTableForContigs()
 
         recovered_split_lengths = []
 
-        # THE INFAMOUS GEN CONTGS DB LOOP (because it is so costly, we call it South Loop)
-        self.progress.new('South Loop')
-        while fasta.next():
-            contig_name = fasta.id
-            contig_sequence = fasta.seq
-
-            self.progress.update('Contig "%d" ' % fasta.pos)
-
-            genes_in_contig = contig_name_to_gene_start_stops[contig_name] if contig_name in contig_name_to_gene_start_stops else set([])
-
-            self.progress.append('has %d genes, ' % len(genes_in_contig))
-            if skip_mindful_splitting:
-                contig_length, split_start_stops, contig_gc_content = contigs_info_table.append(contig_name, contig_sequence, set([]))
-            else:
-                contig_length, split_start_stops, contig_gc_content = contigs_info_table.append(contig_name, contig_sequence, genes_in_contig)
-
-            # let's keep an eye on the returned split lengths
-            if len(split_start_stops) > 1:
-                recovered_split_lengths.extend([s[1] - s[0] for s in split_start_stops])
+        # these are the bits every batch of contigs needs to know about. worker processes inherit
+        # them from this one:
+        self.split_length = split_length
+        self.kmer_size = kmer_size
+        self.skip_mindful_splitting = skip_mindful_splitting
+        self.genes_in_contigs_dict = genes_in_contigs_dict
+        self.contig_name_to_gene_start_stops = contig_name_to_gene_start_stops
 
-            self.progress.append('and %d nts. Now computing: auxiliary ... ' % contig_length)
-            if genes_in_contig:
-                nt_position_info_list = self.compress_nt_position_info(contig_length, genes_in_contig, genes_in_contigs_dict)
+        # THE INFAMOUS GEN CONTGS DB LOOP (because it is so costly, we call it South Loop)
+        if num_threads == 1:
+            batches = self.process_contigs_batches_serially(fasta)
+        else:
+            batches = self.process_contigs_batches_in_parallel(fasta, num_threads)
+
+        # the only writer: whatever the number of threads, batches arrive here in the order
+        # they occur in the FASTA file.
+        for batch in batches:
+            contigs_info_table.extend(batch['contigs_info_table'])
+            splits_info_table.extend(batch['splits_info_table'])
+            contigs_kmer_table.extend(batch['contigs_kmer_table'])
+            splits_kmer_table.extend(batch['splits_kmer_table'])
+            contig_sequences_table.extend(batch['contig_sequences_table'])
+            recovered_split_lengths.extend(batch['recovered_split_lengths'])
+
+            for contig_name, nt_position_info_list in batch['nt_position_info']:
                 nt_positions_auxiliary.append(contig_name, nt_position_info_list)
 
-            contig_kmer_freq = contigs_kmer_table.get_kmer_freq(contig_sequence)
-
-            self.progress.append('k-mers ...')
-            for order in range(0, len(split_start_stops)):
-                start, end = split_start_stops[order]
-                split_name = contigops.gen_split_name(contig_name, order)
-
-                # this is very confusing, because both contigs_kmer_table and splits_kmer_able in fact
-                # holds kmer values for splits only. in one table, each split has a kmer value of their
-                # contigs (to not lose the genomic context while clustering based on kmers), in the other
-                # one each split holds its own kmer value.
-                contigs_kmer_table.append(split_name, contig_sequence[start:end], kmer_freq = contig_kmer_freq)
-                splits_kmer_table.append(split_name, contig_sequence[start:end])
-
-                splits_info_table.append(split_name, contig_sequence[start:end], order, start, end, contig_gc_content, contig_name)
-
-            db_entries_contig_sequences.append((contig_name, contig_sequence), )
         nt_positions_auxiliary.close()
-        self.progress.end()
+        fasta.close()
 
         self.db.set_meta_value('kmer_size', kmer_size)
         contigs_kmer_table.store(self.db)
         splits_kmer_table.store(self.db)
         contigs_info_table.store(self.db)
         splits_info_table.store(self.db)
-
-        self.db._exec_many('''INSERT INTO %s VALUES (?,?)''' % t.contig_sequences_table_name, db_entries_contig_sequences)
+        contig_sequences_table.store(self.db)
 
         # set some useful meta values:
         self.db.set_meta_value('num_contigs', contigs_info_table.total_contigs)
@@ -1019,6 +1076,195 @@ class ContigsDatabase:
                                                                             else "(Anvi'o did not create any splits)", quiet = self.quiet)
 
 
+    def gen_contigs_batches(self, fasta):
+        """Reads the FASTA file and yields contigs in batches of (index, [(contig_name, contig_sequence), ...]).
+
+           Batches are closed either after `self.max_contigs_per_batch` contigs, or once they accumulate
+           `self.max_nts_per_batch` nucleotides, so a single batch full of huge contigs does not keep one
+           worker busy while the others are idle."""
+
+        batch_index = 0
+        batch, num_nts_in_batch = [], 0
+
+        while fasta.next():
+            batch.append((fasta.id, fasta.seq), )
+            num_nts_in_batch += len(fasta.seq)
+
+            if len(batch) >= self.max_contigs_per_batch or num_nts_in_batch >= self.max_nts_per_batch:
+                yield (batch_index, batch)
+                batch_index += 1
+                batch, num_nts_in_batch = [], 0
+
+        if batch:
+            yield (batch_index, batch)
+
+
+    def process_contigs_batches_serially(self, fasta):
+        self.progress.new('South Loop')
+
+        num_contigs_processed = 0
+        for batch_index, batch in self.gen_contigs_batches(fasta):
+            self.progress.update('Processing contigs %d to %d ...' % (num_contigs_processed + 1, num_contigs_processed + len(batch)))
+            yield self.process_contigs_batch(batch)
+            num_contigs_processed += len(batch)
+
+        self.progress.end()
+
+
+    def process_contigs_batches_in_parallel(self, fasta, num_threads):
+        """Sends batches of contigs to `num_threads` worker processes, and yields their results in
+           the order batches were read from the FASTA file.
+
+           The input queue is bounded, so the FASTA file is read only as fast as the workers can keep
+           up with it. Batches that come back early are kept aside until all batches before them
+           are handed over to the writer."""
+
+        input_queue = multiprocessing.Queue(maxsize = num_threads * 2)
+        output_queue = multiprocessing.Queue()
+
+        workers = []
+        for i in range(0, num_threads):
+            worker = multiprocessing.Process(target = self.process_contigs_batches_worker, args = (input_queue, output_queue))
+            workers.append(worker)
+            worker.start()
+
+        self.progress.new('South Loop using %d threads' % num_threads)
+        self.progress.update('...')
+
+        pending_batches = {}
+        next_batch_index = 0
+        num_batches_sent = 0
+
+        batches = self.gen_contigs_batches(fasta)
+        all_batches_sent = False
+        num_poison_pills_sent = 0
+        while num_poison_pills_sent < num_threads or next_batch_index < num_batches_sent:
+            # keep the workers busy, but do not block on a full input queue while their
+            # results are waiting to be collected (or while they are dead):
+            while num_poison_pills_sent < num_threads and not input_queue.full():
+                if all_batches_sent:
+                    # one poison pill for each worker:
+                    input_queue.put(None)
+                    num_poison_pills_sent += 1
+                    continue
+
+                try:
+                    input_queue.put(batches.next())
+                    num_batches_sent += 1
+                except StopIteration:
+                    all_batches_sent = True
+
+            try:
+                batch_index, batch_data, error = output_queue.get(timeout = 0.1)
+            except Queue.Empty:
+                dead_workers = utils.get_worker_processes_that_died(workers)
+                if dead_workers:
+                    for worker in workers:
+                        worker.terminate()
+                    self.progress.end()
+                    raise ConfigError, "One of the worker processes died unexpectedly (with exit code %d) while\
+                                        processing contigs. This usually happens when the operating system kills\
+                                        a process that uses too much memory. You may want to try again with fewer\
+                                        threads :/" % dead_workers[0].exitcode
+                continue
+
+            if error:
+                for worker in workers:
+                    worker.terminate()
+                self.progress.end()
+                raise ConfigError, "Something went wrong while processing contigs in one of the worker processes :/\
+                                    Here is the error message: '%s'." % error
+
+            pending_batches[batch_index] = batch_data
+
+            while next_batch_index in pending_batches:
+                yield pending_batches.pop(next_batch_index)
+                next_batch_index += 1
+
+                self.progress.update('%d of %d batches of contigs are processed ...' % (next_batch_index, num_batches_sent))
+
+        for worker in workers:
+            worker.join()
+
+        self.progress.end()
+
+
+    def process_contigs_batches_worker(self, input_queue, output_queue):
+        while True:
+            item = input_queue.get()
+
+            if item is None:
+                break
+
+            batch_index, batch = item
+
+            try:
+                batch_data = self.process_contigs_batch(batch)
+            except Exception as e:
+                output_queue.put((batch_index, None, str(e)))
+                break
+
+            output_queue.put((batch_index, batch_data, None))
+
+
+    def process_contigs_batch(self, batch):
+        """Computes everything the contigs database needs to know about a batch of contigs: contig and
+           split info table entries, compressed sequence blocks, k-mer frequencies for contigs and splits,
+           and nucleotide position info for contigs with genes. Nothing is written to the database here, so this can run in any
+           process."""
+
+        contigs_kmer_table = KMerTablesForContigsAndSplits('kmer_contigs', k=self.kmer_size)
+        splits_kmer_table = KMerTablesForContigsAndSplits('kmer_splits', k=self.kmer_size)
+        contigs_info_table = InfoTableForContigs(self.split_length)
+        splits_info_table = InfoTableForSplits()
+        contig_sequences_table = SequencesTableForContigs()
+
+        recovered_split_lengths = []
+        nt_position_info = []
+
+        for contig_name, contig_sequence in batch:
+            contig_sequences_table.append(contig_name, contig_sequence)
+
+            genes_in_contig = self.contig_name_to_gene_start_stops[contig_name] if contig_name in self.contig_name_to_gene_start_stops else set([])
+
+            if self.skip_mindful_splitting:
+                contig_length, split_start_stops, contig_gc_content = contigs_info_table.append(contig_name, contig_sequence, set([]))
+            else:
+                contig_length, split_start_stops, contig_gc_content = contigs_info_table.append(contig_name, contig_sequence, genes_in_contig)
+
+            # let's keep an eye on the returned split lengths
+            if len(split_start_stops) > 1:
+                recovered_split_lengths.extend([s[1] - s[0] for s in split_start_stops])
+
+            if genes_in_contig:
+                nt_position_info_list = self.compress_nt_position_info(contig_length, genes_in_contig, self.genes_in_contigs_dict)
+                nt_position_info.append((contig_name, nt_position_info_list), )
+
+            contig_kmer_freq, split_kmer_freqs = contigs_kmer_table.get_kmer_freqs_for_contig_and_splits(contig_sequence, split_start_stops)
+
+            for order in range(0, len(split_start_stops)):
+                start, end = split_start_stops[order]
+                split_name = contigops.gen_split_name(contig_name, order)
+
+                # this is very confusing, because both contigs_kmer_table and splits_kmer_able in fact
+                # holds kmer values for splits only. in one table, each split has a kmer value of their
+                # contigs (to not lose the genomic context while clustering based on kmers), in the other
+                # one each split holds its own kmer value.
+                contigs_kmer_table.append(split_name, contig_sequence[start:end], kmer_freq = contig_kmer_freq)
+                splits_kmer_table.append(split_name, contig_sequence[start:end], kmer_freq = split_kmer_freqs[order])
+
+                splits_info_table.append(split_name, contig_sequence[start:end], order, start, end, contig_gc_content, contig_name)
+
+        # only the table rows travel back, not the k-mers class instances:
+        return {'contigs_info_table': contigs_info_table.db_entries,
+                'splits_info_table': splits_info_table.db_entries,
+                'contigs_kmer_table': contigs_kmer_table.db_entries,
+                'splits_kmer_table': splits_kmer_table.db_entries,
+                'contig_sequences_table': contig_sequences_table.db_entries,
+                'recovered_split_lengths': recovered_split_lengths,
+                'nt_position_info': nt_position_info}
+
+
     def compress_nt_position_info(self, contig_length, genes_in_contig, genes_in_contigs_dict):
         """This function compresses information regarding each nucleotide position in a given contig
            into a small int. Every nucleotide position is represented by four bits depending on whether
@@ -1041,8 +1287,8 @@ class ContigsDatabase:
            1: int('0001', 2); nt position is in a complete gene call, and is at the 3rd position in the codon
         """
 
-        # first we create a list of zeros for each position of the contig
-        nt_position_info_list = [0] * contig_length
+        # first we create an array of zeros for each position of the contig
+        nt_position_info_list = numpy.zeros(contig_length, dtype = numpy.uint8)
 
         for gene_unique_id, start, stop in genes_in_contig:
             gene_call = genes_in_contigs_dict[gene_unique_id]
@@ -1052,20 +1298,20 @@ class ContigsDatabase:
             # non-synonmous bases in that. the clients who wish to use these variables must also
             # be careful about the difference
             if gene_call['partial']:
-                for nt_position in range(start, stop):
-                    nt_position_info_list[nt_position] = 8
+                nt_position_info_list[start:stop] = 8
                 continue
 
-            if gene_call['direction'] == 'f':
-                for nt_position in range(start, stop, 3):
-                    nt_position_info_list[nt_position] = 4
-                    nt_position_info_list[nt_position + 1] = 2
-                    nt_position_info_list[nt_position + 2] = 1
-            elif gene_call['direction'] == 'r':
-                for nt_position in range(stop - 1, start - 1, -3):
-                    nt_position_info_list[nt_position] = 4
-                    nt_position_info_list[nt_position - 1] = 2
-                    nt_position_info_list[nt_position - 2] = 1
+            # codons of genes on the forward strand are counted from the start of the gene, and the ones
+            # on the reverse strand from the end of it. every third position starting from there is the
+            # same codon position (for genes with a length that is not a multiple of three, the last
+            # codon extends beyond the gene, just like it always did):
+            for offset, value in [(0, 4), (1, 2), (2, 1)]:
+                if gene_call['direction'] == 'f':
+                    nt_position_info_list[start + offset:stop + offset:3] = value
+                elif gene_call['direction'] == 'r':
+                    first, last = stop - 1 - offset, start - 1 - offset
+                    if first >= 0:
+                        nt_position_info_list[first:last if last >= 0 else None:-3] = value
 
         return nt_position_info_list
 
@@ -1200,6 +1446,143 @@ class SamplesInformationDatabase:
 ####################################################################################################
 
 
+class SequencesTableForContigs:
+    def __init__(self, block_size = t.contig_sequences_block_size):
+        self.db_entries = []
+        self.block_size = block_size
+
+
+    def append(self, seq_id, sequence):
+        for block, start in enumerate(range(0, len(sequence), self.block_size)):
+            self.db_entries.append((seq_id, block, zlib.compress(sequence[start:start + self.block_size])), )
+
+
+    def extend(self, db_entries):
+        self.db_entries.extend(db_entries)
+
+
+    def store(self, db):
+        db.create_table(t.contig_sequences_table_name, t.contig_sequences_table_structure, t.contig_sequences_table_types)
+        db._exec('''CREATE INDEX %s_index ON %s (contig, block)''' % (t.contig_sequences_table_name, t.contig_sequences_table_name))
+        if len(self.db_entries):
+            # compressed blocks are kept as strings until here, so they can travel between processes, but
+            # they must go into the database as blobs:
+            db._exec_many('''INSERT INTO %s VALUES (?,?,?)''' % t.contig_sequences_table_name,
+                          [(seq_id, block, buffer(sequence)) for seq_id, block, sequence in self.db_entries])
+
+
+class ContigSequences:
+    """Random access to contig sequences stored in a contigs database.
+
+           >>> c = ContigSequences('CONTIGS.db')
+           >>> c.get_subsequence('contig_1', 1000, 1100)
+
+       Only the blocks a request touches are read from the database and decompressed. Recently used
+       blocks are kept in memory, so reading neighbouring positions one by one does not go to the
+       database every time."""
+
+    def __init__(self, contigs_db_path, block_size = t.contig_sequences_block_size):
+        self.db = db.DB(contigs_db_path, anvio.__contigs__version__)
+        self.block_size = block_size
+
+        self.blocks_cache = OrderedDict()
+        self.blocks_cache_size = 1000
+
+
+    def get_blocks(self, contig_name, first_block, last_block):
+        blocks = {}
+        missing_blocks = []
+
+        for block in range(first_block, last_block + 1):
+            if (contig_name, block) in self.blocks_cache:
+                blocks[block] = self.blocks_cache.pop((contig_name, block))
+                self.blocks_cache[(contig_name, block)] = blocks[block]
+            else:
+                missing_blocks.append(block)
+
+        if missing_blocks:
+            response = self.db._exec('''SELECT block, sequence FROM %s WHERE contig = ? AND block >= ? AND block <= ?''' \
+                                            % t.contig_sequences_table_name, (contig_name, missing_blocks[0], missing_blocks[-1]))
+
+            missing_blocks = set(missing_blocks)
+            for block, compressed_sequence in response.fetchall():
+                if block not in missing_blocks:
+                    continue
+
+                blocks[block] = zlib.decompress(compressed_sequence)
+
+                if len(self.blocks_cache) >= self.blocks_cache_size:
+                    self.blocks_cache.popitem(last = False)
+
+                self.blocks_cache[(contig_name, block)] = blocks[block]
+
+        return blocks
+
+
+    def get_subsequence(self, contig_name, start, stop):
+        """Returns contig_sequence[start:stop] (for 0 <= start and 0 <= stop)"""
+
+        if stop <= start:
+            return ''
+
+        first_block, last_block = start / self.block_size, (stop - 1) / self.block_size
+        blocks = self.get_blocks(contig_name, first_block, last_block)
+
+        if first_block not in blocks:
+            if self.db._exec('''SELECT block FROM %s WHERE contig = ? LIMIT 1''' % t.contig_sequences_table_name, (contig_name, )).fetchall():
+                # the contig is there, it is just not as long as `start`:
+                return ''
+
+            raise ConfigError, "ContigSequences: '%s' is not a contig anvi'o knows about :/" % contig_name
+
+        offset = first_block * self.block_size
+        sequence = ''.join([blocks[block] for block in sorted(blocks)])
+
+        return sequence[start - offset:stop - offset]
+
+
+    def get_sequence(self, contig_name):
+        response = self.db._exec('''SELECT sequence FROM %s WHERE contig = ? ORDER BY block''' % t.contig_sequences_table_name, (contig_name, ))
+
+        rows = response.fetchall()
+        if not rows:
+            raise ConfigError, "ContigSequences: '%s' is not a contig anvi'o knows about :/" % contig_name
+
+        return ''.join([zlib.decompress(row[0]) for row in rows])
+
+
+    def get_sequences(self, contig_names = None):
+        """Returns full sequences in a dict that looks like the rows of a table, {contig_name: {'sequence': ...}},
+           either for every contig in the database, or only for `contig_names`."""
+
+        if contig_names is None:
+            rows = self.db._exec('''SELECT contig, block, sequence FROM %s ORDER BY contig, block''' % t.contig_sequences_table_name)
+        else:
+            contig_names = set(contig_names)
+            if not contig_names:
+                return {}
+
+            # blocks of all contigs of interest come in a single query:
+            rows = sorted(self.db.get_rows_from_table(t.contig_sequences_table_name, columns = ['contig', 'block', 'sequence'],
+                                                      keys_of_interest = contig_names), key = lambda row: (row[0], row[1]))
+
+        blocks = {}
+        for contig_name, block, compressed_sequence in rows:
+            if contig_name not in blocks:
+                blocks[contig_name] = []
+
+            blocks[contig_name].append(zlib.decompress(compressed_sequence))
+
+        if contig_names is not None and len(blocks) != len(contig_names):
+            raise ConfigError, "ContigSequences: '%s' is not a contig anvi'o knows about :/" % list(contig_names - set(blocks))[0]
+
+        return dict([(contig_name, {'sequence': ''.join(blocks.pop(contig_name))}) for contig_name in blocks.keys()])
+
+
+    def close(self):
+        self.db.disconnect()
+
+
 class InfoTableForContigs:
     def __init__(self, split_length):
         self.db_entries = []
@@ -1223,6 +1606,12 @@ class InfoTableForContigs:
         return (sequence_length, split_start_stops, gc_content)
 
 
+    def extend(self, db_entries):
+        self.total_nts += sum([e[1] for e in db_entries])
+        self.total_contigs += len(db_entries)
+        self.db_entries.extend(db_entries)
+
+
     def store(self, db):
         db.create_table(t.contigs_info_table_name, t.contigs_info_table_structure, t.contigs_info_table_types)
         if len(self.db_entries):
@@ -1242,6 +1631,11 @@ class InfoTableForSplits:
         self.db_entries.append(db_entry)
 
 
+    def extend(self, db_entries):
+        self.total_splits += len(db_entries)
+        self.db_entries.extend(db_entries)
+
+
     def store(self, db):
         db.create_table(t.splits_info_table_name, t.splits_info_table_structure, t.splits_info_table_types)
         if len(self.db_entries):
@@ -1265,6 +1659,10 @@ class KMerTablesForContigsAndSplits:
         return self.kmers_class.get_kmer_frequency(sequence)
 
 
+    def get_kmer_freqs_for_contig_and_splits(self, sequence, split_start_stops):
+        return self.kmers_class.get_kmer_frequencies_for_contig_and_splits(sequence, split_start_stops)
+
+
     def append(self, seq_id, sequence, kmer_freq = None):
         if not kmer_freq:
             kmer_freq = self.kmers_class.get_kmer_frequency(sequence)
@@ -1273,6 +1671,10 @@ class KMerTablesForContigsAndSplits:
         self.db_entries.append(db_entry)
 
 
+    def extend(self, db_entries):
+        self.db_entries.extend(db_entries)
+
+
     def store(self, db):
         db.create_table(self.table_name, self.kmers_table_structure, self.kmers_table_types)
         db._exec_many('''INSERT INTO %s VALUES (%s)''' % (self.table_name, (','.join(['?'] * len(self.kmers_table_structure)))), self.db_entries)
@@ -1321,10 +1723,14 @@ class TableForVariability(Table):
 
 
     def store(self):
+        """Sends entries to the database. It can be called as many times as needed, entries that are
+           stored are forgotten."""
         profile_db = ProfileDatabase(self.db_path)
         profile_db.db._exec_many('''INSERT INTO %s VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''' % t.variable_nts_table_name, self.db_entries)
         profile_db.disconnect()
 
+        self.db_entries = []
+
 
 class TableForGeneCoverages(Table):
     '''The purpose of this class is to keep coverage values for each gene in contigs for found in a sample.
@@ -1338,23 +1744,17 @@ class TableForGeneCoverages(Table):
         self.genes = []
         self.set_next_available_id(t.gene_coverages_table_name)
 
-        # we keep coverage values in contig.py/Contig instances only for splits, during the profiling,
-        # coverage for contigs are temporarily calculated, and then discarded. probably that behavior
-        # should change for good. but for now I will generate a dict to keep contig coverages to avoid
-        # even more redundant computations:
-        self.contig_coverages = {}
 
+    def analyze_contig(self, contig, sample_id, start_stop_pos_list, normalization_multiplier = 1.0):
+        # we keep coverage values in contig.py/Contig instances only for splits, so coverage values for the
+        # contig are put together here, once for all of its genes, and discarded once they are analyzed:
+        coverage_index = CoverageIndex(numpy.concatenate([split.coverage.c for split in contig.splits]))
 
-    def analyze_contig(self, contig, sample_id, start_stop_pos_list):
-        if contig.name not in self.contig_coverages:
-            contig_coverage = []
-            for split in contig.splits:
-                contig_coverage.extend(split.coverage.c)
-            self.contig_coverages[contig.name] = contig_coverage
+        gene_callers_ids, starts, stops = zip(*start_stop_pos_list) if start_stop_pos_list else ([], [], [])
+        gene_coverages = coverage_index.mean(starts, stops).tolist()
 
-        for gene_callers_id, start, stop in start_stop_pos_list:
-            gene_coverage = numpy.mean(self.contig_coverages[contig.name][start:stop])
-            self.add_gene_entry(gene_callers_id, sample_id, gene_coverage)
+        for i in range(0, len(gene_callers_ids)):
+            self.add_gene_entry(gene_callers_ids[i], sample_id, gene_coverages[i] * normalization_multiplier)
 
 
     def add_gene_entry(self, gene_callers_id, sample_id, coverage):
@@ -1362,17 +1762,22 @@ class TableForGeneCoverages(Table):
 
 
     def store(self):
+        """Sends gene coverages to the database. It can be called as many times as needed, genes that are
+           stored are forgotten."""
         profile_db = ProfileDatabase(self.db_path)
         db_entries = [tuple([self.next_id(t.gene_coverages_table_name)] + [gene[h] for h in t.gene_coverages_table_structure[1:]]) for gene in self.genes]
         profile_db.db._exec_many('''INSERT INTO %s VALUES (?,?,?,?)''' % t.gene_coverages_table_name, db_entries)
         profile_db.disconnect()
 
+        self.genes = []
+
 
 class TablesForGeneCalls(Table):
-    def __init__(self, db_path, contigs_fasta = None, run=run, progress=progress, debug = False):
+    def __init__(self, db_path, contigs_fasta = None, run=run, progress=progress, debug = False, num_threads = 1):
         self.db_path = db_path
         self.contigs_fasta = contigs_fasta
         self.debug = debug
+        self.num_threads = num_threads
 
         self.gene_calls_dict_id_to_db_unique_id = {}
 
@@ -1414,7 +1819,7 @@ class TablesForGeneCalls(Table):
             self.run.info_single('--debug flag is [ON], which means temporary directories generated by\
                                  this run will not be removed', nl_after = 2)
 
-        gene_caller = genecalling.GeneCaller(self.contigs_fasta, gene_caller = gene_caller, debug = self.debug)
+        gene_caller = genecalling.GeneCaller(self.contigs_fasta, gene_caller = gene_caller, debug = self.debug, num_threads = self.num_threads)
 
         gene_calls_dict, protein_sequences = gene_caller.process()
 
@@ -1428,13 +1833,12 @@ class TablesForGeneCalls(Table):
         contigs_db = db.DB(self.db_path, anvio.__contigs__version__)
 
         self.progress.new('Entering gene calls into the database')
-        counter = 0
-        for entry_id in gene_calls_dict:
-            if counter % 10 == 0:
-                self.progress.update('%d ...' % (counter))
-            contigs_db._exec('''INSERT INTO %s VALUES (?,?,?,?,?,?,?,?)''' % t.genes_in_contigs_table_name, tuple([self.gene_calls_dict_id_to_db_unique_id[entry_id]] + [gene_calls_dict[entry_id][h] for h in t.genes_in_contigs_table_structure[1:]]))
-            contigs_db._exec('''INSERT INTO %s VALUES (?,?)''' % t.gene_protein_sequences_table_name, tuple([self.gene_calls_dict_id_to_db_unique_id[entry_id]] + [protein_sequences[entry_id]]))
-            counter += 1
+        self.progress.update('%d gene calls ...' % len(gene_calls_dict))
+        with contigs_db.transaction():
+            contigs_db._exec_many('''INSERT INTO %s VALUES (?,?,?,?,?,?,?,?)''' % t.genes_in_contigs_table_name,
+                                  (tuple([self.gene_calls_dict_id_to_db_unique_id[entry_id]] + [gene_calls_dict[entry_id][h] for h in t.genes_in_contigs_table_structure[1:]]) for entry_id in gene_calls_dict))
+            contigs_db._exec_many('''INSERT INTO %s VALUES (?,?)''' % t.gene_protein_sequences_table_name,
+                                  ((self.gene_calls_dict_id_to_db_unique_id[entry_id], protein_sequences[entry_id]) for entry_id in gene_calls_dict))
         self.progress.end()
 
         contigs_db.disconnect()
@@ -1514,8 +1918,11 @@ class TablesForGeneCalls(Table):
 
 
 class TablesForHMMHits(Table):
-    def __init__(self, db_path, run=run, progress=progress):
+    def __init__(self, db_path, run=run, progress=progress, num_threads = 1, hmm_cache_dir = None, use_hmm_cache = True):
         self.db_path = db_path
+        self.num_threads = num_threads
+        self.hmm_cache_dir = hmm_cache_dir
+        self.use_hmm_cache = use_hmm_cache
 
         self.debug = False
 
@@ -1551,17 +1958,17 @@ class TablesForHMMHits(Table):
             protein_sequences_fasta = self.export_sequences_table_in_db_into_FASTA_file(t.gene_protein_sequences_table_name)
             remove_fasta_file_upon_finish = True
 
-        commander = HMMSearch(protein_sequences_fasta)
+        hmm_cache = PressedHMMCache(self.hmm_cache_dir) if self.use_hmm_cache else None
+        commander = HMMSearch(protein_sequences_fasta, num_threads = self.num_threads, hmm_cache = hmm_cache)
+
+        # searches for all sources run at once, so they can share the threads:
+        hmm_scan_hits = commander.run_hmmscan_for_sources(sources)
 
         for source in sources:
             kind_of_search = sources[source]['kind']
             all_genes_searched_against = sources[source]['genes']
-            hmm_model = sources[source]['model']
             reference = sources[source]['ref']
-            hmm_scan_hits_txt = commander.run_hmmscan(source,
-                                                      all_genes_searched_against,
-                                                      hmm_model,
-                                                      reference)
+            hmm_scan_hits_txt = hmm_scan_hits[source]
 
             if not hmm_scan_hits_txt:
                 search_results_dict = {}
@@ -5,6 +5,7 @@
 
 import os
 import shutil
+import multiprocessing
 
 import anvio.utils as utils
 import anvio.terminal as terminal
@@ -18,10 +19,12 @@ progress = terminal.Progress()
 
 
 class Prodigal:
-    def __init__(self, progress = progress, run = run):
+    def __init__(self, progress = progress, run = run, num_threads = 1):
         self.progress = progress
         self.run = run
 
+        self.num_threads = num_threads
+
         self.parser = None
         self.installed_prodigal_version = None
         self.ok_prodigal_versions = {'v2.6.2': self.__parser_1,
@@ -99,47 +102,161 @@ class Prodigal:
         log_file_path = os.path.join(output_dir, '00_log.txt')
 
         self.run.warning('', header = 'Finding ORFs in contigs', lc = 'green')
-        self.run.info('Genes', self.genes_in_contigs)
-        self.run.info('Proteins', self.proteins_in_contigs)
+        if self.num_threads == 1:
+            self.run.info('Genes', self.genes_in_contigs)
+            self.run.info('Proteins', self.proteins_in_contigs)
+        else:
+            self.run.info('Genes and proteins', os.path.join(output_dir, 'chunk_*'))
+            self.run.info('Number of threads', self.num_threads)
         self.run.info('Log file', log_file_path)
 
         self.progress.new('Processing')
-        self.progress.update('Identifying ORFs in contigs ...')
+        if self.num_threads == 1:
+            self.progress.update('Identifying ORFs in contigs ...')
+            self.run_prodigal(fasta_file_path, self.genes_in_contigs, self.proteins_in_contigs, log_file_path)
+            self.check_prodigal_output(self.proteins_in_contigs, log_file_path)
+
+            self.progress.update('Processing gene calls ...')
+            gene_calls = self.get_gene_calls(self.proteins_in_contigs)
+        else:
+            gene_calls = self.process_in_chunks(fasta_file_path, output_dir, log_file_path)
+
+        hit_id = 0
+        for gene_call, protein_sequence in gene_calls:
+            gene_calls_dict[hit_id] = gene_call
+            protein_sequences_dict[hit_id] = protein_sequence
+            hit_id += 1
+
+        self.progress.end()
+
+        self.run.info('Result', 'Prodigal (%s) has identified %d genes.' % (self.installed_prodigal_version, len(gene_calls_dict)), nl_after = 1)
+
+        return gene_calls_dict, protein_sequences_dict
+
+
+    def run_prodigal(self, fasta_file_path, genes_file_path, proteins_file_path, log_file_path):
         cmd_line = ('prodigal -i "%s" -o "%s" -a "%s" -p meta >> "%s" 2>&1' % (fasta_file_path,
-                                                                               self.genes_in_contigs,
-                                                                               self.proteins_in_contigs,
+                                                                               genes_file_path,
+                                                                               proteins_file_path,
                                                                                log_file_path))
         with open(log_file_path, "a") as myfile: myfile.write('CMD: ' + cmd_line + '\n')
         utils.run_command(cmd_line)
 
-        if not os.path.exists(self.proteins_in_contigs):
+
+    def check_prodigal_output(self, proteins_file_path, log_file_path):
+        if not os.path.exists(proteins_file_path):
             self.progress.end()
             raise ConfigError, "Something went wrong with prodigal, and it failed to generate the\
                                 expected output :/ Fortunately, this log file should tell you what\
                                 might be the problem: '%s'. Please do not forget to include this\
                                 file if you were to ask for help." % log_file_path
 
-        self.progress.update('Processing gene calls ...')
 
-        fasta = fastalib.SequenceSource(self.proteins_in_contigs)
+    def get_gene_calls(self, proteins_file_path):
+        """Returns a list of (gene_call, protein_sequence) tuples in the order prodigal reported them"""
 
-        hit_id = 0
+        gene_calls = []
+
+        # prodigal leaves an empty file behind if it finds no genes (which is not that unusual for a
+        # chunk of short contigs):
+        if not os.path.getsize(proteins_file_path):
+            return gene_calls
+
+        fasta = fastalib.SequenceSource(proteins_file_path)
         while fasta.next():
-            gene_calls_dict[hit_id] = self.parser(fasta.id)
-            protein_sequences_dict[hit_id] = fasta.seq.replace('*', '')
-            hit_id += 1
+            gene_calls.append((self.parser(fasta.id), fasta.seq.replace('*', '')), )
+        fasta.close()
+
+        return gene_calls
+
+
+    def split_fasta_into_chunks(self, fasta_file_path, output_dir):
+        """Distributes contigs into `self.num_threads` FASTA files of similar total lengths.
+
+           Contigs are dealt from the longest to the shortest, each to the chunk with the fewest
+           nucleotides so far. Returns contig names in the order they appear in the input file, and
+           the paths for chunk files."""
 
+        contig_names, contig_lengths = [], []
+
+        fasta = fastalib.SequenceSource(fasta_file_path)
+        while fasta.next():
+            contig_names.append(fasta.id)
+            contig_lengths.append(len(fasta.seq))
         fasta.close()
 
-        self.progress.end()
+        num_chunks = max(min(self.num_threads, len(contig_names)), 1)
 
-        self.run.info('Result', 'Prodigal (%s) has identified %d genes.' % (self.installed_prodigal_version, len(gene_calls_dict)), nl_after = 1)
+        chunk_lengths = [0] * num_chunks
+        contig_name_to_chunk = {}
+        for i in sorted(range(0, len(contig_names)), key = lambda i: contig_lengths[i], reverse = True):
+            chunk = chunk_lengths.index(min(chunk_lengths))
+            contig_name_to_chunk[contig_names[i]] = chunk
+            chunk_lengths[chunk] += contig_lengths[i]
 
-        return gene_calls_dict, protein_sequences_dict
+        chunk_paths = [os.path.join(output_dir, 'chunk_%d' % chunk) for chunk in range(0, num_chunks)]
+        chunk_outputs = [fastalib.FastaOutput(chunk_path + '.fa') for chunk_path in chunk_paths]
+
+        fasta = fastalib.SequenceSource(fasta_file_path)
+        while fasta.next():
+            chunk_output = chunk_outputs[contig_name_to_chunk[fasta.id]]
+            chunk_output.write_id(fasta.id)
+            chunk_output.write_seq(fasta.seq, split = False)
+        fasta.close()
+
+        for chunk_output in chunk_outputs:
+            chunk_output.close()
+
+        return contig_names, chunk_paths
+
+
+    def process_in_chunks(self, fasta_file_path, output_dir, log_file_path):
+        """Runs one prodigal process for each chunk of contigs at the same time, and merges their output.
+
+           Prodigal in meta mode calls genes in every contig independently, so gene calls do not depend
+           on how contigs are distributed to chunks. Putting gene calls back in the order of contigs in the
+           input file gives the very same list of gene calls (and gene caller ids) a single run would."""
+
+        self.progress.update('Splitting contigs into %d chunks ...' % self.num_threads)
+        contig_names, chunk_paths = self.split_fasta_into_chunks(fasta_file_path, output_dir)
+
+        self.progress.update('Identifying ORFs in contigs using %d threads ...' % len(chunk_paths))
+        workers = []
+        for chunk_path in chunk_paths:
+            worker = multiprocessing.Process(target = self.run_prodigal, args = (chunk_path + '.fa', chunk_path + '.genes', chunk_path + '.proteins', chunk_path + '.log'))
+            workers.append(worker)
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        # keep every command and output in the main log file, too:
+        with open(log_file_path, 'a') as log_file:
+            for chunk_path in chunk_paths:
+                log_file.write(open(chunk_path + '.log').read())
+
+        for chunk_path in chunk_paths:
+            self.check_prodigal_output(chunk_path + '.proteins', chunk_path + '.log')
+
+        self.progress.update('Processing gene calls ...')
+        gene_calls_in_contigs = {}
+        for chunk_path in chunk_paths:
+            for gene_call, protein_sequence in self.get_gene_calls(chunk_path + '.proteins'):
+                if gene_call['contig'] not in gene_calls_in_contigs:
+                    gene_calls_in_contigs[gene_call['contig']] = []
+
+                gene_calls_in_contigs[gene_call['contig']].append((gene_call, protein_sequence), )
+
+        gene_calls = []
+        for contig_name in contig_names:
+            if contig_name in gene_calls_in_contigs:
+                gene_calls.extend(gene_calls_in_contigs[contig_name])
+
+        return gene_calls
 
 
 class GeneCaller:
-    def __init__(self, fasta_file_path, gene_caller = 'prodigal', progress = progress, run = run, debug = False):
+    def __init__(self, fasta_file_path, gene_caller = 'prodigal', progress = progress, run = run, debug = False, num_threads = 1):
         filesnpaths.is_file_exists(fasta_file_path)
         filesnpaths.is_file_fasta_formatted(fasta_file_path)
 
@@ -149,6 +266,7 @@ class GeneCaller:
         self.progress = progress
 
         self.debug = debug
+        self.num_threads = num_threads
         self.tmp_dirs = []
 
         self.gene_callers = {'prodigal': Prodigal}
@@ -163,7 +281,7 @@ class GeneCaller:
     def process(self):
         output_dir = filesnpaths.get_temp_directory_path()
         self.tmp_dirs.append(output_dir)
-        gene_caller = self.gene_callers[self.gene_caller]()
+        gene_caller = self.gene_callers[self.gene_caller](num_threads = self.num_threads)
 
         gene_calls_dict, protein_sequences_dict = gene_caller.process(self.fasta_file_path, output_dir)
 
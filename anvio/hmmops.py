@@ -5,17 +5,27 @@
     * HMMSearch takes care of searches using HMM profiles. It simply takes genes.txt and
     genes.hmm.gz files as input and returns a dictionary back with results. See anvio/data/hmm
     directory for examples.
+
+    * PressedHMMCache keeps unpacked and pressed models on disk, so HMMSearch does not have to
+    press the same model again in every run.
 """
 
 import os
 import gzip
+import fcntl
+import Queue
+import json
 import shutil
+import hashlib
+import tempfile
 import textwrap
+import multiprocessing
 
 import anvio
 import anvio.db as db
 import anvio.tables as t
 import anvio.utils as utils
+import anvio.fastalib as fastalib
 import anvio.terminal as terminal
 import anvio.filesnpaths as filesnpaths
 
@@ -25,24 +35,380 @@ run = terminal.Run()
 progress = terminal.Progress()
 
 
+def unpack_and_press_hmm_model(hmm, hmm_file_path, log_file_path, progress = progress):
+    """Unpacks the gzipped model `hmm` into `hmm_file_path`, and runs hmmpress on it"""
+
+    progress.new('Unpacking the model')
+    progress.update('...')
+    hmm_file = open(hmm_file_path, 'w')
+    hmm_file.write(gzip.open(hmm, 'rb').read())
+    hmm_file.close()
+    progress.end()
+
+    progress.new('Processing')
+    progress.update('Compressing the pfam model')
+    cmd_line = ('hmmpress "%s" >> "%s" 2>&1' % (hmm_file_path, log_file_path))
+    with open(log_file_path, "a") as myfile: myfile.write('CMD: ' + cmd_line + '\n')
+    ret_val = utils.run_command(cmd_line)
+    if ret_val:
+        progress.end()
+        raise ConfigError, "The last call did not work quite well. Most probably the version of HMMER\
+                            you have installed is not up-to-date enough. Just to make sure what went\
+                            wrong please take a look at the log file ('%s'). Please visit %s to see what\
+                            is the latest version availalbe. You can learn which version of HMMER you have\
+                            on your system by typing 'hmmpress -h'"\
+                                    % (log_file_path, 'http://hmmer.janelia.org/download.html')
+    progress.end()
+
+
+class PressedHMMCache:
+    """Keeps pressed HMM models around, so searches against the same model do not unpack and press it
+       again every time.
+
+       Entries are keyed by a hash of the gzipped model file and the HMMER version (pressed files of one
+       version of HMMER may mean nothing to another). Every entry is a directory with the unpacked model,
+       the files hmmpress generated for it, and a manifest of their sizes, modification times, and
+       checksums. Entries that do not match their manifest are removed and built again. Checksums are
+       computed only for files whose size or modification time is not the one in the manifest, unless
+       `verify_checksums` is True. When the cache grows larger than `self.max_cache_size`, least recently
+       used entries are evicted.
+
+       Many anvi'o processes may share the same cache. An entry in use is held with a shared lock on
+       the file `.lock` in its directory (until `release_entries` is called, or the process exits), and
+       entries are removed only by a process that can get an exclusive lock on them, so nobody removes
+       an entry while another process is searching against it."""
+
+    def __init__(self, cache_dir = None, verify_checksums = False, progress = progress, run = run):
+        self.progress = progress
+        self.run = run
+
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.anvio', 'hmm_cache')
+        self.verify_checksums = verify_checksums
+        self.max_cache_size = 10 * 1024 ** 3
+        self.hmmer_version = None
+
+        # locks for the entries this process is using:
+        self.entry_locks = []
+
+
+    def is_usable(self):
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+        except OSError:
+            return False
+
+        return os.access(self.cache_dir, os.W_OK)
+
+
+    def get_hmmer_version(self):
+        if not self.hmmer_version:
+            try:
+                output, ret_code = utils.get_command_output_from_shell('hmmpress -h')
+            except OSError:
+                raise ConfigError, "Anvi'o could not run 'hmmpress' to learn which version of HMMER you have. Please\
+                                    make sure HMMER is installed on your system, and programs that come with it\
+                                    are in your path."
+
+            version_lines = [l for l in output.split('\n') if l.find('HMMER') > -1]
+            self.hmmer_version = version_lines[0].strip('# ') if version_lines else 'unknown'
+
+        return self.hmmer_version
+
+
+    def get_key(self, hmm):
+        h = hashlib.sha1(self.get_hmmer_version())
+        with open(hmm, 'rb') as hmm_file:
+            for chunk in iter(lambda: hmm_file.read(2 ** 20), ''):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+
+    def get_file_checksum(self, file_path):
+        h = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), ''):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+
+    def get_manifest_entry(self, file_path):
+        return {'size': os.path.getsize(file_path), 'mtime': os.path.getmtime(file_path), 'sha1': self.get_file_checksum(file_path)}
+
+
+    def is_entry_valid(self, entry_dir):
+        """Compares files of an entry with its manifest. Reading every file of a large model for its checksum
+           takes as long as a search against a small one, so a file with the size and modification time in
+           the manifest is taken as it is (unless `self.verify_checksums` is True)."""
+        manifest_path = os.path.join(entry_dir, 'MANIFEST')
+
+        try:
+            manifest = json.load(open(manifest_path))
+        except (IOError, ValueError):
+            return False
+
+        for file_name in manifest:
+            file_path = os.path.join(entry_dir, file_name)
+
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != manifest[file_name]['size']:
+                return False
+
+            if not self.verify_checksums and os.path.getmtime(file_path) == manifest[file_name].get('mtime'):
+                continue
+
+            if self.get_file_checksum(file_path) != manifest[file_name]['sha1']:
+                return False
+
+        return True
+
+
+    def lock_entry(self, entry_dir, exclusive = False, blocking = True):
+        """Takes a lock on the cache entry, and returns the file descriptor that holds it (closing it
+           releases the lock). Returns None if the entry is gone, or if `blocking` is False and someone
+           else holds a lock that conflicts with the one requested."""
+
+        lock_path = os.path.join(entry_dir, '.lock')
+
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+        except OSError:
+            return None
+
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+
+            # the entry may have been removed (or removed and built again) while we were waiting for
+            # the lock, in which case the lock we hold is on a file that is no longer there:
+            if os.stat(lock_path).st_ino != os.fstat(fd).st_ino:
+                os.close(fd)
+                return None
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+
+        return fd
+
+
+    def release_entries(self):
+        """Releases the locks on entries this process has been using, after which they may be evicted"""
+
+        for fd in self.entry_locks:
+            os.close(fd)
+
+        self.entry_locks = []
+
+
+    def get_pressed_model(self, hmm, log_file_path):
+        """Returns the path for the unpacked and pressed model of the gzipped `hmm`, building the cache
+           entry first if there is not a valid one. The entry stays locked until `release_entries` is
+           called. Returns None if there is no entry that can be used safely, in which case the model
+           should be pressed somewhere else."""
+
+        entry_dir = os.path.join(self.cache_dir, self.get_key(hmm))
+        hmm_file_path = os.path.join(entry_dir, 'hmm.txt')
+
+        lock = self.lock_entry(entry_dir) if os.path.exists(entry_dir) else None
+        if lock is not None:
+            if self.is_entry_valid(entry_dir):
+                self.entry_locks.append(lock)
+
+                # mark it as recently used:
+                os.utime(entry_dir, None)
+                self.run.info('Pressed model', 'Found in the cache: %s' % entry_dir)
+                return hmm_file_path
+
+            os.close(lock)
+
+            lock = self.lock_entry(entry_dir, exclusive = True, blocking = False)
+            if lock is None:
+                self.run.warning("The cached model at '%s' does not match its manifest, but it is in use by\
+                                  another process, so anvi'o will not touch it, and will press the model in\
+                                  a temporary directory for this run." % entry_dir)
+                return None
+
+            self.run.warning("The cached model at '%s' does not match its manifest (which may happen if files\
+                              in the cache were changed). Anvi'o will remove it, and press the model\
+                              again." % entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            os.close(lock)
+
+        # the entry is built in a directory of its own, and moved into place only once it is complete,
+        # so no other process ever sees half of it:
+        tmp_entry_dir = tempfile.mkdtemp(dir = self.cache_dir, prefix = '.tmp_')
+        try:
+            tmp_hmm_file_path = os.path.join(tmp_entry_dir, 'hmm.txt')
+            unpack_and_press_hmm_model(hmm, tmp_hmm_file_path, log_file_path, self.progress)
+
+            manifest = {}
+            for file_name in os.listdir(tmp_entry_dir):
+                file_path = os.path.join(tmp_entry_dir, file_name)
+                manifest[file_name] = self.get_manifest_entry(file_path)
+            json.dump(manifest, open(os.path.join(tmp_entry_dir, 'MANIFEST'), 'w'), indent = 2)
+            open(os.path.join(tmp_entry_dir, '.lock'), 'w').close()
+
+            try:
+                os.rename(tmp_entry_dir, entry_dir)
+            except OSError:
+                # another process was faster:
+                shutil.rmtree(tmp_entry_dir, ignore_errors = True)
+        except:
+            shutil.rmtree(tmp_entry_dir, ignore_errors = True)
+            raise
+
+        lock = self.lock_entry(entry_dir)
+        if lock is None or not self.is_entry_valid(entry_dir):
+            if lock is not None:
+                os.close(lock)
+
+            self.run.warning("The model anvi'o just added to the cache at '%s' was changed or removed by another\
+                              process before it could be used, so anvi'o will press the model in a temporary\
+                              directory for this run." % entry_dir)
+            return None
+
+        self.entry_locks.append(lock)
+        os.utime(entry_dir, None)
+        self.run.info('Pressed model', 'Added to the cache: %s' % entry_dir)
+
+        self.evict()
+
+        return hmm_file_path
+
+
+    def evict(self):
+        """Removes least recently used entries until the cache is not larger than `self.max_cache_size`.
+           Entries that are in use (by this or any other process) are never removed."""
+
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            if entry_name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+
+            try:
+                entry_size = sum([os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)])
+                entries.append((os.path.getmtime(entry_dir), entry_dir, entry_size))
+            except OSError:
+                # removed by another process while we were looking at it
+                continue
+
+        cache_size = sum([e[2] for e in entries])
+        for last_used, entry_dir, entry_size in sorted(entries):
+            if cache_size <= self.max_cache_size:
+                break
+
+            lock = self.lock_entry(entry_dir, exclusive = True, blocking = False)
+            if lock is None:
+                continue
+
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            os.close(lock)
+            cache_size -= entry_size
+            self.run.info('Evicted from the HMM cache', entry_dir)
+
+
 class HMMSearch:
-    def __init__(self, protein_sequences_fasta, progress = progress, run = run):
+    def __init__(self, protein_sequences_fasta, progress = progress, run = run, num_threads = 1, hmm_cache = None):
         self.progress = progress
         self.run = run
 
+        # pressed models are taken from `hmm_cache` (a PressedHMMCache instance) when there is one:
+        self.hmm_cache = hmm_cache
+        if self.hmm_cache and not self.hmm_cache.is_usable():
+            self.run.warning("The HMM cache directory '%s' is not writable, so anvi'o will not use it, and will\
+                              press the models in temporary directories instead." % self.hmm_cache.cache_dir)
+            self.hmm_cache = None
+
         filesnpaths.is_file_fasta_formatted(protein_sequences_fasta)
 
         self.protein_sequences_fasta = protein_sequences_fasta
+        self.num_threads = num_threads
 
         # hmm_scan_hits is the file to access later on for parsing:
         self.hmm_scan_output = None
         self.hmm_scan_hits = None
         self.genes_in_contigs = None
 
+        # protein sequences are split into shards only once, no matter how many sources are searched:
+        self.protein_sequences_shards = None
+
         self.tmp_dirs = []
 
 
     def run_hmmscan(self, source, genes_in_model, hmm, ref, cut_off_flag = "--cut_ga"):
+        """Runs hmmscan for a single source, and returns the path for parseable hits (or None if there
+           are no hits). See `run_hmmscan_for_sources` for more than one source."""
+
+        sources = {source: {'genes': genes_in_model, 'model': hmm, 'ref': ref}}
+        return self.run_hmmscan_for_sources(sources, cut_off_flag)[source]
+
+
+    def run_hmmscan_for_sources(self, sources, cut_off_flag = "--cut_ga"):
+        """Runs hmmscan for every source in `sources`, and returns a dict with the path for parseable
+           hits for each source (or None if there are no hits).
+
+           When `self.num_threads` is larger than 1, protein sequences are split into `self.num_threads`
+           shards, and hmmscan jobs for every shard of every source share `self.num_threads` processes.
+           Shard outputs are merged in order, so the hits files are identical to the ones a single hmmscan
+           run per source would generate (hmmscan E-values depend on the number of models, not the
+           number of query sequences)."""
+
+        if self.num_threads > 1:
+            self.split_protein_sequences_into_shards()
+            protein_sequences_shards = self.protein_sequences_shards
+        else:
+            protein_sequences_shards = [self.protein_sequences_fasta]
+
+        try:
+            jobs = []
+            work_dirs = {}
+            hmm_file_paths = {}
+            for source in sources:
+                work_dirs[source], hmm_file_paths[source] = self.prepare_hmm_model(source, sources[source]['genes'], sources[source]['model'], sources[source]['ref'])
+
+                for shard in range(0, len(protein_sequences_shards)):
+                    jobs.append((source, shard), )
+
+            self.progress.new('Processing')
+            self.progress.update('Performing HMM scan%s ...' % (' (%d jobs, %d threads)' % (len(jobs), self.num_threads) if self.num_threads > 1 else ''))
+
+            cmd_lines = {}
+            for source, shard in jobs:
+                tmp_dir = work_dirs[source]
+                log_file_path = self.get_shard_path(tmp_dir, '00_log.txt', shard)
+                cmd_line = ('hmmscan -o "%s" %s%s --tblout "%s" "%s" "%s" >> "%s" 2>&1' % (self.get_shard_path(tmp_dir, 'hmm.output', shard),
+                                                                                                         cut_off_flag,
+                                                                                                         ' --cpu 1' if self.num_threads > 1 else '',
+                                                                                                         self.get_shard_path(tmp_dir, 'hmm.hits.shitty', shard),
+                                                                                                         hmm_file_paths[source],
+                                                                                                         protein_sequences_shards[shard],
+                                                                                                         log_file_path))
+                cmd_lines[(source, shard)] = (cmd_line, log_file_path)
+
+            if self.num_threads > 1:
+                self.run_jobs_in_parallel([cmd_lines[job] for job in jobs])
+            else:
+                for job in jobs:
+                    self.run_job(*cmd_lines[job])
+        finally:
+            # cached models this run searched against can be evicted from now on:
+            if self.hmm_cache:
+                self.hmm_cache.release_entries()
+
+        self.progress.end()
+
+        hmm_scan_hits = {}
+        for source in sources:
+            hmm_scan_hits[source] = self.merge_hmmscan_outputs(source, work_dirs[source], len(protein_sequences_shards))
+
+        return hmm_scan_hits
+
+
+    def prepare_hmm_model(self, source, genes_in_model, hmm, ref):
+        """Creates a new temporary work directory for a source, and makes sure there is a pressed model to
+           search against, either in the cache, or in the work directory. Returns both paths."""
+
         self.run.warning('', header = 'HMM Profiling for %s' % source, lc = 'green')
         self.run.info('Reference', ref if ref else 'unknown')
         self.run.info('Pfam model', hmm)
@@ -51,68 +417,152 @@ class HMMSearch:
         tmp_dir = filesnpaths.get_temp_directory_path()
         self.tmp_dirs.append(tmp_dir)
 
-        self.hmm_scan_output = os.path.join(tmp_dir, 'hmm.output')
-        self.hmm_scan_hits = os.path.join(tmp_dir, 'hmm.hits')
-        self.hmm_scan_hits_shitty = os.path.join(tmp_dir, 'hmm.hits.shitty')
         log_file_path = os.path.join(tmp_dir, '00_log.txt')
 
         self.run.info('Temporary work dir', tmp_dir)
-        self.run.info('HMM scan output', self.hmm_scan_output)
-        self.run.info('HMM scan hits', self.hmm_scan_hits)
+        self.run.info('HMM scan output', os.path.join(tmp_dir, 'hmm.output'))
+        self.run.info('HMM scan hits', os.path.join(tmp_dir, 'hmm.hits'))
         self.run.info('Log file', log_file_path)
 
-        self.progress.new('Unpacking the model into temporary work directory')
-        self.progress.update('...')
-        hmm_file_path = os.path.join(tmp_dir, 'hmm.txt')
-        hmm_file = open(hmm_file_path, 'w')
-        hmm_file.write(gzip.open(hmm, 'rb').read())
-        hmm_file.close()
-        self.progress.end()
+        hmm_file_path = self.hmm_cache.get_pressed_model(hmm, log_file_path) if self.hmm_cache else None
+        if not hmm_file_path:
+            hmm_file_path = os.path.join(tmp_dir, 'hmm.txt')
+            unpack_and_press_hmm_model(hmm, hmm_file_path, log_file_path, self.progress)
 
-        self.progress.new('Processing')
-        self.progress.update('Compressing the pfam model')
-        cmd_line = ('hmmpress "%s" >> "%s" 2>&1' % (hmm_file_path, log_file_path))
-        with open(log_file_path, "a") as myfile: myfile.write('CMD: ' + cmd_line + '\n')
-        ret_val = utils.run_command(cmd_line)
-        if ret_val:
-            raise ConfigError, "The last call did not work quite well. Most probably the version of HMMER\
-                                you have installed is not up-to-date enough. Just to make sure what went\
-                                wrong please take a look at the log file ('%s'). Please visit %s to see what\
-                                is the latest version availalbe. You can learn which version of HMMER you have\
-                                on your system by typing 'hmmpress -h'"\
-                                        % (log_file_path, 'http://hmmer.janelia.org/download.html')
-        self.progress.end()
+        return tmp_dir, hmm_file_path
+
+
+    def get_shard_path(self, tmp_dir, file_name, shard):
+        """Files of the first shard (which is the only one in serial mode) keep their usual names"""
+        return os.path.join(tmp_dir, file_name if shard == 0 else '%s.%d' % (file_name, shard))
+
+
+    def split_protein_sequences_into_shards(self):
+        """Splits protein sequences into `self.num_threads` FASTA files with similar numbers of amino
+           acids. Every shard takes a consecutive run of sequences, so concatenating outputs of shards
+           keeps the order of sequences in the input file."""
+
+        if self.protein_sequences_shards:
+            return
 
-        self.progress.new('Processing')
-        self.progress.update('Performing HMM scan ...')
-        cmd_line = ('hmmscan -o "%s" %s --tblout "%s" "%s" "%s" >> "%s" 2>&1' % (self.hmm_scan_output,
-                                                                              cut_off_flag,
-                                                                              self.hmm_scan_hits_shitty,
-                                                                              hmm_file_path,
-                                                                              self.protein_sequences_fasta,
-                                                                              log_file_path))
+        tmp_dir = filesnpaths.get_temp_directory_path()
+        self.tmp_dirs.append(tmp_dir)
+
+        total_length = 0
+        fasta = fastalib.SequenceSource(self.protein_sequences_fasta)
+        while fasta.next():
+            total_length += len(fasta.seq)
+        fasta.close()
+
+        self.protein_sequences_shards = []
+        shard_output, shard_length = None, 0
+
+        fasta = fastalib.SequenceSource(self.protein_sequences_fasta)
+        while fasta.next():
+            # start a new shard once the current one has its share of amino acids:
+            if not shard_output or (shard_length * self.num_threads >= total_length and len(self.protein_sequences_shards) < self.num_threads):
+                if shard_output:
+                    shard_output.close()
+
+                self.protein_sequences_shards.append(os.path.join(tmp_dir, 'proteins_%d.fa' % len(self.protein_sequences_shards)))
+                shard_output, shard_length = fastalib.FastaOutput(self.protein_sequences_shards[-1]), 0
+
+            shard_output.write_id(fasta.id)
+            shard_output.write_seq(fasta.seq, split = False)
+            shard_length += len(fasta.seq)
+        fasta.close()
+
+        if shard_output:
+            shard_output.close()
+
+
+    def run_job(self, cmd_line, log_file_path):
         with open(log_file_path, "a") as myfile: myfile.write('CMD: ' + cmd_line + '\n')
         utils.run_command(cmd_line)
 
-        if not os.path.exists(self.hmm_scan_hits_shitty):
-            raise ConfigError, "Something went wrong with hmmscan, and it failed to generate the\
-                                expected output :/ Fortunately, this log file should tell you what\
-                                might be the problem: '%s'. Please do not forget to include this\
-                                file if you were to ask for help." % log_file_path
 
-        self.progress.end()
+    def run_jobs_in_parallel(self, cmd_lines):
+        """Runs (cmd_line, log_file_path) jobs using `self.num_threads` worker processes"""
+
+        input_queue = multiprocessing.Queue()
+        output_queue = multiprocessing.Queue()
+
+        for cmd_line in cmd_lines:
+            input_queue.put(cmd_line)
+
+        # one poison pill for each worker:
+        num_workers = min(self.num_threads, len(cmd_lines))
+        for i in range(0, num_workers):
+            input_queue.put(None)
+
+        workers = []
+        for i in range(0, num_workers):
+            worker = multiprocessing.Process(target = self.run_jobs_worker, args = (input_queue, output_queue))
+            workers.append(worker)
+            worker.start()
+
+        num_jobs_finished = 0
+        while num_jobs_finished < len(cmd_lines):
+            try:
+                output_queue.get(timeout = 1)
+            except Queue.Empty:
+                dead_workers = utils.get_worker_processes_that_died(workers)
+                if dead_workers:
+                    for worker in workers:
+                        worker.terminate()
+                    self.progress.end()
+                    raise ConfigError, "One of the worker processes died unexpectedly (with exit code %d) while\
+                                        running hmmscan. This usually happens when the operating system kills a\
+                                        process that uses too much memory. You may want to try again with fewer\
+                                        threads :/" % dead_workers[0].exitcode
+                continue
+
+            num_jobs_finished += 1
+            self.progress.update('HMM scan: %d of %d jobs are done ...' % (num_jobs_finished, len(cmd_lines)))
+
+        for worker in workers:
+            worker.join()
+
+
+    def run_jobs_worker(self, input_queue, output_queue):
+        while True:
+            job = input_queue.get()
+
+            if job is None:
+                break
+
+            try:
+                self.run_job(*job)
+            except Exception:
+                # missing outputs are reported by the parent process, along with the log file to look at
+                pass
+
+            output_queue.put(job)
+
+
+    def merge_hmmscan_outputs(self, source, tmp_dir, num_shards):
+        self.hmm_scan_output = os.path.join(tmp_dir, 'hmm.output')
+        self.hmm_scan_hits = os.path.join(tmp_dir, 'hmm.hits')
+
+        for shard in range(0, num_shards):
+            if not os.path.exists(self.get_shard_path(tmp_dir, 'hmm.hits.shitty', shard)):
+                raise ConfigError, "Something went wrong with hmmscan, and it failed to generate the\
+                                    expected output :/ Fortunately, this log file should tell you what\
+                                    might be the problem: '%s'. Please do not forget to include this\
+                                    file if you were to ask for help." % self.get_shard_path(tmp_dir, '00_log.txt', shard)
 
         # thank you, hmmscan, for not generating a simple TAB-delimited, because we programmers
         # love to write little hacks like this into our code:
         parseable_output = open(self.hmm_scan_hits, 'w')
-        for line in open(self.hmm_scan_hits_shitty).readlines():
-            if line.startswith('#'):
-                continue
-            parseable_output.write('\t'.join(line.split()[0:18]) + '\n')
+        for shard in range(0, num_shards):
+            for line in open(self.get_shard_path(tmp_dir, 'hmm.hits.shitty', shard)).readlines():
+                if line.startswith('#'):
+                    continue
+                parseable_output.write('\t'.join(line.split()[0:18]) + '\n')
         parseable_output.close()
 
         num_raw_hits = filesnpaths.get_num_lines_in_file(self.hmm_scan_hits)
-        self.run.info('Number of raw hits', num_raw_hits)
+        self.run.info('Number of raw hits (%s)' % source, num_raw_hits)
 
         return self.hmm_scan_hits if num_raw_hits else None
 
@@ -134,10 +584,12 @@ class SequencesForHMMHits:
         self.hmm_hits = contigs_db.get_table_as_dict(t.hmm_hits_table_name)
         self.hmm_hits_info = contigs_db.get_table_as_dict(t.hmm_hits_info_table_name)
         self.hmm_hits_splits = contigs_db.get_table_as_dict(t.hmm_hits_splits_table_name)
-        self.contig_sequences = contigs_db.get_table_as_dict(t.contig_sequences_table_name, string_the_key = True)
         self.genes_in_contigs = contigs_db.get_table_as_dict(t.genes_in_contigs_table_name)
         contigs_db.disconnect()
 
+        # sequences of genes are read from the contigs database only when they are asked for:
+        self.contigs_db_path = contigs_db_path
+
         missing_sources = [s for s in self.sources if s not in self.hmm_hits_info]
         if len(missing_sources):
             raise ConfigError, 'Some of the requested sources were not found in the contigs database :/\
@@ -177,6 +629,10 @@ class SequencesForHMMHits:
 
         hmm_sequences_dict_for_splits = {}
 
+        # dbops imports this module, hence the late import:
+        import anvio.dbops as dbops
+        contig_sequences = dbops.ContigSequences(self.contigs_db_path)
+
         unique_ids_taken_care_of = set([])
         for split_entry in hits_in_splits.values():
             hmm_hit = self.hmm_hits[split_entry['hmm_hit_entry_id']]
@@ -196,7 +652,7 @@ class SequencesForHMMHits:
 
             contig_name = gene_call['contig']
             start, stop = gene_call['start'], gene_call['stop']
-            sequence = self.contig_sequences[contig_name]['sequence'][start:stop]
+            sequence = contig_sequences.get_subsequence(contig_name, start, stop)
 
             hmm_sequences_dict_for_splits[gene_unique_id] = {'sequence': sequence,
                                                              'source': source,
@@ -208,6 +664,8 @@ class SequencesForHMMHits:
                                                              'stop': stop,
                                                              'length': stop - start}
 
+        contig_sequences.close()
+
         return hmm_sequences_dict_for_splits
 
 
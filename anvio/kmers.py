@@ -1,6 +1,7 @@
 # -*- coding: utf-8
 """Simple KMers class to compute kmer-nucleotide frequecies"""
 
+import numpy
 import itertools
 
 import anvio
@@ -23,11 +24,21 @@ def rev_comp(seq):
 
 
 class KMers:
+    """Counts canonical k-mers (a k-mer and its reverse complement are counted together).
+
+       Sequences are 2-bit encoded with A=0, T=1, C=2, G=3, which happens to be the order in which
+       `get_kmers` visits k-mers, so the canonical form of a k-mer is simply the smaller of its own
+       code and the code of its reverse complement. Every window of k nucleotides gets its code
+       with a rolling sum, windows with anything other than ATCG are masked, and codes are mapped
+       to indices of canonical k-mers through a lookup table, to be counted with `numpy.bincount`."""
+
     def __init__(self, k = 4):
         self.kmers = {}
         self.k = k
         
         self.get_kmers()
+        self.init_kmer_code_lookups()
+
 
     def get_kmers(self):
         k = self.k
@@ -42,37 +53,109 @@ class KMers:
         self.kmers[k] = kmers
 
 
-    def get_kmer_frequency(self, sequence, dist_metric_safe = True):
+    def init_kmer_code_lookups(self):
         k = self.k
-        sequence = sequence.upper()
 
-        if len(sequence) < k:
-            return None
+        # nucleotide -> 2-bit code, -1 for everything else:
+        self.nt_codes = numpy.empty(256, dtype = numpy.int64)
+        self.nt_codes.fill(-1)
+        for code, nt in enumerate('ATCG'):
+            self.nt_codes[ord(nt)] = code
+            self.nt_codes[ord(nt.lower())] = code
 
-        if not self.kmers.has_key(k):
-            self.get_kmers(k)
-        
-        kmers = self.kmers[k]
-        frequencies = dict(zip(kmers, [0] * len(kmers)))
-        
-        for i in range(0, len(sequence) - (k - 1)):
-            kmer = sequence[i:i + k]
-            
-            # FIXME: this can be faster/better
-            if len([n for n in kmer if n not in 'ATCG']):
-                continue
+        # complementing a 2-bit code is flipping its lowest bit (A <-> T, C <-> G), and reversing a k-mer
+        # is reading its codes backwards:
+        codes = numpy.arange(4 ** k, dtype = numpy.int64)
+        rev_comp_codes = numpy.zeros(4 ** k, dtype = numpy.int64)
+        for i in range(0, k):
+            rev_comp_codes = (rev_comp_codes << 2) | (((codes >> (2 * i)) & 3) ^ 1)
+
+        canonical_codes = numpy.minimum(codes, rev_comp_codes)
+        unique_canonical_codes = numpy.unique(canonical_codes)
+
+        # k-mer code -> index of its canonical k-mer in `self.canonical_kmers`:
+        self.canonical_kmer_index = numpy.searchsorted(unique_canonical_codes, canonical_codes)
+        self.canonical_kmers = [''.join(['ATCG'[(code >> (2 * (k - i - 1))) & 3] for i in range(0, k)]) for code in unique_canonical_codes]
+
+
+    def get_canonical_kmer_indices(self, sequence):
+        """Returns the canonical k-mer index for every window of k nucleotides in `sequence`, or -1
+           for windows with ambiguous bases."""
+
+        k = self.k
+        num_windows = len(sequence) - (k - 1)
+
+        nt_codes = self.nt_codes[numpy.frombuffer(str(sequence), dtype = numpy.uint8)]
+
+        # number of ambiguous bases so far, to find windows that contain any:
+        num_ambiguous = numpy.concatenate(([0], numpy.cumsum(nt_codes < 0)))
+        ambiguous_windows = (num_ambiguous[k:] - num_ambiguous[:num_windows]) > 0
+
+        nt_codes[nt_codes < 0] = 0
+        kmer_codes = numpy.zeros(num_windows, dtype = numpy.int64)
+        for i in range(0, k):
+            kmer_codes = (kmer_codes << 2) | nt_codes[i:i + num_windows]
+
+        kmer_indices = self.canonical_kmer_index[kmer_codes]
+        kmer_indices[ambiguous_windows] = -1
+
+        return kmer_indices
+
+
+    def count_kmers(self, kmer_indices):
+        return numpy.bincount(kmer_indices[kmer_indices >= 0], minlength = len(self.canonical_kmers))
 
-            if frequencies.has_key(kmer):
-                frequencies[kmer] += 1
-            else:
-                frequencies[rev_comp(kmer)] += 1
 
+    def get_kmer_frequency_dict(self, counts, dist_metric_safe = True):
         if dist_metric_safe:
             # we don't want all kmer freq values to be zero. so the distance
             # metrics wouldn't go crazy. instead we fill it with 1. which
             # doesn't affect relative distances.
-            if sum(frequencies.values()) == 0:
-                words = self.kmers[self.k]
-                frequencies = dict(zip(words, [1] * len(words)))
+            if not counts.any():
+                counts = numpy.ones(len(self.canonical_kmers), dtype = numpy.int64)
+
+        return dict(zip(self.canonical_kmers, counts.tolist()))
+
+
+    def get_kmer_frequency(self, sequence, dist_metric_safe = True):
+        if len(sequence) < self.k:
+            return None
+
+        counts = self.count_kmers(self.get_canonical_kmer_indices(sequence))
+
+        return self.get_kmer_frequency_dict(counts, dist_metric_safe)
+
+
+    def get_kmer_frequencies_for_contig_and_splits(self, sequence, split_start_stops, dist_metric_safe = True):
+        """Returns k-mer frequencies for a contig, and for each of its splits.
+
+           The sequence is encoded only once. Each split is counted from the windows that fall
+           entirely within it, and the contig profile is the sum of split profiles plus the few
+           windows that span split boundaries."""
+
+        k = self.k
+
+        if len(sequence) < k:
+            return (None, [None] * len(split_start_stops))
+
+        kmer_indices = self.get_canonical_kmer_indices(sequence)
+
+        in_a_split = numpy.zeros(len(kmer_indices), dtype = bool)
+        contig_counts = numpy.zeros(len(self.canonical_kmers), dtype = numpy.int64)
+        split_kmer_frequencies = []
+
+        for start, end in split_start_stops:
+            if end - start < k:
+                split_kmer_frequencies.append(None)
+                continue
+
+            split_counts = self.count_kmers(kmer_indices[start:end - (k - 1)])
+            in_a_split[start:end - (k - 1)] = True
+            contig_counts += split_counts
+
+            split_kmer_frequencies.append(self.get_kmer_frequency_dict(split_counts, dist_metric_safe))
+
+        # windows that span split boundaries:
+        contig_counts += self.count_kmers(kmer_indices[~in_a_split])
 
-        return frequencies
+        return (self.get_kmer_frequency_dict(contig_counts, dist_metric_safe), split_kmer_frequencies)
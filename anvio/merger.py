@@ -12,6 +12,7 @@ import anvio.dbops as dbops
 import anvio.tables as tables
 import anvio.dictio as dictio
 import anvio.terminal as terminal
+import anvio.contigops as contigops
 import anvio.constants as constants
 import anvio.clustering as clustering
 import anvio.filesnpaths as filesnpaths
@@ -545,3 +546,300 @@ class MultipleRuns:
         db.disconnect()
 
         return atomic_data_table_fields, atomic_data_table_for_each_run
+
+
+class MultipleShards:
+    """Merges partial profiles of a single BAM file that were generated with `anvi-profile --shard i/N` into a
+       single profile, which is the same profile anvi-profile would have generated without `--shard`.
+
+       Shards have no contigs in common, so merging them is a matter of copying rows of variable positions and
+       gene coverages tables, split coverages, and serialized profiles. The only thing to compute again is the
+       abundance of contigs and splits, which depends on the mean coverage of every contig in the sample."""
+    def __init__(self, args, run = run, progress = progress):
+        self.progress = progress
+        self.run = run
+
+        self.input_runinfo_paths = args.input
+        self.input_runinfo_dicts = []
+        self.output_directory = args.output_dir
+        self.contigs_shall_be_clustered = args.cluster_contigs
+        self.overwrite_output_destinations = args.overwrite_output_destinations
+
+        self.contigs_db_path = args.contigs_db
+        self.profile_db_path = None
+
+        self.clustering_configs = constants.clustering_configs['single']
+
+        self.database_paths = {'CONTIGS.db': self.contigs_db_path}
+
+
+    def read_runinfo_dicts(self):
+        improper = []
+
+        for p in self.input_runinfo_paths:
+            try:
+                runinfo = dictio.read_serialized_object(p)
+            except:
+                improper.append(p)
+                continue
+
+            input_dir = os.path.dirname(os.path.abspath(p))
+            runinfo['input_dir'] = input_dir
+            runinfo['profile_db'] = os.path.join(input_dir, 'PROFILE.db')
+
+            self.input_runinfo_dicts.append(runinfo)
+
+        if improper:
+            raise ConfigError, "%s seem to be properly formatted anvio object: %s. Are you\
+                                sure these are anvio RUNINFO.cp files?" % \
+                                           ('Some RUNINFO files do not' if len(improper) > 1 else "RUNINFO file does not",
+                                            ', '.join(improper))
+
+        missing_path = [r['input_dir'] for r in self.input_runinfo_dicts if not os.path.exists(r['profile_db'])]
+        if missing_path:
+            raise ConfigError, "Anvi'o couldn't find any profile databases for %d of %d shards you provided for merging."\
+                                            % (len(missing_path), len(self.input_runinfo_dicts))
+
+
+    def sanity_check(self):
+        self.output_directory = filesnpaths.check_output_directory(self.output_directory, ok_if_exists = self.overwrite_output_destinations)
+
+        if not self.contigs_db_path:
+            raise ConfigError, "You must provide a contigs database for this operation."
+        if not os.path.exists(self.contigs_db_path):
+            raise ConfigError, "anvio couldn't find the contigs database where you said it would be :/"
+
+        missing = [p for p in self.input_runinfo_paths if not os.path.exists(p)]
+        if missing:
+            raise ConfigError, "%s not found: %s." % ('Some files are' if len(missing) > 1 else "File is",
+                                                                 ', '.join(missing))
+
+        self.read_runinfo_dicts()
+
+        not_shards = [r['input_dir'] for r in self.input_runinfo_dicts if not r.get('shard')]
+        if not_shards:
+            raise ConfigError, "Some of the profiles you want to merge are not partial profiles of shards (i.e., '%s'). You\
+                                should use 'anvi-merge' to merge profiles of different samples." % not_shards[0]
+
+        # sort shards by their index, and make sure none is missing:
+        shards = [[int(x) for x in r['shard'].split('/')] for r in self.input_runinfo_dicts]
+        self.input_runinfo_dicts = [r for (s, r) in sorted(zip(shards, self.input_runinfo_dicts))]
+        self.num_shards = shards[0][1]
+
+        if len(set([n for (i, n) in shards])) > 1:
+            raise ConfigError, "These shards do not come from the same split of the job: some of them belong to a\
+                                different number of shards than others."
+
+        if sorted([i for (i, n) in shards]) != range(1, self.num_shards + 1):
+            missing_shards = sorted(set(range(1, self.num_shards + 1)) - set([i for (i, n) in shards]))
+            raise ConfigError, "You need every one of the %d shards of this profile, once, to merge them. %s"\
+                                    % (self.num_shards, ('These are missing: %s.' % ', '.join([str(i) for i in missing_shards])) \
+                                                            if missing_shards else 'Some of them are declared more than once.')
+
+        for k, p in [('sample_id', 'Sample name'),
+                     ('contigs_db_hash', 'Contigs database'),
+                     ('total_reads_mapped', 'Number of reads mapped'),
+                     ('split_length', 'Split length (-L)'),
+                     ('min_contig_length', 'Minimum contig length (-M)'),
+                     ('min_mean_coverage', 'Minimum mean coverage (-C)'),
+                     ('min_coverage_for_variability', 'Minimum coverage to report variability (-V)'),
+                     ('max_depth_for_SNV_profiling', 'Max depth for SNV profiling (--max-depth-for-SNV-profiling)'),
+                     ('report_variability_full', 'Report full variability (--report-variability-full)'),
+                     ('skip_SNV_profiling', 'Skip SNV profiling parameter (--skip-SNV-profiling)')]:
+            v = set([r.get(k) for r in self.input_runinfo_dicts])
+            if len(v) > 1:
+                raise ConfigError, "%s is not identical for all shards to be merged, which is a deal breaker. All\
+                                    shards of a profile must be run with identical flags and parameters :/" % p
+
+        contigs_db = dbops.ContigsDatabase(self.contigs_db_path, quiet = True)
+        contigs_db_hash = contigs_db.meta['contigs_db_hash']
+        contigs_basic_info = contigs_db.db.get_table_as_dict(tables.contigs_info_table_name)
+        contigs_db.disconnect()
+
+        if self.input_runinfo_dicts[0]['contigs_db_hash'] != contigs_db_hash:
+            raise ConfigError, "The contigs database you provided, which is identified with hash '%s', does not seem\
+                                to match the shards you are trying to merge, which share the hash identifier of '%s'.\
+                                What's up with that?" % (contigs_db_hash, self.input_runinfo_dicts[0]['contigs_db_hash'])
+
+        self.contigs_db_hash = contigs_db_hash
+        self.contig_lengths = dict([(contig_name, contigs_basic_info[contig_name]['length']) for contig_name in contigs_basic_info])
+
+
+    def merge(self):
+        self.sanity_check()
+
+        filesnpaths.gen_output_directory(self.output_directory, delete_if_exists = self.overwrite_output_destinations)
+
+        self.profile_db_path = os.path.join(self.output_directory, 'PROFILE.db')
+
+        self.progress.new('Merging shards')
+        self.progress.update('Creating the profile database ...')
+        self.create_profile_db()
+
+        self.progress.update('Merging variable positions and gene coverages tables ...')
+        self.merge_tables()
+
+        self.progress.update('Merging split coverage values ...')
+        self.merge_split_coverage_data()
+
+        self.progress.update('Merging serialized profiles ...')
+        self.merge_serialized_profiles()
+        self.progress.end()
+
+        self.merge_atomic_data()
+
+        # the only view for a single profile:
+        views_table = dbops.TableForViews(self.profile_db_path, anvio.__profile__version__)
+        views_table.append('single', 'atomic_data_splits')
+        views_table.store()
+
+        self.gen_runinfo_dict()
+
+        if self.contigs_shall_be_clustered:
+            self.cluster_contigs()
+
+        runinfo_serialized = os.path.join(self.output_directory, 'RUNINFO.cp')
+        self.run.info('runinfo', runinfo_serialized)
+        self.run.store_info_dict(runinfo_serialized, strip_prefix = self.output_directory)
+
+        self.run.quit()
+
+
+    def create_profile_db(self):
+        meta_values = {}
+        for runinfo in self.input_runinfo_dicts:
+            profile_db = dbops.ProfileDatabase(runinfo['profile_db'], quiet = True)
+
+            for key in ['num_contigs', 'num_splits', 'total_length']:
+                meta_values[key] = meta_values.get(key, 0) + profile_db.meta[key]
+
+            for key in profile_db.meta:
+                if key not in ['version', 'creation_date', 'shard', 'num_contigs', 'num_splits', 'total_length']:
+                    meta_values[key] = profile_db.meta[key]
+
+            profile_db.disconnect()
+
+        meta_values['contigs_clustered'] = self.contigs_shall_be_clustered
+
+        profile_db = dbops.ProfileDatabase(self.profile_db_path)
+        profile_db.create(meta_values)
+
+        self.num_contigs = meta_values['num_contigs']
+        self.num_splits = meta_values['num_splits']
+        self.total_length = meta_values['total_length']
+
+
+    def merge_tables(self):
+        """Rows are copied from one database to the other by SQLite. Only their entry ids change, so they
+           continue from where the previous shard left off."""
+        profile_db = dbops.ProfileDatabase(self.profile_db_path, quiet = True)
+
+        for table_name, table_structure in [(tables.variable_nts_table_name, tables.variable_nts_table_structure),
+                                            (tables.gene_coverages_table_name, tables.gene_coverages_table_structure)]:
+            for runinfo in self.input_runinfo_dicts:
+                next_id = profile_db.db._exec('''SELECT COALESCE(MAX(%s) + 1, 0) FROM %s''' % (table_structure[0], table_name)).fetchone()[0]
+
+                profile_db.db._exec('''ATTACH DATABASE ? AS shard''', (runinfo['profile_db'], ))
+                profile_db.db._exec('''INSERT INTO %s SELECT %s + %d, %s FROM shard.%s''' % (table_name, table_structure[0], next_id,
+                                                                                             ', '.join(table_structure[1:]), table_name))
+                profile_db.db._exec('''DETACH DATABASE shard''')
+
+        profile_db.disconnect()
+
+
+    def merge_split_coverage_data(self):
+        output_file_path = os.path.join(self.output_directory, 'AUXILIARY-DATA.h5')
+        merged_split_coverage_values = auxiliarydataops.AuxiliaryDataForSplitCoverages(output_file_path, self.contigs_db_hash, create_new = True)
+
+        for runinfo in self.input_runinfo_dicts:
+            input_file_path = os.path.join(runinfo['input_dir'], 'AUXILIARY-DATA.h5')
+            shard_split_coverage_values = auxiliarydataops.AuxiliaryDataForSplitCoverages(input_file_path, self.contigs_db_hash)
+            merged_split_coverage_values.extend(shard_split_coverage_values)
+            shard_split_coverage_values.close()
+
+        merged_split_coverage_values.close()
+
+
+    def merge_serialized_profiles(self):
+        """Shards have serialized profiles unless they were profiled with `--skip-serialized-profile`"""
+        input_file_paths = [os.path.join(r['input_dir'], 'PROFILE.h5') for r in self.input_runinfo_dicts]
+
+        self.serialized_profile_path = None
+        if False in [os.path.exists(p) for p in input_file_paths]:
+            return
+
+        self.serialized_profile_path = os.path.join(self.output_directory, 'PROFILE.h5')
+
+        merged_serialized_profile = None
+        for input_file_path in input_file_paths:
+            shard_serialized_profile = contigops.SerializedProfile(input_file_path, self.contigs_db_hash)
+
+            if not merged_serialized_profile:
+                contig_parameters = dict(shard_serialized_profile.fp.attrs.items())
+                merged_serialized_profile = contigops.SerializedProfile(self.serialized_profile_path, self.contigs_db_hash,
+                                                                        create_new = True, contig_parameters = contig_parameters)
+
+            merged_serialized_profile.extend(shard_serialized_profile)
+            shard_serialized_profile.close()
+
+        merged_serialized_profile.close()
+
+
+    def merge_atomic_data(self):
+        atomic_contig_split_data = contigops.AtomicContigSplitData(self.progress)
+
+        for runinfo in self.input_runinfo_dicts:
+            shard_profile_db = dbops.ProfileDatabase(runinfo['profile_db'], quiet = True)
+            atomic_contig_split_data.add_atomic_data_from_db(shard_profile_db.db, self.contig_lengths)
+            shard_profile_db.disconnect()
+
+        profile_db = dbops.ProfileDatabase(self.profile_db_path, quiet = True)
+        atomic_contig_split_data.store_atomic_data_for_contigs_and_splits(profile_db.db)
+        profile_db.disconnect()
+
+        self.split_names = set(atomic_contig_split_data.atomic_data_splits.keys())
+        self.num_contigs_stored = len(atomic_contig_split_data.atomic_data_contigs)
+
+
+    def gen_runinfo_dict(self):
+        """The runinfo dict of the merged profile is the one of the first shard, with numbers that describe the
+           whole profile rather than a single shard."""
+        for key, value in self.input_runinfo_dicts[0].items():
+            if key not in ['shard', 'input_dir', 'profile_db', 'contigs_after_C', 'num_contigs_in_shard', 'total_length_of_shard',
+                           'num_columns_capped_for_SNV_profiling', 'profile_dict', 'runinfo']:
+                self.run.info(key, value, quiet = True)
+
+        self.run.info('sample_id', self.input_runinfo_dicts[0]['sample_id'])
+        self.run.info('num_shards_merged', self.num_shards)
+        self.run.info('output_dir', self.output_directory, display_only = True)
+        self.run.info('profile_db', self.profile_db_path, display_only = True)
+        self.run.info('cmd_line', utils.get_cmd_line())
+        self.run.info('num_contigs', self.num_contigs)
+        self.run.info('num_splits', self.num_splits)
+        self.run.info('total_length', self.total_length)
+        self.run.info('clustering_performed', self.contigs_shall_be_clustered)
+
+        if self.num_contigs_stored < self.num_contigs:
+            self.run.info('contigs_after_C', self.num_contigs_stored)
+
+        if False not in [r.has_key('num_columns_capped_for_SNV_profiling') for r in self.input_runinfo_dicts]:
+            self.run.info('num_columns_capped_for_SNV_profiling', sum([r['num_columns_capped_for_SNV_profiling'] for r in self.input_runinfo_dicts]))
+
+        if self.serialized_profile_path:
+            self.run.info('profile_dict', self.serialized_profile_path)
+
+
+    def cluster_contigs(self):
+        for config_name in self.clustering_configs:
+            config_path = self.clustering_configs[config_name]
+
+            config = ClusteringConfiguration(config_path, self.output_directory, db_paths = self.database_paths, row_ids_of_interest = self.split_names)
+
+            try:
+                newick = clustering.order_contigs_simple(config, progress = self.progress)
+            except Exception as e:
+                self.run.warning('Clustering has failed for "%s": "%s"' % (config_name, e))
+                self.progress.end()
+                continue
+
+            dbops.add_hierarchical_clustering_to_db(self.profile_db_path, config_name, newick, make_default = config_name == constants.single_default, run = self.run)
@@ -0,0 +1,582 @@
+# -*- coding: utf-8
+"""Classes to recover what the pileup of a BAM file reports, without walking through the pileup.
+
+   Going through the pileup column by column, and through every read in every column is the most
+   expensive thing we do during profiling. Everything we need from the pileup (coverage values,
+   and the nucleotides reads report for every position) can be recovered by visiting each read only
+   once, as long as we filter and treat reads exactly the way pysam's pileup does by default. The
+   classes here do that, and fall back to the pileup when they can't guarantee identical results.
+
+   The pileup they mimic is the one of pysam 0.15 (and the htslib that comes with it), which is the
+   only version `tests/run_pileup_test.py` compared the two for. With any other version of pysam
+   `PYSAM_VERSION_IS_VERIFIED` is False, and callers should walk through the pileup instead."""
+
+import re
+import zlib
+import numpy
+import pysam
+
+import anvio
+
+from anvio.variability import nt_counts_order, get_depth_capped_nt_counts
+
+
+__author__ = "A. Murat Eren"
+__copyright__ = "Copyright 2015, The anvio Project"
+__credits__ = []
+__license__ = "GPL 3.0"
+__version__ = anvio.__version__
+__maintainer__ = "A. Murat Eren"
+__email__ = "a.murat.eren@gmail.com"
+__status__ = "Development"
+
+
+# reads with any of these flags never make it into the pileup (this is pysam's default):
+PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 # unmapped, secondary, qc fail, duplicate
+
+# pysam's default max depth for the pileup:
+PILEUP_MAX_DEPTH = 8000
+
+# the max depth of the pileup `SplitPileup` walks through, which is large enough for the pileup to hold
+# on to every read, so coverage values of columns deeper than `PILEUP_MAX_DEPTH` are not truncated:
+SPLIT_PILEUP_MAX_DEPTH = 2 ** 31 - 1
+
+# pysam's pileup does not report nucleotides with base qualities lower than this:
+PILEUP_MIN_BASE_QUALITY = 13
+
+# versions of pysam from the first one here up to (but not including) the second one report the
+# same pileup the classes here recover from reads:
+VERIFIED_PYSAM_VERSIONS = ((0, 15), (0, 16))
+
+# cigar operations
+M, I, D, N, S, H, P, EQ, X = range(0, 9)
+
+CIGAR_ALIGNED = set([M, EQ, X])
+CIGAR_CONSUMES_REFERENCE = set([M, D, N, EQ, X])
+CIGAR_CONSUMES_READ = set([M, I, S, EQ, X])
+
+# ASCII code of a nucleotide -> its index in `nt_counts_order` (anything that is not A, C, G, or T is an N):
+NT_INDEX = numpy.empty(256, dtype = numpy.uint8)
+NT_INDEX.fill(nt_counts_order.index('N'))
+for nt in 'ACGT':
+    NT_INDEX[ord(nt)] = nt_counts_order.index(nt)
+
+
+def is_pysam_version_verified(version):
+    """Returns True if the pileup of this version of pysam is the one the classes here recover from reads"""
+    numbers = re.match(r'^(\d+)\.(\d+)', version)
+    if not numbers:
+        return False
+
+    version = (int(numbers.group(1)), int(numbers.group(2)))
+    return VERIFIED_PYSAM_VERSIONS[0] <= version < VERIFIED_PYSAM_VERSIONS[1]
+
+
+PYSAM_VERSION_IS_VERIFIED = is_pysam_version_verified(pysam.__version__)
+
+
+def get_sampling_seed(split):
+    """Reads of deep columns are always sampled with the same seed for a given split, so profiles do not
+       change from one run to another"""
+    return zlib.crc32(split.name) & 0xffffffff
+
+
+def is_read_in_pileup(read):
+    """Returns True if pysam's pileup would have reported this read (with its default filters)"""
+    if read.flag & PILEUP_SKIP_FLAGS:
+        return False
+
+    if read.is_paired and not read.is_proper_pair:
+        return False
+
+    if read.reference_end is None:
+        return False
+
+    return True
+
+
+def get_coverage_from_reads(starts, ends, window_start, window_end, pileup_max_depth = PILEUP_MAX_DEPTH):
+    """Returns coverage values between `window_start` and `window_end` for reads with given start
+       and end positions, and whether these values are identical to what a pileup with the given max
+       depth would report.
+
+       Start and end positions of reads are recorded in a difference array (+1 where a read starts,
+       -1 where it ends), and the coverage is its cumulative sum."""
+    starts = numpy.asarray(starts)
+    ends = numpy.minimum(ends, window_end)
+
+    # some reads may start before the window:
+    offset = min(starts.min(), window_start)
+    length = window_end - offset
+
+    starts = numpy.bincount(starts - offset, minlength = length + 1)
+    ends = numpy.bincount(ends - offset, minlength = length + 1)
+
+    c = numpy.cumsum(starts[:length] - ends[:length])
+
+    # while a new read is added to the pileup, the pileup holds on to every read that covers the
+    # previous position. if that number ever exceeds the max depth, the pileup quietly drops reads,
+    # and coverage values from reads will no longer match the ones from the pileup:
+    reads_held_by_pileup = starts[:length].copy()
+    reads_held_by_pileup[1:] += c[:-1]
+    is_identical_to_pileup = reads_held_by_pileup.max() < pileup_max_depth - 1
+
+    return c[window_start - offset:].astype(numpy.uint32), is_identical_to_pileup
+
+
+def get_concatenated_ranges(starts, lengths):
+    """Returns numpy.concatenate([numpy.arange(s, s + l) for s, l in zip(starts, lengths)]), without the loop"""
+    starts = numpy.asarray(starts, dtype = numpy.int64)
+    lengths = numpy.asarray(lengths, dtype = numpy.int64)
+
+    offsets_in_output = numpy.cumsum(lengths) - lengths
+    return numpy.repeat(starts - offsets_in_output, lengths) + numpy.arange(0, lengths.sum())
+
+
+def is_mate_overlap_candidate(read):
+    """Returns True if the pileup would check this read for an overlap with its mate"""
+    if not read.flag & 0x1 or read.flag & 0x8:
+        return False
+
+    if read.next_reference_id >= 0 and read.next_reference_id != read.reference_id:
+        return False
+
+    # the pileup also skips reads with long inserts if their mates start after them. but it makes that call
+    # before it records where the read ends, so in practice the end it compares against is never beyond the
+    # start of the read, and every read with a long insert is skipped:
+    if abs(read.template_length) >= 2 * read.query_length:
+        return False
+
+    return True
+
+
+def get_single_aligned_block(cigar):
+    """Returns (position in read, length) of the aligned block if this cigar has only one (i.e., there are
+       no indels or =/X operations; clipping is fine), otherwise returns None."""
+    block = None
+    pos_in_read = 0
+
+    for operation, length in cigar:
+        if operation in CIGAR_ALIGNED:
+            if block:
+                return None
+            block = (pos_in_read, length)
+        elif operation not in (S, H):
+            return None
+
+        if operation == S:
+            pos_in_read += length
+
+    return block
+
+
+class CigarWalker:
+    """Walks through the aligned positions of a read the way the pileup does when it looks for
+       positions shared by overlapping mates.
+
+       This is a line-by-line port of `cigar_iref2iseq_set` and `cigar_iref2iseq_next` in htslib,
+       including their quirks (such as skipping the last nucleotide of aligned blocks that follow
+       another cigar operation), so the positions we modify in mates are the ones the pileup
+       modifies."""
+    def __init__(self, cigar):
+        self.cigar = cigar
+        self.i = 0
+        self.icig = 0
+        self.iseq = 0
+        self.iref = 0
+
+
+    def set(self, pos):
+        if pos < 0:
+            return -1
+
+        self.icig, self.iseq, self.iref = 0, 0, 0
+        while self.i < len(self.cigar):
+            operation, length = self.cigar[self.i]
+
+            if operation == S:
+                self.i += 1; self.iseq += length; self.icig = 0
+            elif operation in (H, P):
+                self.i += 1; self.icig = 0
+            elif operation in CIGAR_ALIGNED:
+                pos -= length
+                if pos < 0:
+                    self.icig = length + pos; self.iseq += self.icig; self.iref += self.icig
+                    return M
+                self.i += 1; self.iseq += length; self.icig = 0; self.iref += length
+            elif operation == I:
+                self.i += 1; self.iseq += length; self.icig = 0
+            elif operation in (D, N):
+                pos = max(pos - length, 0)
+                self.i += 1; self.icig = 0; self.iref += length
+            else:
+                return -2
+
+        self.iseq = -1
+        return -1
+
+
+    def next(self):
+        while self.i < len(self.cigar):
+            operation, length = self.cigar[self.i]
+
+            if operation == S:
+                self.i += 1; self.iseq += length; self.icig = 0
+            elif operation in (H, P):
+                self.i += 1; self.icig = 0
+            elif operation in CIGAR_ALIGNED:
+                self.icig += 1
+                if self.icig < length:
+                    self.iseq += 1; self.iref += 1
+                    return M
+                self.i += 1; self.icig = 0
+            elif operation == I:
+                self.i += 1; self.iseq += length; self.icig = 0
+            elif operation in (D, N):
+                self.i += 1; self.icig = 0; self.iref += length
+            else:
+                return -2
+
+        self.iseq, self.iref = -1, -1
+        return -1
+
+
+def get_positions_shared_by_mates(a_start, a_cigar, a_length, b_start, b_cigar, b_length):
+    """Returns positions in read `a` and read `b` (in that order) the pileup would consider as the same
+       position of the reference when mates overlap (port of the walk in `tweak_overlap_quality`
+       in htslib). `a` is the mate that appears first in the BAM file."""
+    a_positions, b_positions = [], []
+
+    a, b = CigarWalker(a_cigar), CigarWalker(b_cigar)
+
+    iref = b_start
+    a_ret = a.set(iref - a_start)
+    if a_ret < 0:
+        return a_positions, b_positions
+
+    b_ret = b.set(iref - b_start)
+    if b_ret < 0:
+        return a_positions, b_positions
+
+    while True:
+        while a_ret >= 0 and a.iref >= 0 and a.iref < iref - a_start:
+            a_ret = a.next()
+        if a_ret < 0:
+            break
+        if iref < a.iref + a_start:
+            iref = a.iref + a_start
+
+        while b_ret >= 0 and b.iref >= 0 and b.iref < iref - b_start:
+            b_ret = b.next()
+        if b_ret < 0:
+            break
+        if iref < b.iref + b_start:
+            iref = b.iref + b_start
+
+        iref += 1
+        if a.iref + a_start != b.iref + b_start:
+            continue
+
+        if a.iseq >= a_length or b.iseq >= b_length:
+            break
+
+        a_positions.append(a.iseq)
+        b_positions.append(b.iseq)
+
+    return a_positions, b_positions
+
+
+class SplitPileup:
+    """A single-pass pileup engine for a split.
+
+       This is the fallback for `SplitPileupFromReads` for splits that are too deep for the pileup
+       to report every read (see `PILEUP_MAX_DEPTH`). It goes through the pileup of a given split
+       only once, and collects both the coverage value for each nucleotide position (`self.c`), and
+       the frequency of each nucleotide observed in every column (`self.nt_counts`, see
+       `variability.nt_counts_order` for the order of columns). The pileup it goes through holds on
+       to every read (see `SPLIT_PILEUP_MAX_DEPTH`), so coverage values are never truncated.
+
+       If `max_depth` is set, nucleotides of columns in which more reads than that report a nucleotide
+       are counted only for `max_depth` of those reads, picked at random. The number of reads that
+       report a nucleotide in each column before this cap is kept in `self.nt_depths`."""
+    def __init__(self, split, skip_SNV_profiling = False, max_depth = 0):
+        self.split = split
+        self.skip_SNV_profiling = skip_SNV_profiling
+        self.max_depth = max_depth
+        self.num_capped_columns = 0
+
+        self.c = numpy.zeros(split.length, dtype = numpy.uint32)
+        self.nt_counts = None if skip_SNV_profiling else numpy.zeros((split.length, len(nt_counts_order)), dtype = numpy.uint32)
+        self.nt_depths = None if skip_SNV_profiling else numpy.zeros(split.length, dtype = numpy.uint32)
+
+
+    def run(self, bam):
+        split = self.split
+
+        random_state = numpy.random.RandomState(get_sampling_seed(split)) if self.max_depth else None
+
+        for pileupcolumn in bam.pileup(split.parent, split.start, split.end, max_depth = SPLIT_PILEUP_MAX_DEPTH):
+            pos_in_contig = pileupcolumn.pos
+            if pos_in_contig < split.start or pos_in_contig >= split.end:
+                continue
+
+            pos_in_split = pos_in_contig - split.start
+            self.c[pos_in_split] = pileupcolumn.n
+
+            if self.skip_SNV_profiling:
+                continue
+
+            pileupreads = [p for p in pileupcolumn.pileups if not p.is_del and not p.is_refskip]
+            self.nt_depths[pos_in_split] = len(pileupreads)
+
+            # getting the sequence of a read is the expensive bit here, so in columns that are deeper than
+            # max depth we only look at the reads in the sample:
+            if self.max_depth and len(pileupreads) > self.max_depth:
+                pileupreads = [pileupreads[i] for i in random_state.choice(len(pileupreads), self.max_depth, replace = False)]
+                self.num_capped_columns += 1
+
+            nt_counts = self.nt_counts[pos_in_split]
+            for pileupread in pileupreads:
+                nt_counts[NT_INDEX[ord(pileupread.alignment.seq[pileupread.query_position])]] += 1
+
+
+class SplitPileupFromReads:
+    """Fills in the same `self.c` and `self.nt_counts` as `SplitPileup`, without the pileup.
+
+       Every read that overlaps with the split is visited only once. Sequences and base qualities
+       of all reads are concatenated, and aligned nucleotides from all reads are added to the
+       nucleotide count matrix of the split at once. Coverage values come from the start and end
+       positions of the same reads (see `get_coverage_from_reads`).
+
+       To report the same nucleotides the pileup would, nucleotides with low base qualities are
+       ignored, and base qualities of overlapping mates are adjusted the way the pileup adjusts
+       them (so a fragment is not counted twice where its mates overlap).
+
+       Columns deeper than `max_depth` are capped as in `SplitPileup`. Here nucleotides of all reads are
+       counted at once anyway, so the sample is drawn from the counts of capped columns (see
+       `variability.get_depth_capped_nt_counts`).
+
+       If the split is too deep for a pileup with `pileup_max_depth` to report every read,
+       `self.is_identical_to_pileup` is set to False, and the caller should use `SplitPileup` instead."""
+    def __init__(self, split, skip_SNV_profiling = False, max_depth = 0, pileup_max_depth = PILEUP_MAX_DEPTH):
+        self.split = split
+        self.skip_SNV_profiling = skip_SNV_profiling
+        self.max_depth = max_depth
+        self.pileup_max_depth = pileup_max_depth
+        self.num_capped_columns = 0
+
+        self.c = numpy.zeros(split.length, dtype = numpy.uint32)
+        self.nt_counts = None if skip_SNV_profiling else numpy.zeros((split.length, len(nt_counts_order)), dtype = numpy.uint32)
+        self.nt_depths = None if skip_SNV_profiling else numpy.zeros(split.length, dtype = numpy.uint32)
+        self.is_identical_to_pileup = True
+
+        # reads that contribute nucleotides:
+        self.reads = []
+        self.sequences = []
+        self.qualities = []
+        self.sequences_length = 0
+
+        # aligned blocks of all reads:
+        self.block_starts_in_contig = []
+        self.block_starts_in_sequences = []
+        self.block_lengths = []
+
+        # mates that overlap, mates that are waiting for their partners to show up (by read name), and
+        # where reads with each name end:
+        self.mates = []
+        self.mates_waiting = {}
+        self.read_ends = {}
+
+
+    def run(self, bam):
+        split = self.split
+
+        starts, ends = [], []
+        previous_start = -1
+
+        for read in bam.fetch(split.parent, split.start, split.end):
+            if not is_read_in_pileup(read):
+                continue
+
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+
+            if not self.skip_SNV_profiling:
+                self.add_read(read, previous_start)
+
+            previous_start = read.reference_start
+
+        if not starts:
+            return
+
+        self.c, self.is_identical_to_pileup = get_coverage_from_reads(starts, ends, split.start, split.end, self.pileup_max_depth)
+
+        if not self.skip_SNV_profiling and self.is_identical_to_pileup and self.reads:
+            self.count_nucleotides()
+
+        self.reads, self.sequences, self.qualities, self.mates = [], [], [], []
+        self.block_starts_in_contig, self.block_starts_in_sequences, self.block_lengths = [], [], []
+        self.mates_waiting, self.read_ends = {}, {}
+
+
+    def add_read(self, read, previous_start):
+        read_name = read.query_name
+        read_ends = self.read_ends.setdefault(read_name, [])
+
+        sequence = read.query_sequence
+        if not sequence:
+            read_ends.append(read.reference_end)
+            return
+
+        qualities = read.query_qualities
+        qualities = qualities.tostring() if qualities is not None else '\xff' * len(sequence)
+
+        read_index = len(self.reads)
+        self.reads.append((read.reference_start, read.cigartuples, len(sequence), self.sequences_length))
+        self.sequences.append(sequence)
+        self.qualities.append(qualities)
+
+        pos_in_contig = read.reference_start
+        pos_in_read = 0
+        for operation, length in read.cigartuples:
+            if operation in CIGAR_ALIGNED:
+                self.block_starts_in_contig.append(pos_in_contig)
+                self.block_starts_in_sequences.append(self.sequences_length + pos_in_read)
+                self.block_lengths.append(length)
+
+            if operation in CIGAR_CONSUMES_REFERENCE:
+                pos_in_contig += length
+            if operation in CIGAR_CONSUMES_READ:
+                pos_in_read += length
+
+        self.sequences_length += len(sequence)
+
+        # the pileup pairs a read with the mate it has seen before, unless it has already forgotten about
+        # that mate. it forgets about a name once the pileup moves beyond the end of ANY read with that name
+        # (i.e., the mate itself, but also a supplementary alignment, or a mate that was never waiting):
+        is_candidate = is_mate_overlap_candidate(read)
+        mate = self.mates_waiting.pop(read_name, None) if is_candidate else None
+        if mate and [e for e in read_ends if mate[1] <= e < previous_start]:
+            mate = None
+
+        read_ends.append(read.reference_end)
+
+        if not is_candidate:
+            return
+
+        if mate:
+            self.mates.append((mate[0], read_index))
+        else:
+            self.mates_waiting[read_name] = (read_index, previous_start)
+
+
+    def adjust_qualities_of_overlapping_mates(self, sequences, qualities):
+        """Where mates overlap, the pileup keeps the nucleotide from only one of them: if they agree, the
+           first mate gets the sum of both base qualities, otherwise the one with the higher base quality
+           wins with 80% of its quality. The base quality of the other one becomes 0."""
+        a_positions, b_positions = [], []
+
+        # when both mates are aligned as a single block, positions they share are simply the ones between
+        # the start of the second mate and the end of whichever ends first. we collect those to deal with
+        # them all at once, and walk through the cigars of the others:
+        a_starts_of_shared, b_starts_of_shared, lengths_of_shared = [], [], []
+
+        for a_index, b_index in self.mates:
+            a_start, a_cigar, a_length, a_offset = self.reads[a_index]
+            b_start, b_cigar, b_length, b_offset = self.reads[b_index]
+
+            a_block = get_single_aligned_block(a_cigar)
+            b_block = get_single_aligned_block(b_cigar)
+
+            if a_block and b_block:
+                length_of_shared = min(a_start + a_block[1], b_start + b_block[1]) - b_start
+                if length_of_shared > 0:
+                    a_starts_of_shared.append(a_offset + a_block[0] + b_start - a_start)
+                    b_starts_of_shared.append(b_offset + b_block[0])
+                    lengths_of_shared.append(length_of_shared)
+            else:
+                a, b = get_positions_shared_by_mates(a_start, a_cigar, a_length, b_start, b_cigar, b_length)
+                if a:
+                    a_positions.append(numpy.array(a) + a_offset)
+                    b_positions.append(numpy.array(b) + b_offset)
+
+        if lengths_of_shared:
+            a_positions.append(get_concatenated_ranges(a_starts_of_shared, lengths_of_shared))
+            b_positions.append(get_concatenated_ranges(b_starts_of_shared, lengths_of_shared))
+
+        if not a_positions:
+            return
+
+        a_positions = numpy.concatenate(a_positions)
+        b_positions = numpy.concatenate(b_positions)
+
+        a_qualities = qualities[a_positions].astype(numpy.int64)
+        b_qualities = qualities[b_positions].astype(numpy.int64)
+
+        agree = sequences[a_positions] == sequences[b_positions]
+        a_wins = a_qualities >= b_qualities
+
+        qualities[a_positions] = numpy.where(agree, numpy.minimum(a_qualities + b_qualities, 200),
+                                             numpy.where(a_wins, (0.8 * a_qualities).astype(numpy.int64), 0))
+        qualities[b_positions] = numpy.where(agree | a_wins, 0, (0.8 * b_qualities).astype(numpy.int64))
+
+
+    def count_nucleotides(self):
+        split = self.split
+        num_nts = len(nt_counts_order)
+
+        sequences = numpy.frombuffer(''.join(self.sequences), dtype = numpy.uint8)
+        qualities = numpy.frombuffer(''.join(self.qualities), dtype = numpy.uint8).copy()
+
+        self.adjust_qualities_of_overlapping_mates(sequences, qualities)
+
+        positions_in_contig = get_concatenated_ranges(self.block_starts_in_contig, self.block_lengths)
+        positions_in_sequences = get_concatenated_ranges(self.block_starts_in_sequences, self.block_lengths)
+
+        reported = (positions_in_contig >= split.start) & (positions_in_contig < split.end) & \
+                   (qualities[positions_in_sequences] >= PILEUP_MIN_BASE_QUALITY)
+
+        positions_in_split = positions_in_contig[reported] - split.start
+        nt_indices = NT_INDEX[sequences[positions_in_sequences[reported]]]
+
+        self.nt_counts = numpy.bincount(positions_in_split * num_nts + nt_indices, minlength = split.length * num_nts)\
+                                        .reshape(split.length, num_nts).astype(numpy.uint32)
+        self.nt_depths = self.nt_counts.sum(axis = 1).astype(numpy.uint32)
+
+        if self.max_depth:
+            self.nt_counts, capped = get_depth_capped_nt_counts(self.nt_counts, self.max_depth, seed = get_sampling_seed(split))
+            self.num_capped_columns = int(capped.sum())
+
+
+class ContigCoverageFromReads:
+    """A coverage-only engine for a contig.
+
+       Coverage of a position in the pileup is simply the number of reads that start at or before
+       that position, and end after it. So instead of walking through every column of the pileup,
+       this class goes through the reads of a contig only once, and recovers coverage values for
+       the entire contig from their start and end positions (see `get_coverage_from_reads`).
+
+       Contigs that are too deep for a pileup with `pileup_max_depth` to report every read are marked
+       with `self.is_identical_to_pileup = False`, so the caller can fall back to the pileup for them."""
+    def __init__(self, contig, pileup_max_depth = PILEUP_MAX_DEPTH):
+        self.contig = contig
+        self.pileup_max_depth = pileup_max_depth
+
+        self.c = numpy.zeros(contig.length, dtype = numpy.uint32)
+        self.is_identical_to_pileup = True
+
+
+    def run(self, bam):
+        starts, ends = [], []
+
+        for read in bam.fetch(self.contig.name, 0, self.contig.length):
+            if not is_read_in_pileup(read):
+                continue
+
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+
+        if not starts:
+            return
+
+        self.c, self.is_identical_to_pileup = get_coverage_from_reads(starts, ends, 0, self.contig.length, self.pileup_max_depth)
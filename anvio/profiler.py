@@ -3,12 +3,19 @@
 
 import os
 import sys
+import glob
+import h5py
+import time
 import pysam
+import Queue
 import shutil
+import multiprocessing
 
 import anvio
 import anvio.dbops as dbops
 import anvio.utils as utils
+import anvio.tables as tables
+import anvio.pileup as pileup
 import anvio.dictio as dictio
 import anvio.terminal as terminal
 import anvio.contigops as contigops
@@ -39,6 +46,7 @@ class BAMProfiler(dbops.ContigsSuperclass):
     def __init__(self, args = None):
         self.args = None
         self.input_file_path = None 
+        self.input_file_paths = []
         self.contigs_db_path = None
         self.serialized_profile_path = None 
         self.output_directory = None 
@@ -46,15 +54,22 @@ class BAMProfiler(dbops.ContigsSuperclass):
         self.min_contig_length = 10000 
         self.min_mean_coverage = 0
         self.min_coverage_for_variability = 10 # if a nucleotide position is covered less than this, don't bother
+        self.max_depth_for_SNV_profiling = 0 # if a nucleotide position is covered more than this, only look at this many reads
         self.contig_names_of_interest = None
         self.contigs_shall_be_clustered = False
         self.report_variability_full = False # don't apply any noise filtering, and simply report ALL base frequencies
         self.overwrite_output_destinations = False
         self.skip_SNV_profiling = False
+        self.skip_serialized_profile = False
+        self.checkpoint = False
+        self.resume = False
+        self.shard = None
+        self.num_threads = 1
 
         if args:
             self.args = args
-            self.input_file_path = args.input_file
+            self.input_file_paths = (args.input_file if type(args.input_file) == list else [args.input_file]) if args.input_file else []
+            self.input_file_path = self.input_file_paths[0] if self.input_file_paths else None
             self.contigs_db_path = args.contigs_db
             self.serialized_profile_path = args.serialized_profile
             self.output_directory = args.output_dir
@@ -62,13 +77,17 @@ class BAMProfiler(dbops.ContigsSuperclass):
             self.min_contig_length = args.min_contig_length
             self.min_mean_coverage = args.min_mean_coverage
             self.min_coverage_for_variability = args.min_coverage_for_variability
+            self.max_depth_for_SNV_profiling = args.max_depth_for_SNV_profiling
             self.contigs_shall_be_clustered = args.cluster_contigs
-            self.number_of_threads = 4 
-            self.no_trehading = True
+            self.num_threads = args.num_threads
             self.sample_id = args.sample_name
             self.report_variability_full = args.report_variability_full
             self.overwrite_output_destinations = args.overwrite_output_destinations
             self.skip_SNV_profiling = args.skip_SNV_profiling
+            self.skip_serialized_profile = args.skip_serialized_profile
+            self.checkpoint = args.checkpoint or args.resume
+            self.resume = args.resume
+            self.shard = args.shard
 
             if args.contigs_of_interest:
                 if not os.path.exists(args.contigs_of_interest):
@@ -89,20 +108,32 @@ class BAMProfiler(dbops.ContigsSuperclass):
         self.init_contig_sequences()
         self.contig_names_in_contigs_db = set(self.contigs_basic_info.keys())
 
+        self.database_paths = {'CONTIGS.db': self.contigs_db_path}
+
+        self.clustering_configs = constants.clustering_configs['single']
+
+        # profiles of contigs are written as they come, but db entries are sent to the database in batches:
+        self.max_num_db_entries_in_memory = 100000
+
+        # when checkpointing, a new checkpoint file is started once the current one is this old (in seconds):
+        self.checkpoint_interval = 300
+
+        self.init_profile_state()
+
+
+    def init_profile_state(self):
+        """Everything that belongs to a single profile, and has to start over for every BAM file when more than
+           one of them are profiled with the same contigs database (see `profile_multiple_BAM_files`)."""
         self.bam = None
         self.contigs = {}
 
-        self.database_paths = {'CONTIGS.db': self.contigs_db_path}
-
         self.profile_db_path = None
-
-        self.clustering_configs = constants.clustering_configs['single']
+        self.serialized_profile_reader = None
 
         self.atomic_contig_split_data = contigops.AtomicContigSplitData(self.progress)
 
-        # following variable will be populated during the profiling, and its content will eventually
-        # be stored in t.variable_nts_table_name
-        self.variable_nts_table_entries = []
+        self.checkpoint_file = None
+        self.num_checkpoints = 0
 
 
     def init_dirs_and_dbs(self):
@@ -112,17 +143,35 @@ class BAMProfiler(dbops.ContigsSuperclass):
                                 tutorial: http://merenlab.org/2015/05/02/anvio-tutorial/"
 
         self.output_directory = filesnpaths.check_output_directory(self.output_directory or self.input_file_path + '-ANVIO_PROFILE',\
-                                                                   ok_if_exists = self.overwrite_output_destinations)
+                                                                   ok_if_exists = self.overwrite_output_destinations or self.resume)
+        self.checkpoints_directory = self.generate_output_destination('CHECKPOINTS')
 
         self.progress.new('Initializing')
 
-        self.progress.update('Creating the output directory ...')
-        filesnpaths.gen_output_directory(self.output_directory, self.progress, delete_if_exists = self.overwrite_output_destinations)
+        if self.resume:
+            self.progress.update('Cleaning up the output directory of the previous run ...')
+            self.clean_output_directory_for_resume()
+        else:
+            self.progress.update('Creating the output directory ...')
+            filesnpaths.gen_output_directory(self.output_directory, self.progress, delete_if_exists = self.overwrite_output_destinations)
 
-        self.progress.update('Creating a new single profile database with contigs hash "%s" ...' % self.a_meta['contigs_db_hash'])
+        self.progress.update('Creating a new profile database with contigs hash "%s" ...' % self.a_meta['contigs_db_hash'])
         self.profile_db_path = self.generate_output_destination('PROFILE.db')
         profile_db = dbops.ProfileDatabase(self.profile_db_path)
+        profile_db.create(self.get_profile_db_meta_values())
+
+        if self.skip_SNV_profiling:
+            self.run.warning('Single-nucleotide variation will not be characterized for this profile.')
+
+        if not pileup.PYSAM_VERSION_IS_VERIFIED:
+            self.run.warning("You have pysam %s, which is not a version anvi'o can recover the pileup from reads\
+                              for. All splits will go through the pileup instead, which gives the same profile,\
+                              but takes much longer. Installing pysam 0.15 would make profiling faster." % pysam.__version__)
+
+        self.progress.end()
+
 
+    def get_profile_db_meta_values(self):
         meta_values = {'db_type': 'profile',
                        'anvio': __version__,
                        'sample_id': self.sample_id,
@@ -136,17 +185,49 @@ class BAMProfiler(dbops.ContigsSuperclass):
                        'report_variability_full': self.report_variability_full,
                        'contigs_db_hash': self.a_meta['contigs_db_hash'],
                        'gene_coverages_computed': self.a_meta['genes_are_called']}
-        profile_db.create(meta_values)
 
-        if self.skip_SNV_profiling:
-            self.run.warning('Single-nucleotide variation will not be characterized for this profile.')
+        # partial profiles know which shard they are (see `anvi-merge-shards`):
+        if self.shard:
+            meta_values['shard'] = self.shard
 
-        self.progress.end()
+        return meta_values
 
 
     def _run(self):
         self.check_args()
 
+        if len(self.input_file_paths) > 1:
+            self.profile_multiple_BAM_files()
+        else:
+            self.profile_single_input()
+
+
+    def profile_multiple_BAM_files(self):
+        """Profiles every BAM file one after the other, each into its own output directory. The contigs database
+           is read only once (in `__init__`) for all of them, which is the most expensive part of getting ready
+           to profile a BAM file for large assemblies."""
+        input_file_paths = [os.path.abspath(p) for p in self.input_file_paths]
+        parent_output_directory = self.output_directory
+
+        if parent_output_directory:
+            parent_output_directory = filesnpaths.check_output_directory(parent_output_directory, ok_if_exists = True)
+            filesnpaths.gen_output_directory(parent_output_directory)
+
+        for i in range(0, len(input_file_paths)):
+            self.init_profile_state()
+
+            self.run = terminal.Run(width=35)
+            self.input_file_path = input_file_paths[i]
+            self.sample_id = None
+            self.set_sample_id()
+            self.output_directory = os.path.join(parent_output_directory, self.sample_id) if parent_output_directory else None
+
+            self.run.warning('', header = 'Profiling BAM file %d of %d: %s' % (i + 1, len(input_file_paths), self.input_file_path), lc = 'green')
+
+            self.profile_single_input()
+
+
+    def profile_single_input(self):
         self.set_sample_id()
 
         self.init_dirs_and_dbs()
@@ -164,7 +245,12 @@ class BAMProfiler(dbops.ContigsSuperclass):
         self.run.info('min_mean_coverage', self.min_mean_coverage)
         self.run.info('clustering_performed', self.contigs_shall_be_clustered)
         self.run.info('min_coverage_for_variability', self.min_coverage_for_variability)
+        self.run.info('max_depth_for_SNV_profiling', self.max_depth_for_SNV_profiling or None)
         self.run.info('skip_SNV_profiling', self.skip_SNV_profiling)
+        self.run.info('num_threads', self.num_threads, display_only = True)
+        if self.shard:
+            self.run.info('shard', self.shard)
+        self.run.info('checkpoint', self.checkpoint, display_only = True)
         self.run.info('report_variability_full', self.report_variability_full)
         self.run.info('gene_coverages_computed', self.a_meta['genes_are_called'])
 
@@ -172,18 +258,20 @@ class BAMProfiler(dbops.ContigsSuperclass):
         # profile...
         if self.input_file_path:
             self.init_profile_from_BAM()
+            self.init_profile_outputs()
+            self.init_checkpoints()
             self.profile()
-            self.store_profile()
+            self.close_checkpoints()
         else:
             self.init_serialized_profile()
+            self.init_profile_outputs()
+            self.store_contigs_from_serialized_profile()
 
-        self.generate_variabile_positions_table()
-        self.generate_gene_coverages_table()
-        self.store_split_coverages()
+        self.close_profile_outputs()
 
         # here we store atomic data for contigs and splits into the database:
         profile_db = dbops.ProfileDatabase(self.profile_db_path, quiet=True)
-        self.atomic_contig_split_data.store_atomic_data_for_contigs_and_splits(self.sample_id, self.contigs, profile_db.db)
+        self.atomic_contig_split_data.store_atomic_data_for_contigs_and_splits(profile_db.db)
         profile_db.disconnect()
 
         # the only view for the single PROFILE database is ready, and already
@@ -199,79 +287,262 @@ class BAMProfiler(dbops.ContigsSuperclass):
         self.run.info('runinfo', runinfo_serialized)
         self.run.store_info_dict(runinfo_serialized, strip_prefix = self.output_directory)
 
+        # the profile is complete, and checkpoints are no longer needed:
+        if self.checkpoint:
+            shutil.rmtree(self.checkpoints_directory)
+
         self.run.quit()
 
 
-    def generate_variabile_positions_table(self):
-        if self.skip_SNV_profiling:
-            # there is nothing to generate really..
-            self.run.info('variable_nts_table', False, quiet = True)
+    def init_profile_outputs(self):
+        """Everything about a contig is written to the output files as soon as the contig is profiled (see
+           `store_contig`), so profiles of contigs do not have to be kept in memory until the end."""
+        self.num_contigs_stored = 0
+        self.num_columns_capped_for_SNV_profiling = 0
+
+        self.variable_nts_table = None
+        if not self.skip_SNV_profiling:
+            self.variable_nts_table = dbops.TableForVariability(self.profile_db_path, anvio.__profile__version__, progress = self.progress)
+
+        self.gene_coverages_table = dbops.TableForGeneCoverages(self.profile_db_path, anvio.__profile__version__, progress = self.progress)
+
+        self.split_coverages_path = self.generate_output_destination('AUXILIARY-DATA.h5')
+        self.split_coverage_values = auxiliarydataops.AuxiliaryDataForSplitCoverages(self.split_coverages_path, self.a_meta['contigs_db_hash'], create_new = True)
+
+        # we only serialize profiles that come from BAM files:
+        self.serialized_profile = None
+        if self.input_file_path and not self.skip_serialized_profile:
+            self.serialized_profile_output_path = self.generate_output_destination('PROFILE.h5')
+            self.serialized_profile = contigops.SerializedProfile(self.serialized_profile_output_path,
+                                                                  self.a_meta['contigs_db_hash'],
+                                                                  create_new = True,
+                                                                  contig_parameters = {'split_length': self.a_meta['split_length'],
+                                                                                       'min_coverage_for_variability': self.min_coverage_for_variability,
+                                                                                       'skip_SNV_profiling': self.skip_SNV_profiling,
+                                                                                       'report_variability_full': self.report_variability_full})
+
+
+    def store_contig(self, contig):
+        """Writes everything about a profiled contig into the output files. Once this is done, the contig
+           object is no longer needed."""
+        if self.serialized_profile:
+            self.serialized_profile.append(contig)
+
+        if self.variable_nts_table:
+            self.store_variable_positions(contig, self.sample_id)
+            self.num_columns_capped_for_SNV_profiling += sum([split.auxiliary.num_capped_columns for split in contig.splits])
+
+        # if no open reading frames were found in a contig, it wouldn't have an entry in the contigs table,
+        # therefore there wouldn't be any record of it in contig_ORFs; so we better check ourselves before
+        # we wreck ourselves and the ultimately the analysis of this poor user:
+        if self.contig_name_to_genes.has_key(contig.name):
+            self.gene_coverages_table.analyze_contig(contig, self.sample_id, self.contig_name_to_genes[contig.name])
+
+        for split in contig.splits:
+            self.split_coverage_values.append(split.name, self.sample_id, split.coverage.c)
+
+        # atomic data for contigs and splits are small, but they can only be stored once every contig is
+        # known (see `AtomicContigSplitData`):
+        self.atomic_contig_split_data.add_contig(contig)
+
+        # we don't want to go to the database for every contig, but we also don't want db entries to pile up:
+        if self.variable_nts_table and len(self.variable_nts_table.db_entries) >= self.max_num_db_entries_in_memory:
+            self.variable_nts_table.store()
+
+        if len(self.gene_coverages_table.genes) >= self.max_num_db_entries_in_memory:
+            self.gene_coverages_table.store()
+
+        self.num_contigs_stored += 1
+
+
+    def store_variable_positions(self, contig, sample_id):
+        for split in contig.splits:
+            column_profiles = split.column_profiles
+            field_names = column_profiles.dtype.names
+
+            # let's figure out more about these variable positions
+            nt_position_info = self.get_nt_position_info_many(contig.name, column_profiles.pos_in_contig)
+
+            for i, record in enumerate(column_profiles.tolist()):
+                column_profile = dict(zip(field_names, record))
+
+                column_profile['in_partial_gene_call'], \
+                column_profile['in_complete_gene_call'],\
+                column_profile['pos_in_codon'] = nt_position_info[i]
+
+                column_profile['split_name'] = split.name
+                column_profile['sample_id'] = sample_id
+
+                self.variable_nts_table.append(column_profile)
+
+
+    def clean_output_directory_for_resume(self):
+        """Everything in the output directory of a resumed run is generated again from checkpoints, except the
+           checkpoints themselves."""
+        if not os.path.exists(self.checkpoints_directory):
+            self.progress.end()
+            raise ConfigError, "You asked anvi'o to resume profiling, but there are no checkpoints in the output directory\
+                                '%s'. Maybe the previous run was not started with '--checkpoint', or maybe it is not the\
+                                right output directory?" % self.output_directory
+
+        for file_name in os.listdir(self.output_directory):
+            path = os.path.join(self.output_directory, file_name)
+            if path == self.checkpoints_directory:
+                continue
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+        # these are the checkpoints the previous run was writing when it died:
+        for path in glob.glob(os.path.join(self.checkpoints_directory, '*.tmp')):
+            os.remove(path)
+
+
+    def get_checkpoint_parameters(self):
+        """Parameters that would change the profile of a contig. A run can only be resumed from checkpoints that
+           were written with the same ones."""
+        return {'sample_id': self.sample_id,
+                'input_bam': os.path.basename(self.input_file_path),
+                'min_mean_coverage': self.min_mean_coverage,
+                'max_depth_for_SNV_profiling': self.max_depth_for_SNV_profiling}
+
+
+    def get_contig_parameters(self):
+        return {'split_length': self.a_meta['split_length'],
+                'min_coverage_for_variability': self.min_coverage_for_variability,
+                'skip_SNV_profiling': self.skip_SNV_profiling,
+                'report_variability_full': self.report_variability_full}
+
+
+    def init_checkpoints(self):
+        """Contigs found in the checkpoints of a previous run are stored from there rather than profiled again."""
+        self.contig_names_in_checkpoints = set([])
+
+        if not self.checkpoint:
             return
 
-        variable_nts_table = dbops.TableForVariability(self.profile_db_path, anvio.__profile__version__, progress = self.progress)
+        if not self.resume:
+            os.makedirs(self.checkpoints_directory)
+            return
 
-        self.progress.new('Storing variability information')
-        for contig in self.contigs.values():
-            for split in contig.splits:
-                for column_profile in split.column_profiles.values():
-                    # let's figure out more about this particular variable position
-                    pos_in_contig = column_profile['pos_in_contig']
+        self.progress.new('Resuming from checkpoints')
+
+        contig_names = set(self.contig_names)
+        parameters = self.get_contig_parameters()
+        parameters.update(self.get_checkpoint_parameters())
+
+        checkpoint_paths = sorted(glob.glob(os.path.join(self.checkpoints_directory, 'CHECKPOINT-*.h5')))
+        for checkpoint_path in checkpoint_paths:
+            self.progress.update('Reading %s ...' % os.path.basename(checkpoint_path))
+            checkpoint = contigops.ProfileCheckpoint(checkpoint_path, self.a_meta['contigs_db_hash'])
+
+            for parameter in parameters:
+                value = checkpoint.get_parameter(parameter)
+                if value != parameters[parameter]:
+                    checkpoint.close()
+                    self.progress.end()
+                    raise ConfigError, "The checkpoint '%s' was written with a different '%s' (%s) than the one of this run\
+                                        (%s). You can only resume a run with the same parameters it was started with."\
+                                            % (checkpoint_path, parameter, value, parameters[parameter])
 
-                    column_profile['in_partial_gene_call'], \
-                    column_profile['in_complete_gene_call'],\
-                    column_profile['pos_in_codon'] = self.get_nt_position_info(contig.name, pos_in_contig)
+            for contig_name in checkpoint.contig_names:
+                if contig_name in contig_names:
+                    self.store_contig(checkpoint.get(contig_name))
+                    self.contig_names_in_checkpoints.add(contig_name)
 
-                    column_profile['sample_id'] = self.sample_id
+            self.contig_names_in_checkpoints.update([c for c in checkpoint.discarded_contig_names if c in contig_names])
+            self.num_columns_capped_for_SNV_profiling += checkpoint.num_columns_capped_for_SNV_profiling
 
-                    variable_nts_table.append(column_profile)
+            checkpoint.close()
+
+        self.num_checkpoints = len(checkpoint_paths)
 
-        variable_nts_table.store()
         self.progress.end()
-        self.run.info('variable_nts_table', True, quiet = True)
+
+        self.run.info('num_checkpoints_found', pp(len(checkpoint_paths)))
+        self.run.info('num_contigs_resumed_from_checkpoints', pp(len(self.contig_names_in_checkpoints)))
 
 
-    def generate_gene_coverages_table(self):
-        gene_coverages_table = dbops.TableForGeneCoverages(self.profile_db_path, anvio.__profile__version__, progress = self.progress)
+    def add_to_checkpoint(self, contig_name, contig):
+        """Records a profiled contig (or the fact that `contig_name` was discarded, if `contig` is None) in the
+           current checkpoint, and starts a new checkpoint if the current one is old enough to be closed."""
+        if not self.checkpoint:
+            return
 
-        self.progress.new('Profiling genes')
-        num_contigs = len(self.contigs)
-        contig_names = self.contigs.keys()
-        for i in range(0, num_contigs):
-            contig = contig_names[i]
-            self.progress.update('Processing contig %d of %d' % (i + 1, num_contigs))
-            # if no open reading frames were found in a contig, it wouldn't have an entry in the contigs table,
-            # therefore there wouldn't be any record of it in contig_ORFs; so we better check ourselves before
-            # we wreck ourselves and the ultimately the analysis of this poor user:
-            if self.contig_name_to_genes.has_key(contig):
-                gene_coverages_table.analyze_contig(self.contigs[contig], self.sample_id, self.contig_name_to_genes[contig])
+        if not self.checkpoint_file:
+            self.num_checkpoints += 1
+            checkpoint_path = os.path.join(self.checkpoints_directory, 'CHECKPOINT-%06d.h5' % self.num_checkpoints)
+            self.checkpoint_file = contigops.ProfileCheckpoint(checkpoint_path,
+                                                               self.a_meta['contigs_db_hash'],
+                                                               create_new = True,
+                                                               contig_parameters = self.get_contig_parameters(),
+                                                               checkpoint_parameters = self.get_checkpoint_parameters())
+            self.checkpoint_file_opened_at = time.time()
+
+        if contig:
+            self.checkpoint_file.append(contig)
+            self.checkpoint_file.num_columns_capped_for_SNV_profiling += sum([split.auxiliary.num_capped_columns for split in contig.splits if split.auxiliary])
+        else:
+            self.checkpoint_file.discard(contig_name)
+
+        if time.time() - self.checkpoint_file_opened_at > self.checkpoint_interval:
+            self.close_checkpoints()
+
+
+    def close_checkpoints(self):
+        if self.checkpoint_file:
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+
+
+    def store_contigs_from_serialized_profile(self):
+        self.progress.new('Storing profile')
+
+        num_contigs = len(self.contig_names)
+        for contig_name in self.contig_names:
+            self.progress.update('Processing contig %s of %s' % (pp(self.num_contigs_stored + 1), pp(num_contigs)))
+
+            if self.serialized_profile_reader:
+                contig = self.serialized_profile_reader.get(contig_name)
+            else:
+                contig = self.contigs.pop(contig_name)
+
+            self.store_contig(contig)
 
-        gene_coverages_table.store()
         self.progress.end()
-        self.run.info('gene_coverages_table', True, quiet = True)
 
 
-    def store_split_coverages(self):
-        output_file = self.generate_output_destination('AUXILIARY-DATA.h5')
-        split_coverage_values = auxiliarydataops.AuxiliaryDataForSplitCoverages(output_file, self.a_meta['contigs_db_hash'], create_new = True)
+    def close_profile_outputs(self):
+        self.progress.new('Finalizing profile outputs')
+        self.progress.update('...')
+
+        if self.variable_nts_table:
+            self.variable_nts_table.store()
+        self.run.info('variable_nts_table', self.variable_nts_table is not None, quiet = True)
 
-        self.progress.new('Storing split coverages')
+        self.gene_coverages_table.store()
+        self.run.info('gene_coverages_table', True, quiet = True)
 
-        contigs_counter = 1
-        for contig_name in self.contigs:
-            self.progress.update('working on contig %s of %s' % (pp(contigs_counter), pp(len(self.contigs))))
+        self.split_coverage_values.close()
 
-            for split in self.contigs[contig_name].splits:
-                split_coverage_values.append(split.name, self.sample_id, split.coverage.c)
+        if self.serialized_profile:
+            self.serialized_profile.close()
 
-            contigs_counter += 1
+        if self.serialized_profile_reader:
+            self.serialized_profile_reader.close()
 
         self.progress.end()
 
-        split_coverage_values.close()
+        if self.serialized_profile:
+            self.run.info('profile_dict', self.serialized_profile_output_path)
 
-        self.run.info('split_coverage_values', 'stored in %s' % output_file, display_only = True)
+        self.run.info('split_coverage_values', 'stored in %s' % self.split_coverages_path, display_only = True)
         self.run.info('split_coverage_values', True, quiet = True)
 
+        if self.max_depth_for_SNV_profiling and self.variable_nts_table:
+            self.run.info('num_columns_capped_for_SNV_profiling', self.num_columns_capped_for_SNV_profiling)
+
 
     def set_sample_id(self):
         if self.sample_id:
@@ -279,17 +550,23 @@ class BAMProfiler(dbops.ContigsSuperclass):
         else:
             if self.input_file_path:
                 self.input_file_path = os.path.abspath(self.input_file_path)
-                self.sample_id = os.path.basename(self.input_file_path).upper().split('.BAM')[0]
-                self.sample_id = self.sample_id.replace('-', '_')
-                self.sample_id = self.sample_id.replace('.', '_')
-                if self.sample_id[0] in constants.digits:
-                    self.sample_id = 's' + self.sample_id
-                utils.check_sample_id(self.sample_id)
+                self.sample_id = self.get_sample_id_from_BAM_file_path(self.input_file_path)
             if self.serialized_profile_path:
                 self.serialized_profile_path = os.path.abspath(self.serialized_profile_path)
                 self.sample_id = os.path.basename(os.path.dirname(self.serialized_profile_path))
 
 
+    def get_sample_id_from_BAM_file_path(self, input_file_path):
+        sample_id = os.path.basename(input_file_path).upper().split('.BAM')[0]
+        sample_id = sample_id.replace('-', '_')
+        sample_id = sample_id.replace('.', '_')
+        if sample_id[0] in constants.digits:
+            sample_id = 's' + sample_id
+        utils.check_sample_id(sample_id)
+
+        return sample_id
+
+
     def check_contigs_without_any_gene_calls(self, contig_names):
         if not self.a_meta['genes_are_called']:
             self.run.warning("The contigs database '%s' does not contain any gene calls. Which means the profiling step\
@@ -310,41 +587,52 @@ class BAMProfiler(dbops.ContigsSuperclass):
                                       (P(len(contigs_without_any_gene_calls)), random.choice(contigs_without_any_gene_calls)))
 
 
-    def init_serialized_profile(self):
+    def read_serialized_profile(self, ignore_hash = False):
+        """Sets `self.contig_names` and `self.contig_lengths` for the contigs in the serialized profile. Contigs
+           themselves are read one by one later on, unless the profile is a pickled dictionary of contigs from
+           earlier versions of anvi'o, in which case it is read into `self.contigs` entirely."""
         self.progress.new('Init')
         self.progress.update('Reading serialized profile')
-        self.contigs = dictio.read_serialized_object(self.serialized_profile_path)
+
+        if h5py.is_hdf5(self.serialized_profile_path):
+            self.serialized_profile_reader = contigops.SerializedProfile(self.serialized_profile_path,
+                                                                         None if ignore_hash else self.a_meta['contigs_db_hash'],
+                                                                         ignore_hash = ignore_hash)
+            contig_lengths = self.serialized_profile_reader.contig_lengths
+        else:
+            self.contigs = dictio.read_serialized_object(self.serialized_profile_path)
+            contig_lengths = dict([(contig_name, self.contigs[contig_name].length) for contig_name in self.contigs])
+
         self.progress.end()
 
+        self.contig_names = contig_lengths.keys()
+        self.contig_lengths = [contig_lengths[contig_name] for contig_name in self.contig_names]
+
         self.run.info('profile_loaded_from', self.serialized_profile_path)
-        self.run.info('num_contigs', pp(len(self.contigs)))
+        self.run.info('num_contigs', pp(len(self.contig_names)))
 
-        if self.contig_names_of_interest:
-            contigs_to_discard = set()
-            for contig in self.contigs:
-                if contig not in self.contig_names_of_interest:
-                    contigs_to_discard.add(contig)
 
-            if len(contigs_to_discard):
-                for contig in contigs_to_discard:
-                    self.contigs.pop(contig)
-            self.run.info('num_contigs_selected_for_analysis', pp(len(self.contigs)))
+    def init_serialized_profile(self):
+        self.read_serialized_profile()
 
-        self.check_contigs()
+        if self.contig_names_of_interest:
+            indexes = [i for i in range(0, len(self.contig_names)) if self.contig_names[i] in self.contig_names_of_interest]
+            self.contig_names = [self.contig_names[i] for i in indexes]
+            self.contig_lengths = [self.contig_lengths[i] for i in indexes]
+            self.run.info('num_contigs_selected_for_analysis', pp(len(self.contig_names)))
+
+        self.check_contigs(len(self.contig_names))
 
         # it brings good karma to let the user know what the hell is wrong with their data:
-        self.check_contigs_without_any_gene_calls(self.contigs.keys())
+        self.check_contigs_without_any_gene_calls(self.contig_names)
 
-        contigs_to_discard = set()
-        for contig in self.contigs.values():
-            if contig.length < self.min_contig_length:
-                contigs_to_discard.add(contig.name)
-        if len(contigs_to_discard):
-            for contig in contigs_to_discard:
-                self.contigs.pop(contig)
-            self.run.info('contigs_raw_longer_than_M', len(self.contigs))
+        contigs_longer_than_M = [i for i in range(0, len(self.contig_names)) if self.contig_lengths[i] >= self.min_contig_length]
+        if len(contigs_longer_than_M) < len(self.contig_names):
+            self.contig_names = [self.contig_names[i] for i in contigs_longer_than_M]
+            self.contig_lengths = [self.contig_lengths[i] for i in contigs_longer_than_M]
+            self.run.info('contigs_raw_longer_than_M', len(self.contig_names))
 
-        self.check_contigs()
+        self.check_contigs(len(self.contig_names))
 
 
     def list_contigs(self):
@@ -366,15 +654,10 @@ class BAMProfiler(dbops.ContigsSuperclass):
                 print '%-40s %s' % (tpl[1], pp(int(tpl[0])))
 
         else:
-            self.progress.new('Init')
-            self.progress.update('Reading serialized profile')
-            self.contigs = dictio.read_serialized_object(self.serialized_profile_path)
-            self.progress.end()
+            # the contigs database is not initialized yet, so we can't check the hash:
+            self.read_serialized_profile(ignore_hash = True)
 
-            self.run.info('profile_loaded_from', self.serialized_profile_path)
-            self.run.info('num_contigs', pp(len(self.contigs)))
-
-            for tpl in sorted([(int(self.contigs[contig].length), contig) for contig in self.contigs]):
+            for tpl in sorted(zip([int(l) for l in self.contig_lengths], self.contig_names)):
                 print '%-40s %s' % (tpl[1], pp(int(tpl[0])))
 
 
@@ -405,6 +688,12 @@ class BAMProfiler(dbops.ContigsSuperclass):
         self.run.info('total_reads_mapped', pp(int(self.num_reads_mapped)))
         self.run.info('num_contigs', pp(len(self.contig_names)))
 
+        self.select_contigs_and_splits()
+
+
+    def select_contigs_and_splits(self):
+        """Narrows `self.contig_names` (which are the contigs in the BAM file at this point) down to the ones that
+           will be profiled, finds their splits, and records what is left in the profile database."""
         if self.contig_names_of_interest:
             indexes = [self.contig_names.index(r) for r in self.contig_names_of_interest if r in self.contig_names]
             self.contig_names = [self.contig_names[i] for i in indexes]
@@ -425,6 +714,10 @@ class BAMProfiler(dbops.ContigsSuperclass):
         else:
             self.contig_names = [self.contig_names[i] for i in contigs_longer_than_M]
             self.contig_lengths = [self.contig_lengths[i] for i in contigs_longer_than_M]
+
+            if self.shard:
+                self.contig_names, self.contig_lengths = self.get_contigs_in_shard(self.contig_names, self.contig_lengths)
+
             self.num_contigs = len(self.contig_names)    # we will store these two
             self.total_length = sum(self.contig_lengths) # into the db in a second.
 
@@ -474,6 +767,46 @@ class BAMProfiler(dbops.ContigsSuperclass):
         profile_db.disconnect()
 
 
+    def get_contigs_in_shard(self, contig_names, contig_lengths):
+        """Distributes contigs to shards so every shard gets about the same number of nucleotides, and returns
+           the names and lengths of the ones that belong to this shard.
+
+           Contigs are given to the shard with the smallest total length so far, from the longest contig to the
+           shortest (ties are broken by name), so every run with the same contigs ends up with the same shards."""
+        shard_index, num_shards = self.get_shard_index_and_num_shards()
+
+        shard_lengths = [0] * num_shards
+        contigs_in_shard = []
+        for contig_length, contig_name in sorted(zip(contig_lengths, contig_names), key = lambda x: (-x[0], x[1])):
+            shortest_shard = shard_lengths.index(min(shard_lengths))
+            shard_lengths[shortest_shard] += contig_length
+
+            if shortest_shard == shard_index - 1:
+                contigs_in_shard.append((contig_name, contig_length))
+
+        if not contigs_in_shard:
+            raise ConfigError, "There are no contigs left for shard %s :/ There are only %d contigs to profile, so you\
+                                should split this job into fewer shards." % (self.shard, len(contig_names))
+
+        self.run.info('num_contigs_in_shard', len(contigs_in_shard))
+        self.run.info('total_length_of_shard', sum([l for n, l in contigs_in_shard]))
+
+        return [n for n, l in contigs_in_shard], [l for n, l in contigs_in_shard]
+
+
+    def get_shard_index_and_num_shards(self):
+        try:
+            shard_index, num_shards = [int(x) for x in self.shard.split('/')]
+        except ValueError:
+            raise ConfigError, "Shards must be declared as 'i/N' (i.e., '2/8' for the second of eight shards), but\
+                                anvi'o does not know what to do with '%s'." % self.shard
+
+        if not 1 <= shard_index <= num_shards:
+            raise ConfigError, "There is no shard %d among %d shards. Shard numbers start from 1." % (shard_index, num_shards)
+
+        return shard_index, num_shards
+
+
     def generate_output_destination(self, postfix, directory = False):
         return_path = os.path.join(self.output_directory, postfix)
 
@@ -488,71 +821,207 @@ class BAMProfiler(dbops.ContigsSuperclass):
     def profile(self):
         """Big deal function"""
 
-        # So we start with essential stats. In the section below, we will simply go through each contig
-        # in the BAM file and populate the contigs dictionary for the first time.
-        for i in range(0, len(self.contig_names)):
-        
-            contig_name = self.contig_names[i]
-
-            contig = contigops.Contig(contig_name)
-            contig.length = self.contig_lengths[i]
-            contig.split_length = self.a_meta['split_length']
-            contig.min_coverage_for_variability = self.min_coverage_for_variability
-            contig.skip_SNV_profiling = self.skip_SNV_profiling
-            contig.report_variability_full = self.report_variability_full
-
-            self.progress.new('Profiling "%s" (%d of %d) (%s nts)' % (contig.name,
-                                                                      i + 1,
-                                                                      len(self.contig_names),
-                                                                      pp(int(contig.length))))
-
-            # populate contig with empty split objects and 
-            for split_name in self.contig_name_to_splits[contig_name]:
-                s = self.splits_basic_info[split_name]
-                split_sequence = self.contig_sequences[contig_name]['sequence'][s['start']:s['end']]
-                split = contigops.Split(split_name, split_sequence, contig_name, s['order_in_parent'], s['start'], s['end'])
-                contig.splits.append(split)
-
-            # analyze coverage for each split
-            contig.analyze_coverage(self.bam, self.progress)
-
-            # test the mean coverage of the contig.
-            discarded_contigs_due_to_C = set([])
-            if contig.coverage.mean < self.min_mean_coverage:
-                # discard this contig and continue
-                discarded_contigs_due_to_C.add(contig.name)
-                self.progress.end()
-                continue
+        # contigs that are already in checkpoints are stored by `init_checkpoints`:
+        contig_indices = [i for i in range(0, len(self.contig_names)) if self.contig_names[i] not in self.contig_names_in_checkpoints]
+
+        if self.num_threads > 1:
+            self.profile_contigs_in_parallel(contig_indices)
+        else:
+            self.profile_contigs_serially(contig_indices)
+
+        # every contig is stored as soon as it is profiled (unless it was discarded due to -C):
+        if self.num_contigs_stored < len(self.contig_names):
+            self.run.info('contigs_after_C', pp(self.num_contigs_stored))
+
+        # a shard may end up with no contigs after -C, but it is still one piece of the whole profile:
+        if not self.shard:
+            self.check_contigs(self.num_contigs_stored)
+
+
+    def profile_contig(self, bam, contig_name, contig_length, progress):
+        """Profiles a single contig, and returns the Contig object (or None if it is discarded due to -C)"""
+
+        contig = self.gen_contig(contig_name, contig_length)
+
+        # analyze coverage for each split (this also profiles SNVs in the same pass over
+        # the pileup unless self.skip_SNV_profiling is True)
+        contig.analyze_coverage(bam, progress)
+
+        # test the mean coverage of the contig.
+        if contig.coverage.mean < self.min_mean_coverage:
+            return None
+
+        if not self.skip_SNV_profiling:
+            contig.analyze_auxiliary(progress)
+
+        return contig
+
+
+    def gen_contig(self, contig_name, contig_length):
+        """Returns a Contig object with empty splits that is ready to be profiled"""
+
+        contig = contigops.Contig(contig_name)
+        contig.length = contig_length
+        contig.split_length = self.a_meta['split_length']
+        contig.min_coverage_for_variability = self.min_coverage_for_variability
+        contig.max_depth_for_SNV_profiling = self.max_depth_for_SNV_profiling
+        contig.skip_SNV_profiling = self.skip_SNV_profiling
+        contig.report_variability_full = self.report_variability_full
+
+        # populate contig with empty split objects and 
+        for split_name in self.contig_name_to_splits[contig_name]:
+            s = self.splits_basic_info[split_name]
+            split_sequence = self.contig_sequences[contig_name]['sequence'][s['start']:s['end']]
+            split = contigops.Split(split_name, split_sequence, contig_name, s['order_in_parent'], s['start'], s['end'])
+            contig.splits.append(split)
+
+        return contig
+
+
+    def profile_contigs_serially(self, contig_indices):
+        for n in range(0, len(contig_indices)):
+            i = contig_indices[n]
+            self.progress.new('Profiling "%s" (%d of %d) (%s nts)' % (self.contig_names[i],
+                                                                      n + 1,
+                                                                      len(contig_indices),
+                                                                      pp(int(self.contig_lengths[i]))))
 
-            if not self.skip_SNV_profiling:
-                contig.analyze_auxiliary(self.bam, self.progress)
+            contig = self.profile_contig(self.bam, self.contig_names[i], self.contig_lengths[i], self.progress)
+
+            if contig:
+                self.progress.update('Storing ...')
+                self.store_contig(contig)
+
+            self.add_to_checkpoint(self.contig_names[i], contig)
 
             self.progress.end()
 
-            # add contig to the dict.
-            self.contigs[contig_name] = contig
 
+    def profile_contigs_in_parallel(self, contig_indices):
+        """Distributes contigs to `self.num_threads` worker processes, and stores their profiles in the
+           order contigs appear in the BAM file, so the output does not depend on the number of threads.
+
+           Contigs are sent to workers in the same order they are stored. Profiles that come back early
+           are kept aside until all contigs before them are stored, and since contigs are sent in order,
+           only a few of them are kept aside at any given time."""
+
+        num_contigs = len(contig_indices)
+
+        input_queue = multiprocessing.Queue()
+        output_queue = multiprocessing.Queue()
+
+        for i in contig_indices:
+            input_queue.put(i)
+
+        # one poison pill for each worker:
+        for i in range(0, self.num_threads):
+            input_queue.put(None)
+
+        workers = []
+        for i in range(0, self.num_threads):
+            worker = multiprocessing.Process(target = self.profile_contigs_worker, args = (input_queue, output_queue))
+            workers.append(worker)
+            worker.start()
+
+        self.progress.new('Profiling %s contigs using %d threads' % (pp(num_contigs), self.num_threads))
+        self.progress.update('...')
+
+        pending_contigs = {}
+        next_index = 0
+        num_contigs_received = 0
+        while num_contigs_received < num_contigs:
+            try:
+                i, contig, error = output_queue.get(timeout = 1)
+            except Queue.Empty:
+                dead_workers = utils.get_worker_processes_that_died(workers)
+                if dead_workers:
+                    for worker in workers:
+                        worker.terminate()
+                    self.progress.end()
+                    raise ConfigError, "One of the worker processes died unexpectedly (with exit code %d) while profiling\
+                                        contigs. This usually happens when the operating system kills a process that\
+                                        uses too much memory. You may want to try again with fewer threads :/"\
+                                                                                    % dead_workers[0].exitcode
+                continue
+
+            if error:
+                for worker in workers:
+                    worker.terminate()
+                self.progress.end()
+                raise ConfigError, "Something went wrong while profiling '%s' in one of the worker processes :/ Here\
+                                    is the error message: '%s'." % (self.contig_names[i], error)
+
+            pending_contigs[i] = contig
 
-        if discarded_contigs_due_to_C:
-            self.run.info('contigs_after_C', pp(len(self.contigs)))
+            while next_index < num_contigs and contig_indices[next_index] in pending_contigs:
+                i = contig_indices[next_index]
+                contig = pending_contigs.pop(i)
 
-        # set contig abundance
-        contigops.set_contigs_abundance(self.contigs)
+                # workers do not send back split sequences (we have them already):
+                if contig:
+                    self.restore_split_sequences(contig)
+                    self.store_contig(contig)
 
-        self.check_contigs()
+                self.add_to_checkpoint(self.contig_names[i], contig)
 
+                next_index += 1
+
+            num_contigs_received += 1
+
+            self.progress.update('%s of %s contigs are profiled ...' % (pp(num_contigs_received), pp(num_contigs)))
+
+        for worker in workers:
+            worker.join()
 
-    def store_profile(self):
-        output_file = self.generate_output_destination('PROFILE.cp')
-        self.progress.new('Storing Profile')
-        self.progress.update('Serializing information for %s contigs ...' % pp(len(self.contigs)))
-        dictio.write_serialized_object(self.contigs, output_file)
         self.progress.end()
-        self.run.info('profile_dict', output_file)
 
 
-    def check_contigs(self):
-        if not len(self.contigs):
+    def profile_contigs_worker(self, input_queue, output_queue):
+        # every worker gets its own file handle:
+        bam = self.open_BAM_files()
+        progress = terminal.Progress(verbose = False)
+
+        while True:
+            i = input_queue.get()
+
+            if i is None:
+                break
+
+            try:
+                contig = self.profile_contig(bam, self.contig_names[i], self.contig_lengths[i], progress)
+            except Exception as e:
+                output_queue.put((i, None, str(e)))
+                break
+
+            # no need to send split sequences back to the parent process:
+            if contig:
+                self.drop_split_sequences(contig)
+
+            output_queue.put((i, contig, None))
+
+        self.close_BAM_files(bam)
+
+
+    def open_BAM_files(self):
+        return pysam.Samfile(self.input_file_path, 'rb')
+
+
+    def close_BAM_files(self, bam):
+        bam.close()
+
+
+    def drop_split_sequences(self, contig):
+        for split in contig.splits:
+            split.sequence = None
+
+
+    def restore_split_sequences(self, contig):
+        for split in contig.splits:
+            split.sequence = self.contig_sequences[contig.name]['sequence'][split.start:split.end]
+
+
+    def check_contigs(self, num_contigs):
+        if not num_contigs:
             raise ConfigError, "0 contigs to work with. Bye."
 
 
@@ -578,15 +1047,349 @@ class BAMProfiler(dbops.ContigsSuperclass):
                                       to learn more about the command line parameters."
         if self.input_file_path and self.serialized_profile_path:
             raise ConfigError, "You can't declare both an input file and a serialized profile."
+        if len(self.input_file_paths) > 1:
+            self.check_args_for_multiple_BAM_files()
+        if self.checkpoint and not self.input_file_path:
+            raise ConfigError, "Checkpoints are only written when profiling BAM files, so '--checkpoint' and '--resume'\
+                                can only be used with an input file."
+        if self.shard and not self.input_file_path:
+            raise ConfigError, "Only BAM files can be profiled in shards."
+        if self.shard:
+            self.get_shard_index_and_num_shards()
+        if self.shard and self.contigs_shall_be_clustered:
+            raise ConfigError, "Contigs can't be clustered in a partial profile of a shard. You can ask anvi'o to\
+                                cluster them when you merge all shards with 'anvi-merge-shards'."
+        if self.resume and self.overwrite_output_destinations:
+            raise ConfigError, "You can't ask anvi'o to resume a run in an output directory, and to overwrite it at the\
+                                same time."
         if self.serialized_profile_path and (not self.output_directory):
             raise ConfigError, "When loading serialized profiles, you need to declare an output directory."
-        if self.input_file_path and not os.path.exists(self.input_file_path):
-            raise ConfigError, "No such file: '%s'" % self.input_file_path
+        for input_file_path in self.input_file_paths:
+            if not os.path.exists(input_file_path):
+                raise ConfigError, "No such file: '%s'" % input_file_path
         if self.serialized_profile_path and not os.path.exists(self.serialized_profile_path):
             raise ConfigError, "No such file: '%s'" % self.serialized_profile_path
         if not self.min_coverage_for_variability >= 0:
             raise ConfigError, "Minimum coverage for variability must be 0 or larger."
+        if self.max_depth_for_SNV_profiling and self.max_depth_for_SNV_profiling < max(self.min_coverage_for_variability, 1):
+            raise ConfigError, "Max depth for SNV profiling (%d) can't be smaller than the minimum coverage for variability (%d)."\
+                                        % (self.max_depth_for_SNV_profiling, self.min_coverage_for_variability)
         if not self.min_mean_coverage >= 0:
             raise ConfigError, "Minimum mean coverage must be 0 or larger."
         if not self.min_contig_length >= 0:
             raise ConfigError, "Minimum contig length must be 0 or larger."
+        if not self.num_threads >= 1:
+            raise ConfigError, "Number of threads must be 1 or larger."
+
+
+    def check_args_for_multiple_BAM_files(self):
+        if self.sample_id:
+            raise ConfigError, "You can't declare a sample name when you profile more than one BAM file. Sample names\
+                                will be set from the names of BAM files."
+        if self.resume:
+            raise ConfigError, "Runs can only be resumed one BAM file at a time."
+
+        self.get_sample_ids_of_BAM_files()
+
+
+    def get_sample_ids_of_BAM_files(self):
+        sample_ids = [self.get_sample_id_from_BAM_file_path(os.path.abspath(p)) for p in self.input_file_paths]
+
+        if len(set(sample_ids)) != len(sample_ids):
+            raise ConfigError, "The names of some of these BAM files result in the same sample name (i.e., '%s'), so\
+                                anvi'o can't profile them together :/" % [s for s in sample_ids if sample_ids.count(s) > 1][0]
+
+        return sample_ids
+
+
+class JointBAMProfiler(BAMProfiler):
+    """Profiles multiple BAM files together into a single merged profile, which is the same profile `anvi-merge`
+       would generate from profiles of each BAM file.
+
+       Every contig is piled up in all BAM files before moving on to the next one, and what is learned from each
+       sample goes straight into the merged outputs: coverages of splits in every sample into a single
+       AUXILIARY-DATA.h5, variable positions in every sample into a single variable nts table, gene coverages
+       (normalized by the number of mapped reads in each sample), and view tables that are generated from the
+       atomic data of every sample. None of these are written for each sample and read back to be merged."""
+    def __init__(self, args = None):
+        BAMProfiler.__init__(self, args)
+
+        self.clustering_configs = constants.clustering_configs['merged']
+
+        # merged profiles do not have serialized profiles:
+        self.skip_serialized_profile = True
+
+        self.sample_ids = []
+        self.num_reads_mapped_per_sample = {}
+        self.normalization_multiplier = {}
+
+
+    def _run(self):
+        self.check_args()
+
+        self.sample_ids = self.get_sample_ids_of_BAM_files()
+        self.set_sample_id()
+
+        self.init_dirs_and_dbs()
+
+        self.run.info('anvio', anvio.__version__)
+        self.run.info('profiler_version', anvio.__profile__version__)
+        self.run.info('sample_id', self.sample_id)
+        self.run.info('profile_db', self.profile_db_path)
+        self.run.info('merged', True)
+        self.run.info('merged_sample_ids', self.sample_ids)
+        self.run.info('num_runs_processed', len(self.sample_ids))
+        self.run.info('contigs_db', True)
+        self.run.info('contigs_db_hash', self.a_meta['contigs_db_hash'])
+        self.run.info('cmd_line', utils.get_cmd_line())
+        self.run.info('split_length', self.a_meta['split_length'])
+        self.run.info('min_contig_length', self.min_contig_length)
+        self.run.info('min_mean_coverage', self.min_mean_coverage)
+        self.run.info('clustering_performed', self.contigs_shall_be_clustered)
+        self.run.info('min_coverage_for_variability', self.min_coverage_for_variability)
+        self.run.info('max_depth_for_SNV_profiling', self.max_depth_for_SNV_profiling or None)
+        self.run.info('skip_SNV_profiling', self.skip_SNV_profiling)
+        self.run.info('num_threads', self.num_threads, display_only = True)
+        self.run.info('report_variability_full', self.report_variability_full)
+        self.run.info('gene_coverages_computed', self.a_meta['genes_are_called'])
+
+        self.init_profile_from_BAM()
+        self.init_profile_outputs()
+        self.init_checkpoints()
+        self.profile()
+        self.close_profile_outputs()
+
+        self.gen_view_data_tables()
+
+        runinfo_serialized = self.generate_output_destination('RUNINFO.mcp')
+        self.run.info('runinfo', runinfo_serialized)
+        self.run.store_info_dict(runinfo_serialized, strip_prefix = self.output_directory)
+
+        self.run.quit()
+
+
+    def set_sample_id(self):
+        """The sample name of a merged profile comes from its output directory, unless it is declared."""
+        if not self.sample_id:
+            self.sample_id = os.path.basename(os.path.abspath(self.output_directory))
+            self.sample_id = self.sample_id.replace('-', '_')
+            if self.sample_id[0] in constants.digits:
+                self.sample_id = 's' + self.sample_id
+
+        utils.check_sample_id(self.sample_id)
+
+
+    def get_profile_db_meta_values(self):
+        return {'db_type': 'profile',
+                'anvio': __version__,
+                'sample_id': self.sample_id,
+                'samples': ','.join(self.sample_ids),
+                'merged': True,
+                'contigs_clustered': self.contigs_shall_be_clustered,
+                'default_view': 'mean_coverage',
+                'min_contig_length': self.min_contig_length,
+                'SNVs_profiled': not self.skip_SNV_profiling,
+                'min_coverage_for_variability': self.min_coverage_for_variability,
+                'report_variability_full': self.report_variability_full,
+                'contigs_db_hash': self.a_meta['contigs_db_hash'],
+                'gene_coverages_computed': self.a_meta['genes_are_called']}
+
+
+    def init_profile_from_BAM(self):
+        self.progress.new('Init')
+
+        self.bam = []
+        for input_file_path in self.input_file_paths:
+            self.progress.update('Reading BAM File %s ...' % os.path.basename(input_file_path))
+            try:
+                self.bam.append(pysam.Samfile(input_file_path, 'rb'))
+            except ValueError as e:
+                self.progress.end()
+                raise ConfigError, 'Are you sure "%s" is a BAM file? Because samtools is not happy with it: """%s"""' % (input_file_path, e)
+
+        self.progress.end()
+
+        self.contig_names = self.bam[0].references
+        self.contig_lengths = self.bam[0].lengths
+
+        utils.check_contig_names(self.contig_names)
+
+        # every sample must know about the same contigs, since they are profiled together:
+        for i in range(1, len(self.bam)):
+            if self.bam[i].references != self.contig_names or self.bam[i].lengths != self.contig_lengths:
+                raise ConfigError, "BAM files '%s' and '%s' do not describe the same contigs. All BAM files that are profiled\
+                                    together must come from mapping reads to the same contigs." % (self.input_file_paths[0],
+                                                                                                   self.input_file_paths[i])
+
+        for i in range(0, len(self.bam)):
+            try:
+                self.num_reads_mapped_per_sample[self.sample_ids[i]] = int(self.bam[i].mapped)
+            except ValueError:
+                raise ConfigError, "It seems the BAM file '%s' is not indexed. See 'anvi-init-bam' script." % self.input_file_paths[i]
+
+        self.num_reads_mapped = sum(self.num_reads_mapped_per_sample.values())
+
+        runinfo = self.generate_output_destination('RUNINFO')
+        self.run.init_info_file_obj(runinfo)
+        self.run.info('input_bams', ', '.join(self.input_file_paths))
+        self.run.info('output_dir', self.output_directory, display_only = True)
+        self.run.info('total_reads_mapped', pp(self.num_reads_mapped))
+        self.run.info('num_contigs', pp(len(self.contig_names)))
+
+        self.set_normalization_multiplier()
+
+        self.select_contigs_and_splits()
+
+
+    def set_normalization_multiplier(self):
+        # see `merger.MultipleRuns.set_normalization_multiplier` for a word of caution about this:
+        smallest_sample_size = min(self.num_reads_mapped_per_sample.values())
+
+        if smallest_sample_size == 0:
+            raise ConfigError, "It seems at least one of the samples you are trying to profile has zero hits. Here is a\
+                                list of all samples and number of mapped reads they have: %s." \
+                                    % ', '.join(['"%s": %s' % (s, pp(self.num_reads_mapped_per_sample[s])) for s in self.sample_ids])
+
+        for sample_id in self.sample_ids:
+            self.normalization_multiplier[sample_id] = smallest_sample_size * 1.0 / self.num_reads_mapped_per_sample[sample_id]
+
+        self.run.warning("anvio just set the normalization values for each sample based on\
+                          how many mapped reads they contained. All normalized coverages\
+                          will use this information: %s" % ', '.join(['%s: %.2f' % (s, self.normalization_multiplier[s]) for s in self.sample_ids]))
+
+
+    def init_profile_outputs(self):
+        BAMProfiler.init_profile_outputs(self)
+
+        # abundances depend on every contig in a sample, so atomic data are kept for each sample until the end:
+        self.atomic_data_for_each_sample = dict([(sample_id, contigops.AtomicContigSplitData(self.progress)) for sample_id in self.sample_ids])
+
+
+    def profile_contig(self, bams, contig_name, contig_length, progress):
+        """Profiles a single contig in every BAM file, and returns a list of Contig objects in the order of BAM
+           files (or None if the contig is discarded due to -C in every sample)"""
+
+        contigs = []
+        for bam in bams:
+            contig = self.gen_contig(contig_name, contig_length)
+            contig.analyze_coverage(bam, progress)
+            contigs.append(contig)
+
+        # every sample of a merged profile has the same contigs, so a contig stays if it is covered enough in any
+        # one of them:
+        if max([contig.coverage.mean for contig in contigs]) < self.min_mean_coverage:
+            return None
+
+        if not self.skip_SNV_profiling:
+            for contig in contigs:
+                contig.analyze_auxiliary(progress)
+
+        return contigs
+
+
+    def store_contig(self, contigs):
+        """Writes everything about a contig profiled in every sample into the merged output files."""
+        for sample_id, contig in zip(self.sample_ids, contigs):
+            if self.variable_nts_table:
+                self.store_variable_positions(contig, sample_id)
+                self.num_columns_capped_for_SNV_profiling += sum([split.auxiliary.num_capped_columns for split in contig.splits])
+
+            if self.contig_name_to_genes.has_key(contig.name):
+                self.gene_coverages_table.analyze_contig(contig, sample_id, self.contig_name_to_genes[contig.name], self.normalization_multiplier[sample_id])
+
+            for split in contig.splits:
+                self.split_coverage_values.append(split.name, sample_id, split.coverage.c)
+
+            self.atomic_data_for_each_sample[sample_id].add_contig(contig)
+
+        if self.variable_nts_table and len(self.variable_nts_table.db_entries) >= self.max_num_db_entries_in_memory:
+            self.variable_nts_table.store()
+
+        if len(self.gene_coverages_table.genes) >= self.max_num_db_entries_in_memory:
+            self.gene_coverages_table.store()
+
+        self.num_contigs_stored += 1
+
+
+    def open_BAM_files(self):
+        return [pysam.Samfile(input_file_path, 'rb') for input_file_path in self.input_file_paths]
+
+
+    def close_BAM_files(self, bams):
+        for bam in bams:
+            bam.close()
+
+
+    def drop_split_sequences(self, contigs):
+        for contig in contigs:
+            BAMProfiler.drop_split_sequences(self, contig)
+
+
+    def restore_split_sequences(self, contigs):
+        for contig in contigs:
+            BAMProfiler.restore_split_sequences(self, contig)
+
+
+    def gen_view_data_tables(self):
+        """View tables, clustering, and CONCOCT bins are generated from atomic data of every sample exactly the way
+           `anvi-merge` does it, only without reading atomic data back from single profiles."""
+
+        # importing it any earlier would complain about CONCOCT to every single profile:
+        import anvio.merger as merger
+
+        class Args:
+            pass
+
+        args = Args()
+        args.input = self.input_file_paths
+        args.sample_name = self.sample_id
+        args.output_dir = self.output_directory
+        args.contigs_db = self.contigs_db_path
+        args.skip_hierarchical_clustering = not self.contigs_shall_be_clustered
+        args.skip_concoct_binning = not self.contigs_shall_be_clustered
+        args.overwrite_output_destinations = self.overwrite_output_destinations
+        args.debug = False
+
+        multiple_runs = merger.MultipleRuns(args, run = self.run, progress = self.progress)
+        multiple_runs.profile_db_path = self.profile_db_path
+        multiple_runs.merged_sample_ids = self.sample_ids
+        multiple_runs.normalization_multiplier = self.normalization_multiplier
+        multiple_runs.SNVs_profiled = not self.skip_SNV_profiling
+        multiple_runs.atomic_data_fields = tables.atomic_data_table_structure
+        multiple_runs.atomic_data_for_each_run = {'contigs': {}, 'splits': {}}
+
+        for sample_id in self.sample_ids:
+            atomic_data = self.atomic_data_for_each_sample[sample_id]
+            atomic_data.set_abundances()
+
+            # atomic data for contigs are looked up by the splits they contain:
+            multiple_runs.atomic_data_for_each_run['splits'][sample_id] = atomic_data.atomic_data_splits
+            multiple_runs.atomic_data_for_each_run['contigs'][sample_id] = dict([(split_name, atomic_data.atomic_data_contigs[d['__parent__']]) \
+                                                                                        for split_name, d in atomic_data.atomic_data_splits.iteritems()])
+
+        multiple_runs.split_names = sorted(multiple_runs.atomic_data_for_each_run['splits'][self.sample_ids[0]].keys())
+        multiple_runs.split_parents = multiple_runs.get_split_parents()
+
+        multiple_runs.gen_view_data_tables_from_atomic_data()
+
+        if self.contigs_shall_be_clustered:
+            multiple_runs.cluster_contigs_anvio()
+            multiple_runs.bin_contigs_concoct()
+
+
+    def check_args(self):
+        BAMProfiler.check_args(self)
+
+        if len(self.input_file_paths) < 2:
+            raise ConfigError, "You need to declare at least two BAM files to profile them jointly."
+        if not self.output_directory:
+            raise ConfigError, "You need to declare an output directory for a joint profile."
+        if self.checkpoint:
+            raise ConfigError, "Joint profiles can't be checkpointed."
+        if self.shard:
+            raise ConfigError, "Joint profiles can't be profiled in shards."
+
+
+    def check_args_for_multiple_BAM_files(self):
+        # unlike single profiles of each BAM file, a joint profile is a single profile that can have a name:
+        self.get_sample_ids_of_BAM_files()
@@ -3,7 +3,6 @@
 '''Primitive classes for basic DNA sequence properties.'''
 
 import numpy
-import collections
 
 import anvio
 
@@ -43,11 +42,40 @@ class Composition:
             self.GC_content = (self.G + self.C) * 1.0 / length
 
 
-class Coverage:
+class SlottedObject(object):
+    """A base for classes that have an instance for every contig or split in a profile. Attributes of these
+       classes are kept in `__slots__` rather than in a dict for every instance.
+
+       Instances can still be pickled, and unpickled from pickles of earlier versions of anvi'o in which these
+       classes were not slotted. Attributes that are missing from a pickle keep the values `__init__` gives
+       them, and attributes that are no longer slots are ignored."""
+    __slots__ = []
+
+    def get_slots(self):
+        return [attr for cls in type(self).__mro__ for attr in getattr(cls, '__slots__', [])]
+
+
+    def __getstate__(self):
+        return dict([(attr, getattr(self, attr)) for attr in self.get_slots() if hasattr(self, attr)])
+
+
+    def __setstate__(self, state):
+        self.__init__()
+
+        slots = set(self.get_slots())
+        for attr in state:
+            if attr in slots:
+                setattr(self, attr, state[attr])
+
+
+class Coverage(SlottedObject):
+    __slots__ = ['c', 'outlier_positions', 'min', 'max', 'std', 'mean', 'median', 'portion_covered', 'mean_Q1Q3']
+
     def __init__(self):
-        self.c = [] # list of coverage values
-        self.outlier_positions = set([]) # set of positions along the sequence, coverage values of which
-                                         # are classified as outliers; see `get_indices_for_outlier_values`
+        self.c = numpy.array([], dtype = numpy.uint32) # array of coverage values
+        self.outlier_positions = numpy.array([], dtype = numpy.int64) # sorted array of positions along the sequence,
+                                                                      # coverage values of which are classified as
+                                                                      # outliers; see `get_list_of_outliers`
         self.min = 0
         self.max = 0
         self.std = 0.0
@@ -57,24 +85,6 @@ class Coverage:
         self.mean_Q1Q3 = 0.0
 
 
-    def run(self, bam, split):
-        coverage_profile = {}
-        for pileupcolumn in bam.pileup(split.parent, split.start, split.end):
-            if pileupcolumn.pos < split.start or pileupcolumn.pos >= split.end:
-                continue
-
-            coverage_profile[pileupcolumn.pos] = pileupcolumn.n
-
-        for i in range(split.start, split.end):
-            if coverage_profile.has_key(i):
-                self.c.append(coverage_profile[i])
-            else:
-                self.c.append(0)
-
-        if self.c:
-            split.explicit_length = len(self.c)
-            self.process_c(self.c)
-
     def process_c(self, c):
         c = numpy.asarray(c)
         self.min = numpy.amin(c)
@@ -82,22 +92,98 @@ class Coverage:
         self.median = numpy.median(c)
         self.mean = numpy.mean(c)
         self.std = numpy.std(c)
-        self.portion_covered = 1 - (float(collections.Counter(c)[0]) / len(c))
+        self.portion_covered = float(numpy.count_nonzero(c)) / c.size
 
-        self.outlier_positions = get_indices_for_outlier_values(c)
+        self.outlier_positions = numpy.flatnonzero(get_list_of_outliers(c))
 
         if c.size < 4:
             self.mean_Q1Q3 = self.mean
         else:
-            sorted_c = sorted(c)
+            # we only need the values between the first and the third quartiles, not a fully
+            # sorted array, so a partial sort around the two boundaries is enough:
             Q = int(c.size * 0.25)
-            Q1Q3 = sorted_c[Q:-Q]
-            self.mean_Q1Q3 = numpy.mean(Q1Q3)
+            partitioned_c = numpy.partition(c, (Q, c.size - Q - 1))
+            self.mean_Q1Q3 = numpy.mean(partitioned_c[Q:-Q])
+
+
+    def __setstate__(self, state):
+        SlottedObject.__setstate__(self, state)
+
+        # pickles of earlier versions keep outlier positions in a set:
+        if isinstance(self.outlier_positions, set):
+            self.outlier_positions = numpy.array(sorted(self.outlier_positions), dtype = numpy.int64)
+
+
+class CoverageIndex:
+    """Keeps coverage values of a contig as a single array along with cumulative sums of it, so mean coverages
+       and detection of many regions of the contig (i.e., genes) can be computed at once:
+
+        >>> index = CoverageIndex(c)
+        >>> index.mean(starts, stops)
+        >>> index.detection(starts, stops)
+        >>> index.median(starts, stops)
 
+       Each of these functions takes arrays of start and stop positions, and returns an array with a value for
+       each region (for empty regions mean and median are NaN, and detection is 0)."""
 
-def get_indices_for_outlier_values(c):
-    is_outlier = get_list_of_outliers(c)
-    return set([p for p in range(0, c.size) if is_outlier[p]])
+    # the max number of coverage values `median` puts together at once:
+    max_num_values_in_memory = 10000000
+
+    def __init__(self, c):
+        self.c = numpy.asarray(c)
+
+        # cumulative sums of coverage values. the one at index i is the sum of everything before position i:
+        self.cumsum = numpy.zeros(self.c.size + 1, dtype = numpy.int64)
+        numpy.cumsum(self.c, out = self.cumsum[1:])
+
+        # and cumulative sums of positions that are covered:
+        self.cumsum_covered = numpy.zeros(self.c.size + 1, dtype = numpy.int64)
+        numpy.cumsum(self.c > 0, out = self.cumsum_covered[1:])
+
+
+    def get_regions(self, starts, stops):
+        starts = numpy.clip(numpy.asarray(starts, dtype = numpy.int64), 0, self.c.size)
+        stops = numpy.clip(numpy.asarray(stops, dtype = numpy.int64), 0, self.c.size)
+        return starts, numpy.maximum(starts, stops)
+
+
+    def mean(self, starts, stops):
+        starts, stops = self.get_regions(starts, stops)
+
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            return (self.cumsum[stops] - self.cumsum[starts]) / (stops - starts).astype(float)
+
+
+    def detection(self, starts, stops):
+        """Portion of positions in each region that are covered by at least one read"""
+        starts, stops = self.get_regions(starts, stops)
+        lengths = stops - starts
+
+        detection = numpy.zeros(starts.size)
+        nonempty = lengths > 0
+        detection[nonempty] = (self.cumsum_covered[stops[nonempty]] - self.cumsum_covered[starts[nonempty]]) / lengths[nonempty].astype(float)
+
+        return detection
+
+
+    def median(self, starts, stops):
+        """Medians can't come from cumulative sums, but regions of the same length can be put into a matrix, and
+           medians of all of them can be computed at once"""
+        starts, stops = self.get_regions(starts, stops)
+        lengths = stops - starts
+
+        medians = numpy.empty(starts.size)
+        medians.fill(numpy.nan)
+
+        for length in numpy.unique(lengths[lengths > 0]):
+            regions = numpy.flatnonzero(lengths == length)
+
+            num_regions_at_once = max(1, self.max_num_values_in_memory // length)
+            for i in range(0, regions.size, num_regions_at_once):
+                batch = regions[i:i + num_regions_at_once]
+                medians[batch] = numpy.median(self.c[starts[batch][:, None] + numpy.arange(length)], axis = 1)
+
+        return medians
 
 
 def get_list_of_outliers(values, threshold=1.5):
@@ -129,16 +215,17 @@ def get_list_of_outliers(values, threshold=1.5):
     """
 
     if len(values.shape) == 1:
-        values = values[:,None]
-
-    median = numpy.median(values, axis=0)
+        # for one dimensional data the distance to the median is simply the absolute difference
+        diff = numpy.absolute(values - numpy.median(values))
+    else:
+        median = numpy.median(values, axis=0)
+        diff = numpy.sum((values - median) ** 2, axis=-1)
+        diff = numpy.sqrt(diff)
 
-    diff = numpy.sum((values - median) ** 2, axis=-1)
-    diff = numpy.sqrt(diff)
     median_absolute_deviation = numpy.median(diff)
 
     if not median_absolute_deviation:
-        return [True] * values.size
+        return numpy.ones(diff.size, dtype = bool)
 
     modified_z_score = 0.6745 * diff / median_absolute_deviation
 
@@ -179,6 +179,9 @@ class Summarizer(DatabasesMetaclass):
             self.summary['meta']['total_nts_in_collection'] += self.summary['collection'][bin_id]['total_length']
             self.summary['meta']['num_contigs_in_collection'] += self.summary['collection'][bin_id]['num_contigs'] 
 
+        # bins read gene sequences from the contigs database as they need them:
+        self.close_contig_sequences_store()
+
         # bins are computed, add some relevant meta info:
         self.summary['meta']['percent_contigs_nts_described_by_collection'] = '%.2f' % (self.summary['meta']['total_nts_in_collection'] * 100.0 / int(self.a_meta['total_length']))
         self.summary['meta']['percent_profile_nts_described_by_collection'] = '%.2f' % (self.summary['meta']['total_nts_in_collection'] * 100.0 / int(self.p_meta['total_length']))
@@ -521,7 +524,7 @@ class Bin:
             contig = self.summary.genes_in_contigs_dict[gene_callers_id]['contig']
             start = self.summary.genes_in_contigs_dict[gene_callers_id]['start']
             stop = self.summary.genes_in_contigs_dict[gene_callers_id]['stop']
-            d[gene_callers_id]['sequence'] = self.summary.contig_sequences[contig]['sequence'][start:stop]
+            d[gene_callers_id]['sequence'] = self.summary.get_contig_subsequence(contig, start, stop)
 
         output_file_obj = self.get_output_file_handle('functions.txt')
 
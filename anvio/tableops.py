@@ -83,9 +83,9 @@ class Table(object):
 
     def set_next_available_id(self, table):
         database = db.DB(self.db_path, self.version)
-        table_content = database.get_table_as_dict(table)
-        if table_content:
-            self.next_available_id[table] = max(table_content.keys()) + 1
+        max_id = database.get_max_value_in_column(table, database.get_table_structure(table)[0])
+        if max_id is not None:
+            self.next_available_id[table] = max_id + 1
         else:
             self.next_available_id[table] = 0
 
@@ -112,7 +112,15 @@ class Table(object):
                                 file, however this table does not seem to be a table that\
                                 stores sequence information :(" % table
 
-        sequences_table = database.get_table_as_dict(table)
+        if table == t.contig_sequences_table_name:
+            # contig sequences are stored in compressed blocks (dbops imports this module, hence the late import):
+            import anvio.dbops as dbops
+            contig_sequences = dbops.ContigSequences(self.db_path)
+            sequences_table = contig_sequences.get_sequences()
+            contig_sequences.close()
+        else:
+            sequences_table = database.get_table_as_dict(table)
+
         database.disconnect()
 
         if not len([sequences_table]):
@@ -139,11 +147,11 @@ class Table(object):
         # removes rows from each table in 'tables_to_remove' where 'table_column' equals 'value'
         database = db.DB(self.db_path, self.version)
 
-        table_content = database.get_table_as_dict(tables_to_clear[0])
-        if key in table_content:
+        if database.get_row_counts_from_table(tables_to_clear[0], '%s = ?' % table_column, (key, )):
             self.run.warning('Previous entries for "%s" is being removed from "%s"' % (key, ', '.join(tables_to_clear)))
-            for table_name in tables_to_clear:
-                database._exec('''DELETE FROM %s WHERE %s = "%s"''' % (table_name, table_column, key))
+            with database.transaction():
+                for table_name in tables_to_clear:
+                    database._exec('''DELETE FROM %s WHERE %s = ?''' % (table_name, table_column), (key, ))
 
         database.disconnect()
 
@@ -10,7 +10,7 @@ __maintainer__ = "A. Murat Eren"
 __email__ = "a.murat.eren@gmail.com"
 
 
-contigs_db_version = "5"
+contigs_db_version = "6"
 profile_db_version = "10"
 samples_info_db_version = "2"
 auxiliary_hdf5_db_version = "1"
@@ -23,9 +23,12 @@ auxiliary_hdf5_db_version = "1"
 ####################################################################################################
 
 
+# contig sequences are stored in zlib compressed blocks of `contig_sequences_block_size` nts, so
+# any piece of a contig can be read without decompressing the rest of it (see dbops.ContigSequences):
 contig_sequences_table_name            = 'contig_sequences'
-contig_sequences_table_structure       = ['contig', 'sequence']
-contig_sequences_table_types           = [  'str' ,   'str'   ]
+contig_sequences_table_structure       = ['contig',  'block' , 'sequence']
+contig_sequences_table_types           = [  'str' , 'numeric',   'blob'  ]
+contig_sequences_block_size            = 16384
 
 contigs_info_table_name                = 'contigs_basic_info'
 contigs_info_table_structure           = ['contig', 'length' , 'gc_content', 'num_splits']
@@ -123,6 +123,14 @@ class Multiprocessing:
             time.sleep(1)
 
 
+def get_worker_processes_that_died(workers):
+    """Returns processes in `workers` that are gone without a clean exit. A worker that is killed by the
+       OS (i.e., for using too much memory) can't report back, and a parent that keeps waiting for its
+       results would wait forever."""
+
+    return [worker for worker in workers if worker.exitcode not in [None, 0]]
+
+
 def get_available_port_num(start = 8080, look_upto_next_num_ports = 100, ip='0.0.0.0'):
     """Starts from 'start' and incrementally looks for an available port
        until 'start + look_upto_next_num_ports', and returns the first
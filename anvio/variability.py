@@ -3,6 +3,8 @@
 """Classes to make sense of single nucleotide variation"""
 
 from __future__ import division
+import numpy
+
 from collections import Counter
 
 import anvio
@@ -19,6 +21,54 @@ __maintainer__ = "A. Murat Eren"
 __email__ = "a.murat.eren@gmail.com"
 
 
+# the order of nucleotides in nucleotide count arrays:
+nt_counts_order = 'ACGTN'
+
+# the order in which a `Counter` of 'A', 'C', 'G', 'T', and 'N' iterates over its keys (their hashes fall
+# into different slots of the underlying dict, so this order never changes), expressed as indices in
+# `nt_counts_order`:
+most_common_tie_order = [0, 1, 3, 2, 4]
+
+
+def get_depth_capped_nt_counts(nt_counts, max_depth, seed = 0):
+    """Returns nucleotide counts as if at most `max_depth` reads were seen in each column, and a boolean array
+       that marks the columns that were deeper than that.
+
+       Picking `max_depth` reads out of a deeper column at random (i.e., reservoir sampling of the reads in the
+       column) draws a multivariate hypergeometric sample from its nucleotide counts, so the sample is drawn
+       from the counts directly, one nucleotide at a time. The same `seed` always gives the same sample."""
+    nt_counts = numpy.asarray(nt_counts)
+    capped = nt_counts.sum(axis = 1) > max_depth
+
+    if not capped.any():
+        return nt_counts, capped
+
+    random_state = numpy.random.RandomState(seed)
+
+    counts = nt_counts[capped].astype(numpy.int64)
+    sampled_counts = numpy.zeros(counts.shape, dtype = numpy.int64)
+
+    num_reads_left = counts.sum(axis = 1)
+    num_reads_to_pick = numpy.empty(counts.shape[0], dtype = numpy.int64)
+    num_reads_to_pick.fill(max_depth)
+
+    for i in range(0, counts.shape[1] - 1):
+        picking = num_reads_to_pick > 0
+        sampled_counts[picking, i] = random_state.hypergeometric(counts[picking, i],
+                                                                 num_reads_left[picking] - counts[picking, i],
+                                                                 num_reads_to_pick[picking])
+        num_reads_left -= counts[:, i]
+        num_reads_to_pick -= sampled_counts[:, i]
+
+    # whatever is left to pick comes from the last nucleotide:
+    sampled_counts[:, -1] = num_reads_to_pick
+
+    nt_counts = nt_counts.copy()
+    nt_counts[capped] = sampled_counts
+
+    return nt_counts, capped
+
+
 class VariablityTestFactory:
     """an experimental class to make sense whether the nucleotide variation in a column
        is meaningful beyond sequencing errors, given the coverage of that position."""
@@ -32,6 +82,9 @@ class VariablityTestFactory:
         else:
             self.cov_var_map_dict = dict([(c, 0) for c in range(0, self.coverage_upper_limit + 1)])
 
+        # same, for many coverage values at once:
+        self.cov_var_map_array = numpy.array([self.cov_var_map_dict[c] for c in range(0, self.coverage_upper_limit + 1)])
+
 
     def min_acceptable_ratio_given_coverage(self, coverage):
         if coverage >= self.coverage_upper_limit:
@@ -40,6 +93,10 @@ class VariablityTestFactory:
         return self.cov_var_map_dict[coverage]
 
 
+    def min_acceptable_ratios_given_coverages(self, coverages):
+        return self.cov_var_map_array[numpy.minimum(coverages, self.coverage_upper_limit)]
+
+
     def curve(self, coverage):
         # https://www.desmos.com/calculator/qwocua4zi5
         # and/or https://i.imgur.com/zd04pui.png
@@ -82,3 +139,78 @@ class ColumnProfile:
         else:
             # if there is no test class, just report everything.
             self.profile['departure_from_consensus'] = departure_from_consensus
+
+
+class SplitColumnProfiles:
+    """Profiles every column of a split at once, given the nucleotide counts of its columns.
+
+       `nt_counts` is a matrix with a row for each position in the split and a column for each
+       nucleotide in `nt_counts_order`, and `consensus_sequence` is the sequence of the split. The
+       results are identical to what `ColumnProfile` would have reported for each column, but they
+       are computed as arrays:
+
+            self.coverage                  coverage of each position,
+            self.departure_from_consensus  ratio of non-consensus nucleotides to coverage,
+            self.competing_nts             the most frequent two nucleotides ('' for invariant ones),
+            self.passes                    whether the departure passes the test for its coverage,
+
+       and positions that are covered at least `min_coverage` times and pass the test are stored in
+       `self.variable_positions`, a record array with one record per variable position (see
+       `variable_positions_dtype`)."""
+
+    variable_positions_dtype = [('pos', 'i8'), ('coverage', 'i8'), ('consensus', 'S1'), ('competing_nts', 'S2'),
+                                ('departure_from_consensus', 'f8')] + [(nt, 'i8') for nt in nt_counts_order]
+
+    # competing nts for every pair of indices in `nt_counts_order`, already sorted alphabetically:
+    competing_nts_lookup = numpy.array([[''.join(sorted(a + b)) for b in nt_counts_order] for a in nt_counts_order])
+
+    def __init__(self, nt_counts, consensus_sequence, coverage=None, min_coverage=10, test_class=None):
+        nt_counts = numpy.asarray(nt_counts, dtype = numpy.int64)
+        num_positions = nt_counts.shape[0]
+
+        self.coverage = nt_counts.sum(axis = 1) if coverage is None else numpy.asarray(coverage, dtype = numpy.int64)
+        self.departure_from_consensus = numpy.zeros(num_positions)
+        self.competing_nts = numpy.zeros(num_positions, dtype = 'S2')
+        self.passes = numpy.zeros(num_positions, dtype = bool)
+        self.variable_positions = numpy.zeros(0, dtype = self.variable_positions_dtype).view(numpy.recarray)
+
+        if not num_positions:
+            return
+
+        # only columns with at least two different nucleotides can vary:
+        has_variation = (nt_counts > 0).sum(axis = 1) > 1
+
+        # the most frequent two nucleotides, with ties resolved the way `Counter.most_common` in
+        # `ColumnProfile` resolves them:
+        nt_counts_in_tie_order = nt_counts[:, most_common_tie_order]
+        top_two = numpy.argsort(-nt_counts_in_tie_order, axis = 1, kind = 'mergesort')[:, :2]
+        top_two = numpy.array(most_common_tie_order)[top_two]
+        self.competing_nts[has_variation] = self.competing_nts_lookup[top_two[has_variation, 0], top_two[has_variation, 1]]
+
+        # consensus nucleotides that are not in `nt_counts_order` (i.e., anything that is not one of the
+        # upper case 'ACGTN') are never observed in columns, so every nucleotide departs from them:
+        consensus = numpy.frombuffer(consensus_sequence, dtype = 'S1')
+        consensus_counts = numpy.zeros(num_positions, dtype = numpy.int64)
+        for i in range(0, len(nt_counts_order)):
+            matching = consensus == nt_counts_order[i]
+            consensus_counts[matching] = nt_counts[matching, i]
+
+        covered = has_variation & (self.coverage > 0)
+        self.departure_from_consensus[covered] = (self.coverage[covered] - consensus_counts[covered]) / self.coverage[covered]
+
+        if test_class:
+            self.passes = has_variation & (self.departure_from_consensus > test_class.min_acceptable_ratios_given_coverages(self.coverage))
+        else:
+            # if there is no test class, just report everything.
+            self.passes = has_variation
+
+        variable = numpy.flatnonzero(self.passes & (self.departure_from_consensus > 0) & (self.coverage >= min_coverage))
+
+        self.variable_positions = numpy.zeros(variable.size, dtype = self.variable_positions_dtype).view(numpy.recarray)
+        self.variable_positions.pos = variable
+        self.variable_positions.coverage = self.coverage[variable]
+        self.variable_positions.consensus = consensus[variable]
+        self.variable_positions.competing_nts = self.competing_nts[variable]
+        self.variable_positions.departure_from_consensus = self.departure_from_consensus[variable]
+        for i in range(0, len(nt_counts_order)):
+            self.variable_positions[nt_counts_order[i]] = nt_counts[variable, i]
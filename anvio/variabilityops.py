@@ -74,12 +74,10 @@ class VariableNtPositionsEngine(dbops.ContigsSuperclass):
         self.unique_pos_identifier = 0
         self.split_name_position_dict = {}
         self.unique_pos_id_to_entry_id = {}
-        self.contig_sequences = None
         self.input_file_path = None
 
         # Initialize the contigs super
         dbops.ContigsSuperclass.__init__(self, self.args, r = self.run, p = self.progress)
-        self.init_contig_sequences()
 
 
     def init(self):
@@ -506,12 +504,18 @@ class VariableNtPositionsEngine(dbops.ContigsSuperclass):
             split_info = self.splits_basic_info[split]
             parent_name = split_info['parent']
 
-            for pos in splits_to_consider[split]:
-                parent_seq = self.contig_sequences[parent_name]['sequence']
+            positions = splits_to_consider[split].keys()
+            nt_position_info = self.get_nt_position_info_many(parent_name, [split_info['start'] + pos for pos in positions])
+
+            # only sequences of splits with variable positions are read from the contigs database:
+            split_sequence = self.get_contig_subsequence(parent_name, split_info['start'], split_info['end'])
+
+            for i in range(0, len(positions)):
+                pos = positions[i]
                 pos_in_contig = split_info['start'] + pos
-                base_at_pos = parent_seq[pos_in_contig]
+                base_at_pos = split_sequence[pos]
 
-                in_partial_gene_call, in_complete_gene_call, pos_in_codon = self.get_nt_position_info(parent_name, pos_in_contig)
+                in_partial_gene_call, in_complete_gene_call, pos_in_codon = nt_position_info[i]
 
                 for sample in splits_to_consider[split][pos]:
                     self.variable_nts_table[next_available_entry_id] = {'parent': parent_name,
@@ -534,6 +538,8 @@ class VariableNtPositionsEngine(dbops.ContigsSuperclass):
                     self.variable_nts_table[next_available_entry_id][base_at_pos] = split_coverage_across_samples[sample][pos]
                     next_available_entry_id += 1
 
+        self.close_contig_sequences_store()
+
         self.progress.end()
 
     def report(self):
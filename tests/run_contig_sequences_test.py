@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Compares what the block store of contig sequences (dbops.ContigSequences) returns with the sequences in
+   the FASTA file they came from: subsequences that start and end in different blocks, at the beginning
+   and at the end of contigs, and beyond them, for a contigs database generated from the sandbox, and
+   for a database with tiny blocks and a tiny block cache."""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import subprocess
+
+import anvio
+import anvio.db as db
+import anvio.dbops as dbops
+import anvio.fastalib as u
+
+from anvio.errors import ConfigError
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+results = []
+
+def check(name, condition):
+    run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+    results.append(condition)
+
+
+def test(name, contig_sequences, sequences, block_size):
+    r = random.Random(1)
+
+    positions = [(0, 0), (0, 1), (0, block_size), (block_size - 1, block_size + 1), (block_size, 2 * block_size)]
+    subsequences_are_identical = True
+    for contig_name, sequence in sequences.items():
+        length = len(sequence)
+
+        for start, stop in positions + [(0, length), (length - 1, length), (length, length), (max(0, length - 5), length + 5), (length + 5, length + 10)] + \
+                           [sorted([r.randint(0, length), r.randint(0, length)]) for i in range(0, 200)]:
+            if contig_sequences.get_subsequence(contig_name, start, stop) != sequence[start:stop]:
+                run.info('Mismatch', '%s (%d - %d)' % (contig_name, start, stop), mc = 'red')
+                subsequences_are_identical = False
+
+    check('%s: subsequences' % name, subsequences_are_identical)
+    check('%s: every block is cached at most once' % name, len(contig_sequences.blocks_cache) == len(set(contig_sequences.blocks_cache)) and \
+                                                           len(contig_sequences.blocks_cache) <= contig_sequences.blocks_cache_size)
+    check('%s: full sequences' % name, all([contig_sequences.get_sequence(c) == sequences[c] for c in sequences]))
+    check('%s: all sequences at once' % name, dict([(c, s['sequence']) for c, s in contig_sequences.get_sequences().items()]) == sequences)
+
+    some_contigs = sorted(sequences)[::2]
+    check('%s: some sequences at once' % name, dict([(c, s['sequence']) for c, s in contig_sequences.get_sequences(some_contigs).items()]) == \
+                                               dict([(c, sequences[c]) for c in some_contigs]))
+
+    try:
+        contig_sequences.get_subsequence('not_a_contig', 0, 10)
+        check('%s: unknown contigs are reported' % name, False)
+    except ConfigError:
+        check('%s: unknown contigs are reported' % name, True)
+
+
+def get_sequences_from_fasta(fasta_path):
+    sequences = {}
+
+    fasta = u.SequenceSource(fasta_path)
+    while fasta.next():
+        sequences[fasta.id] = fasta.seq
+    fasta.close()
+
+    return sequences
+
+
+output_dir = tempfile.mkdtemp()
+sandbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox')
+
+
+# a contigs database from the sandbox, with the default block size:
+fasta_path = os.path.join(sandbox, 'contigs.fa')
+contigs_db_path = os.path.join(output_dir, 'CONTIGS.db')
+with open(os.path.join(output_dir, 'log.txt'), 'w') as log_file:
+    subprocess.call(['anvi-gen-contigs-database', '-f', fasta_path, '-o', contigs_db_path, '-L', '1000', '--skip-gene-calling'], stdout = log_file, stderr = subprocess.STDOUT)
+
+contig_sequences = dbops.ContigSequences(contigs_db_path)
+test('Sandbox', contig_sequences, get_sequences_from_fasta(fasta_path), contig_sequences.block_size)
+contig_sequences.close()
+
+
+# a database with blocks of 7 nts, and only 5 blocks in the cache:
+r = random.Random(2)
+sequences = dict([('contig_%d' % length, ''.join([r.choice('ACGTN') for i in range(0, length)])) for length in [1, 6, 7, 8, 13, 14, 15, 500]])
+
+fasta_path = os.path.join(output_dir, 'tiny_blocks.fa')
+with open(fasta_path, 'w') as fasta:
+    for contig_name in sorted(sequences):
+        fasta.write('>%s\n%s\n' % (contig_name, sequences[contig_name]))
+
+contigs_db_path = os.path.join(output_dir, 'TINY_BLOCKS.db')
+contigs_db = db.DB(contigs_db_path, anvio.__contigs__version__, new_database = True)
+contig_sequences_table = dbops.SequencesTableForContigs(block_size = 7)
+for contig_name, sequence in get_sequences_from_fasta(fasta_path).items():
+    contig_sequences_table.append(contig_name, sequence)
+contig_sequences_table.store(contigs_db)
+contigs_db.disconnect()
+
+contig_sequences = dbops.ContigSequences(contigs_db_path, block_size = 7)
+contig_sequences.blocks_cache_size = 5
+test('Tiny blocks', contig_sequences, get_sequences_from_fasta(fasta_path), 7)
+contig_sequences.close()
+
+
+if not all(results):
+    run.info('Result', 'Some tests failed (files are in %s)' % output_dir, mc = 'red')
+    sys.exit(1)
+
+shutil.rmtree(output_dir)
+run.info('Result', 'All tests passed', mc = 'green')
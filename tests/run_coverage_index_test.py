@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Compares mean coverage, detection, and median coverage of many regions computed at once by
+   sequence.CoverageIndex with what numpy reports for each region one by one, for regions that are
+   empty, that are clipped at the ends of a contig, and for medians that are computed in batches."""
+
+import sys
+import numpy
+import random
+
+from anvio.sequence import CoverageIndex
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+results = []
+
+def check(name, condition):
+    run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+    results.append(condition)
+
+
+def get_expected(c, starts, stops):
+    """Mean, detection, and median of each region, one region at a time"""
+    means, detections, medians = [], [], []
+
+    for start, stop in zip(starts, stops):
+        region = c[max(0, start):max(0, min(stop, c.size))]
+        if region.size:
+            means.append(numpy.mean(region))
+            detections.append(numpy.sum(region > 0) / float(region.size))
+            medians.append(numpy.median(region))
+        else:
+            means.append(numpy.nan)
+            detections.append(0.0)
+            medians.append(numpy.nan)
+
+    return numpy.array(means), numpy.array(detections), numpy.array(medians)
+
+
+def are_equal(a, b):
+    return a.shape == b.shape and numpy.allclose(a, b, equal_nan = True)
+
+
+def test(name, c, starts, stops):
+    index = CoverageIndex(c)
+    means, detections, medians = get_expected(c, starts, stops)
+
+    check('%s: mean' % name, are_equal(index.mean(starts, stops), means))
+    check('%s: detection' % name, are_equal(index.detection(starts, stops), detections))
+    check('%s: median' % name, are_equal(index.median(starts, stops), medians))
+
+
+r = random.Random(1)
+
+# a contig with gaps in coverage, and genes of many lengths (some of which share the same length):
+c = numpy.array([r.choice([0, 0, r.randint(1, 100)]) for i in range(0, 5000)], dtype = numpy.uint32)
+starts = [r.randint(0, 4900) for i in range(0, 300)]
+stops = [start + r.choice([1, 2, 3, 50, 99, 100, r.randint(1, 500)]) for start in starts]
+test('Random genes', c, starts, stops)
+
+# empty regions, and regions that go beyond the ends of the contig:
+starts = [0, 10, 10, 4990, 4999, 5000, 5010, -5, -10]
+stops = [0, 10, 5, 5010, 5000, 5000, 5020, 5, -1]
+test('Empty and clipped regions', c, starts, stops)
+
+# a contig that is not covered at all, and one without any positions:
+test('No coverage', numpy.zeros(100, dtype = numpy.uint32), [0, 10, 50], [100, 20, 51])
+test('Empty contig', numpy.zeros(0, dtype = numpy.uint32), [0, 0], [0, 10])
+
+# no genes:
+index = CoverageIndex(c)
+check('No regions', index.mean([], []).size == 0 and index.detection([], []).size == 0 and index.median([], []).size == 0)
+
+# medians of regions of the same length are computed in batches, so a tiny batch size should make no difference:
+starts = [r.randint(0, 4900) for i in range(0, 100)]
+stops = [start + r.choice([30, 31, 77]) for start in starts]
+expected_medians = CoverageIndex(c).median(starts, stops)
+index = CoverageIndex(c)
+index.max_num_values_in_memory = 40
+check('Medians in small batches', are_equal(index.median(starts, stops), expected_medians))
+index.max_num_values_in_memory = 1
+check('Medians one region at a time', are_equal(index.median(starts, stops), expected_medians))
+
+
+if not all(results):
+    run.info('Result', 'Some tests failed', mc = 'red')
+    sys.exit(1)
+
+run.info('Result', 'All tests passed', mc = 'green')
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Tests for the low-level database operations in anvio/db.py."""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+
+import anvio.db as db
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+results = []
+
+def check(name, condition):
+    run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+    results.append(condition)
+
+
+def get_rows_from_another_connection(db_path, table):
+    """What a reader who opens the database file sees, which is only what is committed"""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''SELECT * FROM %s''' % table).fetchall()
+    conn.close()
+    return rows
+
+
+output_dir = tempfile.mkdtemp()
+db_path = os.path.join(output_dir, 'TEST.db')
+
+database = db.DB(db_path, '1', new_database = True)
+database.create_table('numbers', ['entry_id', 'value'], ['numeric', 'text'])
+
+
+# _exec_many with a generator:
+num_generated = [0]
+def rows(n):
+    for i in range(0, n):
+        num_generated[0] += 1
+        yield (i, 'value_%d' % i)
+
+database._exec_many('''INSERT INTO numbers VALUES (?,?)''', rows(25000))
+database.commit()
+check('_exec_many with a generator (default batches)', num_generated[0] == 25000 and \
+                                                        database.get_all_rows_from_table('numbers') == list(rows(25000)))
+
+database._exec('''DELETE FROM numbers''')
+database._exec_many('''INSERT INTO numbers VALUES (?,?)''', rows(100), batch_size = 7)
+database.commit()
+check('_exec_many with a generator (batches of 7)', database.get_all_rows_from_table('numbers') == list(rows(100)))
+
+database._exec('''DELETE FROM numbers''')
+database._exec_many('''INSERT INTO numbers VALUES (?,?)''', rows(0))
+check('_exec_many with an empty generator', database.get_all_rows_from_table('numbers') == [])
+
+
+# transactions:
+with database.transaction():
+    database._exec_many('''INSERT INTO numbers VALUES (?,?)''', rows(10))
+    database.set_meta_value('in_transaction', 'yes')
+    uncommitted = get_rows_from_another_connection(db_path, 'numbers')
+check('Nothing is committed before a transaction ends', uncommitted == [])
+check('Everything is committed once it ends', get_rows_from_another_connection(db_path, 'numbers') == list(rows(10)))
+
+try:
+    with database.transaction():
+        database._exec('''INSERT INTO numbers VALUES (?,?)''', (10, 'value_10'))
+        database.remove_meta_key_value_pair('in_transaction')
+        raise ValueError('Something went wrong')
+except ValueError:
+    pass
+check('A transaction that fails is rolled back', database.get_all_rows_from_table('numbers') == list(rows(10)) and \
+                                                 database.get_meta_value('in_transaction') == 'yes')
+
+try:
+    with database.transaction():
+        database._exec('''INSERT INTO numbers VALUES (?,?)''', (10, 'value_10'))
+        with database.transaction():
+            database._exec('''INSERT INTO numbers VALUES (?,?)''', (11, 'value_11'))
+        raise ValueError('Something went wrong after the inner transaction')
+except ValueError:
+    pass
+check('Inner transactions are rolled back with the outer one', database.get_all_rows_from_table('numbers') == list(rows(10)) and \
+                                                               get_rows_from_another_connection(db_path, 'numbers') == list(rows(10)))
+
+database.disconnect()
+
+
+# rows of interest:
+database = db.DB(db_path, '1')
+database.create_table('splits', ['split', 'contig', 'length'], ['text', 'text', 'numeric'])
+database._exec_many('''INSERT INTO splits VALUES (?,?,?)''', (('split_%d' % i, 'contig_%d' % (i / 10), i) for i in range(0, 5000)))
+database.commit()
+
+check('Rows with keys of interest', sorted(database.get_rows_from_table('splits', keys_of_interest = ['split_3', 'split_7', 'split_9999'])) == \
+                                    [('split_3', 'contig_0', 3), ('split_7', 'contig_0', 7)])
+check('More keys of interest than SQLite takes variables', len(database.get_rows_from_table('splits', keys_of_interest = ['split_%d' % i for i in range(0, 6000)])) == 5000)
+check('Keys of interest in another column', sorted(database.get_rows_from_table('splits', columns = ['split'], keys_of_interest = ['contig_2'], key_column = 'contig')) == \
+                                            [('split_%d' % i, ) for i in range(20, 30)])
+check('Keys of interest with a where clause', sorted(database.get_rows_from_table('splits', columns = ['length'], where_clause = 'length > ?', where_values = [25],
+                                                                                  keys_of_interest = ['contig_2'], key_column = 'contig')) == [(26, ), (27, ), (28, ), (29, )])
+check('Temporary table for keys is dropped', database._exec('''SELECT name FROM sqlite_temp_master''').fetchall() == [])
+
+# keys are converted to the type of the key column, the way values in that column were converted when
+# they were inserted (so '3' finds 3 in a numeric column, and 3 finds '3' in a text column):
+check('Keys are converted to the type of a numeric column', sorted(database.get_rows_from_table('numbers', keys_of_interest = ['3', 4])) == [(3, 'value_3'), (4, 'value_4')])
+database._exec('''INSERT INTO splits VALUES (?,?,?)''', ('42', 'contig_42', 42))
+check('Keys are converted to the type of a text column', database.get_rows_from_table('splits', keys_of_interest = [42]) == [('42', 'contig_42', 42)])
+
+d = database.get_table_as_dict('splits', keys_of_interest = ['split_1', 'split_2'], columns_of_interest = ['length'])
+check('Table as dict with keys and columns of interest', d == {'split_1': {'length': 1}, 'split_2': {'length': 2}})
+
+check('Max value in a column', database.get_max_value_in_column('splits', 'length', where_clause = 'contig = ?', where_values = ['contig_3']) == 39)
+check('Row counts', database.get_row_counts_from_table('splits', where_clause = 'contig = ?', where_values = ['contig_3']) == 10)
+
+# the temporary table for keys commits what came before it in a transaction (see `DB.transaction`):
+try:
+    with database.transaction():
+        database._exec('''INSERT INTO numbers VALUES (?,?)''', (10, 'value_10'))
+        database.get_rows_from_table('numbers', keys_of_interest = [10])
+        database._exec('''INSERT INTO numbers VALUES (?,?)''', (11, 'value_11'))
+        raise ValueError('Something went wrong')
+except ValueError:
+    pass
+check('Only what came after keys of interest is rolled back', database.get_all_rows_from_table('numbers') == list(rows(11)))
+
+database.disconnect()
+
+
+# bulk-load mode is only for those who ask for it:
+def get_pragma(path, pragma):
+    conn = sqlite3.connect(path)
+    value = conn.execute('''PRAGMA %s''' % pragma).fetchone()[0]
+    conn.close()
+    return value
+
+check('New databases use the default journal mode', get_pragma(db_path, 'journal_mode') == 'delete')
+
+bulk_db_path = os.path.join(output_dir, 'BULK.db')
+database = db.DB(bulk_db_path, '1', new_database = True, bulk_load = True)
+check('Bulk-load databases are written with WAL', database._exec('''PRAGMA journal_mode''').fetchone()[0] == 'wal')
+database.disconnect()
+check('Bulk-load databases go back to the default journal mode', get_pragma(bulk_db_path, 'journal_mode') == 'delete')
+
+
+if not all(results):
+    run.info('Result', 'Some tests failed (files are in %s)' % output_dir, mc = 'red')
+    sys.exit(1)
+
+shutil.rmtree(output_dir)
+run.info('Result', 'All tests passed', mc = 'green')
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Tests for the cache of pressed HMM models (hmmops.PressedHMMCache), with a stub `hmmpress` that
+   writes the files the real one would, and keeps a log of the models it pressed: hits, entries that
+   were changed after they were added to the cache, eviction of least recently used entries, and
+   entries that are locked by another process."""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import anvio.terminal as terminal
+
+from anvio.hmmops import PressedHMMCache, HMMSearch
+from anvio.errors import ConfigError
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+stub_hmmpress = """#!/bin/sh
+if [ "$1" = "-h" ]; then
+    echo "# hmmpress :: prepare an HMM database for faster hmmscan searches"
+    echo "# HMMER 3.1b2 (stub)"
+    exit 0
+fi
+
+echo "$1" >> "%(log)s"
+for extension in h3f h3i h3m h3p; do
+    cat "$1" > "$1.$extension"
+done
+"""
+
+# holds a shared lock on the entry given as the first argument, until its stdin is closed:
+lock_holder = """
+import sys, fcntl
+lock = open(sys.argv[1] + '/.lock', 'a')
+fcntl.flock(lock, fcntl.LOCK_SH)
+print 'locked'
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+
+results = []
+
+def check(name, condition):
+    run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+    results.append(condition)
+
+
+class LockHolder:
+    def __init__(self, entry_dir):
+        self.process = subprocess.Popen([sys.executable, '-c', lock_holder, entry_dir], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        self.process.stdout.readline()
+
+    def release(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def get_model(name, size):
+    model_path = os.path.join(output_dir, '%s.hmm.gz' % name)
+    model = gzip.open(model_path, 'wb')
+    model.write('NAME  %s\n%s\n' % (name, 'x' * size))
+    model.close()
+    return model_path
+
+
+def get_num_presses():
+    return len(open(hmmpress_log_path).readlines()) if os.path.exists(hmmpress_log_path) else 0
+
+
+def get_cache(verify_checksums = False):
+    cache = PressedHMMCache(cache_dir, verify_checksums = verify_checksums, run = Run(verbose = False), progress = terminal.Progress(verbose = False))
+
+    # this is what creates the cache directory (HMMSearch does the same):
+    cache.is_usable()
+
+    # counts files that are read for their checksums:
+    cache.num_checksums = 0
+    get_file_checksum = cache.get_file_checksum
+    def count_checksums(file_path):
+        cache.num_checksums += 1
+        return get_file_checksum(file_path)
+    cache.get_file_checksum = count_checksums
+
+    return cache
+
+
+def get_entries():
+    return sorted([e for e in os.listdir(cache_dir) if not e.startswith('.')])
+
+
+def get_entry_dir(cache, model_path):
+    return os.path.join(cache_dir, cache.get_key(model_path))
+
+
+def set_last_used(entry_dir, seconds_ago):
+    t = time.time() - seconds_ago
+    os.utime(entry_dir, (t, t))
+
+
+output_dir = tempfile.mkdtemp()
+cache_dir = os.path.join(output_dir, 'CACHE')
+log_file_path = os.path.join(output_dir, 'log.txt')
+hmmpress_log_path = os.path.join(output_dir, 'hmmpress_log.txt')
+
+bin_dir = os.path.join(output_dir, 'bin')
+os.mkdir(bin_dir)
+with open(os.path.join(bin_dir, 'hmmpress'), 'w') as f:
+    f.write(stub_hmmpress % {'log': hmmpress_log_path})
+os.chmod(os.path.join(bin_dir, 'hmmpress'), 0755)
+
+path = os.environ['PATH']
+os.environ['PATH'] = bin_dir + os.pathsep + path
+
+model_a, model_b, model_c = get_model('A', 1000), get_model('B', 1000), get_model('C', 1000)
+
+
+# a model that is not in the cache, and then is:
+cache = get_cache()
+hmm_file_path = cache.get_pressed_model(model_a, log_file_path)
+entry_dir = get_entry_dir(cache, model_a)
+check('New entry', hmm_file_path == os.path.join(entry_dir, 'hmm.txt') and get_num_presses() == 1 and \
+                   all([os.path.exists(hmm_file_path + '.' + e) for e in ['h3f', 'h3i', 'h3m', 'h3p']]))
+cache.release_entries()
+
+cache = get_cache()
+check('Hit', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and get_num_presses() == 1)
+check('Hits read no files for checksums', cache.num_checksums == 0)
+cache.release_entries()
+
+cache = get_cache(verify_checksums = True)
+check('Hits with checksums', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and \
+                             cache.num_checksums == len(json.load(open(os.path.join(entry_dir, 'MANIFEST')))))
+cache.release_entries()
+
+
+# files that were touched, and files that were changed:
+os.utime(hmm_file_path + '.h3m', None)
+cache = get_cache()
+check('Touched entry is still a hit', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and get_num_presses() == 1 and \
+                                      cache.num_checksums == 1)
+cache.release_entries()
+
+with open(hmm_file_path + '.h3m', 'a') as f:
+    f.write('tampered')
+cache = get_cache()
+check('Entry with a larger file is pressed again', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and get_num_presses() == 2 and \
+                                                   not open(hmm_file_path + '.h3m').read().endswith('tampered'))
+cache.release_entries()
+
+with open(hmm_file_path + '.h3m', 'r+') as f:
+    f.write('Z')
+cache = get_cache()
+check('Entry with a changed file is pressed again', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and get_num_presses() == 3 and \
+                                                    open(hmm_file_path + '.h3m').read().startswith('N'))
+cache.release_entries()
+
+# a change that keeps the size and the modification time is found only with checksums:
+manifest = json.load(open(os.path.join(entry_dir, 'MANIFEST')))
+with open(hmm_file_path + '.h3m', 'r+') as f:
+    f.write('Z')
+os.utime(hmm_file_path + '.h3m', (manifest['hmm.txt.h3m']['mtime'], manifest['hmm.txt.h3m']['mtime']))
+cache = get_cache(verify_checksums = True)
+check('Checksums find what sizes and times miss', cache.get_pressed_model(model_a, log_file_path) == hmm_file_path and get_num_presses() == 4)
+cache.release_entries()
+
+
+# least recently used entries are evicted first, and locked ones never are:
+entry_size = sum([os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)])
+
+cache = get_cache()
+cache.get_pressed_model(model_b, log_file_path)
+cache.release_entries()
+set_last_used(get_entry_dir(cache, model_a), 300)
+set_last_used(get_entry_dir(cache, model_b), 200)
+
+cache.get_pressed_model(model_a, log_file_path)
+cache.release_entries()
+
+cache.max_cache_size = int(entry_size * 2.5)
+cache.get_pressed_model(model_c, log_file_path)
+cache.release_entries()
+check('Least recently used entry is evicted', get_entries() == sorted([cache.get_key(model_a), cache.get_key(model_c)]))
+
+cache.max_cache_size = 10 * entry_size
+cache.get_pressed_model(model_b, log_file_path)
+set_last_used(get_entry_dir(cache, model_a), 300)
+set_last_used(get_entry_dir(cache, model_c), 200)
+lock_holder_process = LockHolder(get_entry_dir(cache, model_a))
+cache.max_cache_size = 0
+cache.evict()
+check('Locked entries are not evicted', get_entries() == sorted([cache.get_key(model_a), cache.get_key(model_b)]))
+cache.release_entries()
+
+# a broken entry another process is using is left alone, and the model is pressed somewhere else:
+num_presses = get_num_presses()
+with open(os.path.join(get_entry_dir(cache, model_a), 'hmm.txt.h3m'), 'a') as f:
+    f.write('broken')
+check('Broken entry in use is not used', cache.get_pressed_model(model_a, log_file_path) is None and \
+                                         os.path.exists(get_entry_dir(cache, model_a)))
+
+protein_sequences_fasta = os.path.join(output_dir, 'proteins.fa')
+with open(protein_sequences_fasta, 'w') as f:
+    f.write('>1\nMKV\n')
+hmm_search = HMMSearch(protein_sequences_fasta, run = Run(verbose = False), progress = terminal.Progress(verbose = False), hmm_cache = cache)
+tmp_dir, hmm_file_path = hmm_search.prepare_hmm_model('A', ['A'], model_a, None)
+check('Broken entry in use is pressed elsewhere', hmm_file_path == os.path.join(tmp_dir, 'hmm.txt') and os.path.exists(hmm_file_path + '.h3m') and \
+                                                  get_num_presses() == num_presses + 1)
+hmm_search.clean_tmp_dirs()
+
+lock_holder_process.release()
+cache.max_cache_size = 10 * entry_size
+check('Broken entry is pressed again once it is free', cache.get_pressed_model(model_a, log_file_path) == os.path.join(get_entry_dir(cache, model_a), 'hmm.txt') and \
+                                                       get_num_presses() == num_presses + 2)
+cache.release_entries()
+
+
+# without hmmpress:
+os.environ['PATH'] = path
+try:
+    get_cache().get_hmmer_version()
+    check('Missing hmmpress is reported', False)
+except ConfigError:
+    check('Missing hmmpress is reported', True)
+
+
+if not all(results):
+    run.info('Result', 'Some tests failed (files are in %s)' % output_dir, mc = 'red')
+    sys.exit(1)
+
+shutil.rmtree(output_dir)
+run.info('Result', 'All tests passed', mc = 'green')
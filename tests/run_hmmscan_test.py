@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Searches protein sequences of genes in the sandbox contigs against the HMM profiles that come with
+   anvi'o with one thread, and with more threads (in which case protein sequences are split into shards
+   that are searched separately, and outputs of shards are merged), and compares the hits files. Also
+   searches fewer protein sequences than threads, and makes sure an empty FASTA file is reported the
+   same way no matter how many threads there are.
+
+   Needs HMMER and prodigal, and skips everything if they are not installed."""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import subprocess
+
+import anvio
+import anvio.db as db
+import anvio.utils as utils
+import anvio.tables as t
+import anvio.fastalib as u
+import anvio.terminal as terminal
+
+from distutils.spawn import find_executable
+
+from anvio.hmmops import HMMSearch
+from anvio.errors import FilesNPathsError
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+results = []
+
+def check(name, condition):
+    run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+    results.append(condition)
+
+
+def get_sequences_from_fasta(fasta_path):
+    sequences = []
+
+    fasta = u.SequenceSource(fasta_path)
+    while fasta.next():
+        sequences.append((fasta.id, fasta.seq))
+    fasta.close()
+
+    return sequences
+
+
+def search(protein_sequences_fasta, sources, num_threads):
+    """Returns the contents of the hits file for every source (None for sources without hits), and the
+       shards protein sequences were split into"""
+    hmm_search = HMMSearch(protein_sequences_fasta, num_threads = num_threads, run = Run(verbose = False), progress = terminal.Progress(verbose = False))
+
+    hits = {}
+    for source, hits_path in hmm_search.run_hmmscan_for_sources(sources).items():
+        hits[source] = open(hits_path).read() if hits_path else None
+
+    shards = [get_sequences_from_fasta(shard) for shard in (hmm_search.protein_sequences_shards or [])]
+
+    hmm_search.clean_tmp_dirs()
+
+    return hits, shards
+
+
+def test(name, protein_sequences_fasta, sources, num_threads):
+    expected_hits, shards = search(protein_sequences_fasta, sources, 1)
+    hits, shards = search(protein_sequences_fasta, sources, num_threads)
+
+    sequences = get_sequences_from_fasta(protein_sequences_fasta)
+    check('%s: at most %d shards, none empty' % (name, num_threads), len(shards) <= num_threads and all(shards))
+    check('%s: shards keep the order of sequences' % name, sum(shards, []) == sequences)
+    check('%s: hits with %d threads' % (name, num_threads), hits == expected_hits)
+
+    return expected_hits
+
+
+missing_programs = [p for p in ['prodigal', 'hmmscan', 'hmmpress'] if not find_executable(p)]
+if missing_programs:
+    run.info('Result', 'Skipped (%s not installed)' % ', '.join(missing_programs), mc = 'red')
+    sys.exit(0)
+
+output_dir = tempfile.mkdtemp()
+sandbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox')
+
+# protein sequences of genes in the sandbox contigs:
+contigs_db_path = os.path.join(output_dir, 'CONTIGS.db')
+with open(os.path.join(output_dir, 'log.txt'), 'w') as log_file:
+    subprocess.call(['anvi-gen-contigs-database', '-f', os.path.join(sandbox, 'contigs.fa'), '-o', contigs_db_path, '-L', '1000'], stdout = log_file, stderr = subprocess.STDOUT)
+
+contigs_db = db.DB(contigs_db_path, anvio.__contigs__version__)
+protein_sequences = contigs_db.get_table_as_dict(t.gene_protein_sequences_table_name)
+contigs_db.disconnect()
+
+protein_sequences_fasta = os.path.join(output_dir, 'proteins.fa')
+with open(protein_sequences_fasta, 'w') as fasta:
+    for gene_callers_id in sorted(protein_sequences):
+        fasta.write('>%d\n%s\n' % (gene_callers_id, protein_sequences[gene_callers_id]['sequence']))
+
+hmm_data_dir = os.path.join(os.path.dirname(os.path.abspath(anvio.__file__)), 'data', 'hmm')
+sources = utils.get_HMM_sources_dictionary([d for d in glob.glob(os.path.join(hmm_data_dir, '*')) if os.path.isdir(d)])
+
+run.info('Protein sequences', len(protein_sequences))
+run.info('HMM sources', ', '.join(sorted(sources)))
+
+# there should be hits, or the comparison would not mean much:
+expected_hits = test('Sandbox', protein_sequences_fasta, sources, 3)
+check('Sandbox: there are hits', any(expected_hits.values()))
+
+# fewer sequences than threads:
+for num_sequences, num_threads in [(2, 3), (1, 8)]:
+    fasta_path = os.path.join(output_dir, 'proteins_%d.fa' % num_sequences)
+    with open(fasta_path, 'w') as fasta:
+        for gene_callers_id in sorted(protein_sequences)[:num_sequences]:
+            fasta.write('>%d\n%s\n' % (gene_callers_id, protein_sequences[gene_callers_id]['sequence']))
+    test('%d sequence%s' % (num_sequences, 's' if num_sequences > 1 else ''), fasta_path, sources, num_threads)
+
+# no sequences at all, which is not a FASTA file anvi'o would search:
+fasta_path = os.path.join(output_dir, 'no_proteins.fa')
+open(fasta_path, 'w').close()
+for num_threads in [1, 3]:
+    try:
+        search(fasta_path, sources, num_threads)
+        check('No sequences: reported (%d threads)' % num_threads, False)
+    except FilesNPathsError:
+        check('No sequences: reported (%d threads)' % num_threads, True)
+
+
+if not all(results):
+    run.info('Result', 'Some tests failed (files are in %s)' % output_dir, mc = 'red')
+    sys.exit(1)
+
+shutil.rmtree(output_dir)
+run.info('Result', 'All tests passed', mc = 'green')
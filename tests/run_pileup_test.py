@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Compares coverages and nucleotide counts anvi'o recovers from reads (anvio/pileup.py) with what the
+   pileup of pysam reports, for the BAM files in the sandbox, and for a BAM file with overlapping mates,
+   indels, skipped regions, soft and hard clips, low quality bases, and reads the pileup should ignore.
+
+   Then checks what happens to splits that are deeper than the pileup's max depth, with and without
+   capping the number of reads nucleotides are counted for in each column."""
+
+import os
+import sys
+import numpy
+import pysam
+import random
+import shutil
+import tempfile
+
+from anvio.pileup import SplitPileup, SplitPileupFromReads, ContigCoverageFromReads, is_pysam_version_verified
+from anvio.pileup import PILEUP_MAX_DEPTH, SPLIT_PILEUP_MAX_DEPTH
+from anvio.variability import nt_counts_order
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+class Contig:
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+
+
+class Split:
+    def __init__(self, parent, start, end):
+        self.parent = parent
+        self.start = start
+        self.end = end
+        self.length = end - start
+        self.name = '%s_split_%05d' % (parent, start)
+
+
+def get_profile_from_pileup(bam, split):
+    """Coverage and nucleotide counts for a split, straight from the pileup"""
+    c = numpy.zeros(split.length, dtype = numpy.uint32)
+    nt_counts = numpy.zeros((split.length, len(nt_counts_order)), dtype = numpy.uint32)
+
+    for pileupcolumn in bam.pileup(split.parent, split.start, split.end):
+        if pileupcolumn.pos < split.start or pileupcolumn.pos >= split.end:
+            continue
+
+        pos_in_split = pileupcolumn.pos - split.start
+        c[pos_in_split] = pileupcolumn.n
+
+        for pileupread in pileupcolumn.pileups:
+            if pileupread.is_del or pileupread.is_refskip:
+                continue
+
+            nt = pileupread.alignment.query_sequence[pileupread.query_position]
+            nt_counts[pos_in_split, nt_counts_order.index(nt if nt in 'ACGT' else 'N')] += 1
+
+    return c, nt_counts
+
+
+def test(bam_path, split_length = 1000):
+    bam = pysam.AlignmentFile(bam_path, 'rb')
+
+    num_splits, num_identical, num_fallbacks = 0, 0, 0
+    for contig_name, contig_length in zip(bam.references, bam.lengths):
+        contig = ContigCoverageFromReads(Contig(contig_name, contig_length))
+        contig.run(bam)
+
+        for start in range(0, contig_length, split_length):
+            split = Split(contig_name, start, min(start + split_length, contig_length))
+            num_splits += 1
+
+            c, nt_counts = get_profile_from_pileup(bam, split)
+
+            pileup = SplitPileupFromReads(split)
+            pileup.run(bam)
+
+            if not pileup.is_identical_to_pileup:
+                num_fallbacks += 1
+                continue
+
+            if (pileup.c == c).all() and (pileup.nt_counts == nt_counts).all() and (contig.c[split.start:split.end] == c).all():
+                num_identical += 1
+            else:
+                run.info('Mismatch', '%s (%d - %d)' % (contig_name, split.start, split.end), mc = 'red')
+
+    run.info('BAM file', os.path.basename(bam_path))
+    run.info('Splits', num_splits)
+    run.info('Too deep to test', num_fallbacks)
+    run.info('Identical to the pileup', num_identical, mc = 'green' if num_identical + num_fallbacks == num_splits else 'red')
+
+    return num_identical + num_fallbacks == num_splits
+
+
+def get_random_read(reference, start, name, r, read_length = 100):
+    """A read with random clips, indels, skipped regions, mismatches, and low quality bases"""
+    cigar, sequence = [], []
+
+    if r.random() < 0.2:
+        cigar.append((5, r.randint(1, 10))) # H
+    if r.random() < 0.3:
+        length = r.randint(1, 10)
+        cigar.append((4, length)) # S
+        sequence.extend([r.choice('ACGT') for i in range(length)])
+
+    pos = start
+    while len(sequence) < read_length:
+        length = r.randint(5, 40)
+        cigar.append((0, length)) # M
+        for i in range(length):
+            sequence.append(reference[pos] if r.random() > 0.05 else r.choice('ACGTN'))
+            pos += 1
+
+        event = r.random()
+        if event < 0.15:
+            length = r.randint(1, 4)
+            cigar.append((1, length)) # I
+            sequence.extend([r.choice('ACGT') for i in range(length)])
+        elif event < 0.3:
+            length = r.randint(1, 4)
+            cigar.append((2, length)) # D
+            pos += length
+        elif event < 0.33:
+            length = r.randint(10, 50)
+            cigar.append((3, length)) # N
+            pos += length
+
+    # no read should end with an operation that is not an M:
+    while cigar[-1][0] != 0:
+        operation, length = cigar.pop()
+        if operation == 1:
+            del sequence[-length:]
+        elif operation in (2, 3):
+            pos -= length
+
+    if r.random() < 0.3:
+        length = r.randint(1, 10)
+        cigar.append((4, length)) # S
+        sequence.extend([r.choice('ACGT') for i in range(length)])
+
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = start
+    read.mapping_quality = 60
+    read.cigartuples = cigar
+    read.query_sequence = ''.join(sequence)
+    read.query_qualities = pysam.qualitystring_to_array(''.join([chr(33 + (r.randint(2, 12) if r.random() < 0.15 else r.randint(13, 40))) for s in sequence]))
+
+    return read, pos
+
+
+def get_tricky_bam(output_dir, seed = 1):
+    r = random.Random(seed)
+
+    reference_length = 3000
+    reference = ''.join([r.choice('ACGT') for i in range(reference_length)])
+
+    reads = []
+    for i in range(0, 1200):
+        name = 'read_%d' % i
+        start = r.randint(0, reference_length - 400)
+
+        a, a_end = get_random_read(reference, start, name, r)
+
+        if r.random() < 0.2:
+            # a read without a mate (which still may have flags the pileup does not like):
+            a.flag = r.choice([0, 0, 0x10, 0x4, 0x100, 0x200, 0x400, 0x800])
+            reads.append(a)
+            continue
+
+        # mates that mostly overlap:
+        b, b_end = get_random_read(reference, start + r.randint(0, 150), name, r)
+
+        tlen = max(a_end, b_end) - start
+        a.flag = 0x1 | 0x40 | 0x20 | (0x2 if r.random() > 0.05 else 0)
+        b.flag = 0x1 | 0x80 | 0x10 | (a.flag & 0x2)
+        a.next_reference_id, a.next_reference_start, a.template_length = 0, b.reference_start, tlen
+        b.next_reference_id, b.next_reference_start, b.template_length = 0, a.reference_start, -tlen
+
+        if r.random() < 0.05:
+            # a supplementary alignment with the same name:
+            s, s_end = get_random_read(reference, r.randint(0, reference_length - 400), name, r)
+            s.flag = 0x1 | 0x40 | 0x800 | 0x2
+            reads.append(s)
+
+        reads.extend([a, b])
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'tricky_contig', 'LN': reference_length}]}
+    bam_path = os.path.join(output_dir, 'tricky.bam')
+    bam = pysam.AlignmentFile(bam_path, 'wb', header = header)
+    for read in sorted(reads, key = lambda read: read.reference_start):
+        bam.write(read)
+    bam.close()
+
+    pysam.index(bam_path)
+
+    return bam_path
+
+
+if not is_pysam_version_verified(pysam.__version__):
+    run.info('pysam', '%s (reads were never compared to the pileup of this version)' % pysam.__version__, mc = 'red')
+
+def get_deep_bam(output_dir, seed = 1, reference_length = 150, num_reads = 10000, read_length = 100):
+    """A BAM file with reads that all start in the first third of a short contig, so the pileup would
+       have to hold on to more reads than `PILEUP_MAX_DEPTH`. Returns its path, and the true coverage"""
+    r = random.Random(seed)
+
+    reference = ''.join([r.choice('ACGT') for i in range(reference_length)])
+
+    reads = []
+    for i in range(0, num_reads):
+        start = r.randint(0, reference_length - read_length)
+
+        read = pysam.AlignedSegment()
+        read.query_name = 'read_%d' % i
+        read.reference_id = 0
+        read.reference_start = start
+        read.mapping_quality = 60
+        read.cigartuples = [(0, read_length)] # M
+        read.query_sequence = ''.join([reference[pos] if r.random() > 0.2 else r.choice('ACGT') for pos in range(start, start + read_length)])
+        read.query_qualities = pysam.qualitystring_to_array('I' * read_length)
+        reads.append(read)
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'deep_contig', 'LN': reference_length}]}
+    bam_path = os.path.join(output_dir, 'deep.bam')
+    bam = pysam.AlignmentFile(bam_path, 'wb', header = header)
+    for read in sorted(reads, key = lambda read: read.reference_start):
+        bam.write(read)
+    bam.close()
+
+    pysam.index(bam_path)
+
+    c = numpy.zeros(reference_length, dtype = numpy.uint32)
+    for read in reads:
+        c[read.reference_start:read.reference_start + read_length] += 1
+
+    return bam_path, c
+
+
+def test_deep_splits(bam_path, c, max_depth = 1000, split_length = 75):
+    bam = pysam.AlignmentFile(bam_path, 'rb')
+    contig_name, contig_length = bam.references[0], bam.lengths[0]
+
+    results = []
+    def check(name, condition):
+        run.info(name, 'OK' if condition else 'FAILED', mc = 'green' if condition else 'red')
+        results.append(condition)
+
+    run.info('BAM file', os.path.basename(bam_path))
+    run.info('Max coverage', c.max())
+    run.info('Max depth for SNV profiling', max_depth)
+
+    contig = ContigCoverageFromReads(Contig(contig_name, contig_length))
+    contig.run(bam)
+    check('Contig is too deep for the pileup', not contig.is_identical_to_pileup)
+
+    contig = ContigCoverageFromReads(Contig(contig_name, contig_length), pileup_max_depth = SPLIT_PILEUP_MAX_DEPTH)
+    contig.run(bam)
+    check('True coverage of the contig from reads', contig.is_identical_to_pileup and (contig.c == c).all())
+
+    for start in range(0, contig_length, split_length):
+        split = Split(contig_name, start, min(start + split_length, contig_length))
+        true_c = c[split.start:split.end]
+        capped_columns = true_c > max_depth
+        name = 'Split %d - %d' % (split.start, split.end)
+
+        pileup = SplitPileupFromReads(split, max_depth = max_depth)
+        pileup.run(bam)
+        check('%s: too deep for the pileup' % name, not pileup.is_identical_to_pileup)
+
+        # the fallback:
+        pileup = SplitPileup(split, max_depth = max_depth)
+        pileup.run(bam)
+        check('%s: coverage (pileup)' % name, (pileup.c == true_c).all())
+        check('%s: depths before the cap (pileup)' % name, (pileup.nt_depths == true_c).all())
+        check('%s: depths after the cap (pileup)' % name, (pileup.nt_counts.sum(axis = 1) == numpy.minimum(true_c, max_depth)).all() and \
+                                                          pileup.num_capped_columns == capped_columns.sum())
+
+        another_pileup = SplitPileup(split, max_depth = max_depth)
+        another_pileup.run(bam)
+        check('%s: same sample every time (pileup)' % name, (another_pileup.nt_counts == pileup.nt_counts).all())
+
+        uncapped_pileup = SplitPileup(split)
+        uncapped_pileup.run(bam)
+
+        # reads, with a pileup that is deep enough:
+        pileup = SplitPileupFromReads(split, max_depth = max_depth, pileup_max_depth = SPLIT_PILEUP_MAX_DEPTH)
+        pileup.run(bam)
+        check('%s: coverage (reads)' % name, pileup.is_identical_to_pileup and (pileup.c == true_c).all())
+        check('%s: depths before the cap (reads)' % name, (pileup.nt_depths == true_c).all())
+        check('%s: depths after the cap (reads)' % name, (pileup.nt_counts.sum(axis = 1) == numpy.minimum(true_c, max_depth)).all() and \
+                                                         pileup.num_capped_columns == capped_columns.sum())
+        check('%s: capped columns only (reads)' % name, (pileup.nt_counts[~capped_columns] == uncapped_pileup.nt_counts[~capped_columns]).all() and \
+                                                        (pileup.nt_counts <= uncapped_pileup.nt_counts).all())
+
+        another_pileup = SplitPileupFromReads(split, max_depth = max_depth, pileup_max_depth = SPLIT_PILEUP_MAX_DEPTH)
+        another_pileup.run(bam)
+        check('%s: same sample every time (reads)' % name, (another_pileup.nt_counts == pileup.nt_counts).all())
+
+        pileup = SplitPileupFromReads(split, pileup_max_depth = SPLIT_PILEUP_MAX_DEPTH)
+        pileup.run(bam)
+        check('%s: uncapped counts (reads and pileup)' % name, (pileup.nt_counts == uncapped_pileup.nt_counts).all() and pileup.num_capped_columns == 0)
+
+    return all(results)
+
+
+output_dir = tempfile.mkdtemp()
+sandbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox')
+
+results = []
+for sample in ['6M', '7M', '9M']:
+    bam_path = os.path.join(output_dir, '204_3contigs_%s.bam' % sample)
+    pysam.sort('-o', bam_path, os.path.join(sandbox, '204_3contigs_%s.bam' % sample))
+    pysam.index(bam_path)
+    results.append(test(bam_path))
+
+for seed in [1, 2, 3]:
+    results.append(test(get_tricky_bam(output_dir, seed), split_length = 500))
+
+bam_path, c = get_deep_bam(output_dir)
+results.append(c.max() > PILEUP_MAX_DEPTH and test_deep_splits(bam_path, c))
+
+# only pysam 0.15 is trusted to report the pileup reads are compared to here:
+versions = {'0.15.0': True, '0.15.4': True, '0.15.4.dev0': True, '0.14.1': False, '0.16.0': False, '1.15.0': False, 'unknown': False}
+versions_are_verified = all([is_pysam_version_verified(version) == verified for version, verified in versions.items()])
+run.info('Verified versions of pysam', 'OK' if versions_are_verified else 'FAILED', mc = 'green' if versions_are_verified else 'red')
+results.append(versions_are_verified)
+
+shutil.rmtree(output_dir)
+
+if not all(results):
+    run.info('Result', 'Reads and the pileup do not agree', mc = 'red')
+    sys.exit(1)
+
+run.info('Result', 'Reads and the pileup agree', mc = 'green')
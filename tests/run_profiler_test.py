@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Profiles a BAM file from the sandbox in different ways that should all end up with the same profile,
+   and compares every table of PROFILE.db and every dataset of the HDF5 files they generate with the ones
+   of a profile generated in a single run:
+
+       * a run with checkpoints that dies after a contig is checkpointed, and is then resumed,
+       * shards of the BAM file profiled separately, and merged with `anvi-merge-shards`."""
+
+import os
+import sys
+import h5py
+import sqlite3
+import shutil
+import tempfile
+import subprocess
+
+from distutils.spawn import find_executable
+
+from anvio.terminal import Run
+run = Run(width=55)
+
+
+# runs `anvi-profile` with the given arguments, and dies right after the given number of contigs are
+# added to checkpoints:
+crashing_profiler = """
+import sys, runpy
+import anvio.profiler as profiler
+
+num_contigs_to_checkpoint = int(sys.argv.pop(1))
+add_to_checkpoint = profiler.BAMProfiler.add_to_checkpoint
+
+def add_to_checkpoint_and_crash(self, contig_name, contig):
+    # every contig goes into a checkpoint of its own:
+    self.checkpoint_interval = -1
+    add_to_checkpoint(self, contig_name, contig)
+
+    self.num_contigs_checkpointed = getattr(self, 'num_contigs_checkpointed', 0) + 1
+    if self.num_contigs_checkpointed >= num_contigs_to_checkpoint:
+        raise SystemExit('Simulated crash')
+
+profiler.BAMProfiler.add_to_checkpoint = add_to_checkpoint_and_crash
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name = '__main__')
+"""
+
+
+def execute(cmd_line, log_file_path):
+    with open(log_file_path, 'a') as log_file:
+        return subprocess.call(cmd_line, stdout = log_file, stderr = subprocess.STDOUT)
+
+
+def get_profile_dump(profile_dir):
+    """Every row of every table in PROFILE.db (except 'self', which has the time of the run), and every
+       dataset in the HDF5 files of a profile, as sorted lines of text"""
+    dump = []
+
+    db = sqlite3.connect(os.path.join(profile_dir, 'PROFILE.db'))
+    for (table_name, ) in db.execute('''SELECT name FROM sqlite_master WHERE type="table"'''):
+        if table_name == 'self':
+            continue
+
+        for row in db.execute('''SELECT * FROM %s''' % table_name):
+            # entry ids depend on the order in which contigs are stored:
+            if table_name in ['variable_nucleotide_positions', 'gene_coverages']:
+                row = row[1:]
+
+            dump.append('%s\t%s' % (table_name, '\t'.join([('%.6f' % v) if isinstance(v, float) else str(v) for v in row])))
+    db.close()
+
+    for file_name in ['PROFILE.h5', 'AUXILIARY-DATA.h5']:
+        if not os.path.exists(os.path.join(profile_dir, file_name)):
+            continue
+
+        h5 = h5py.File(os.path.join(profile_dir, file_name), 'r')
+        def dump_dataset(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                dump.append('%s\t%s\t%s' % (file_name, name, obj[...].tolist()))
+        h5.visititems(dump_dataset)
+        h5.close()
+
+    return sorted(dump)
+
+
+def test(name, profile_dir, expected_dump):
+    if not os.path.exists(os.path.join(profile_dir, 'PROFILE.db')):
+        run.info(name, 'No profile', mc = 'red')
+        return False
+
+    dump = get_profile_dump(profile_dir)
+    if dump != expected_dump:
+        run.info(name, '%d lines differ from the single run' % len(set(dump).symmetric_difference(set(expected_dump))), mc = 'red')
+        return False
+
+    run.info(name, 'Identical to the single run', mc = 'green')
+    return True
+
+
+output_dir = tempfile.mkdtemp()
+sandbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox')
+log_file_path = os.path.join(output_dir, 'log.txt')
+
+anvi_profile = find_executable('anvi-profile')
+
+bam_path = os.path.join(output_dir, 'SAMPLE')
+contigs_db_path = os.path.join(output_dir, 'CONTIGS.db')
+execute(['anvi-init-bam', os.path.join(sandbox, '204_3contigs_6M.bam'), '-O', bam_path], log_file_path)
+execute(['anvi-gen-contigs-database', '-f', os.path.join(sandbox, 'contigs.fa'), '-o', contigs_db_path, '-L', '1000', '--skip-gene-calling'], log_file_path)
+
+def profile(profile_dir, *args):
+    return execute(['anvi-profile', '-i', bam_path + '.bam', '-c', contigs_db_path, '-o', os.path.join(output_dir, profile_dir), '-S', 'sandbox'] + list(args), log_file_path)
+
+profile('SINGLE_RUN')
+expected_dump = get_profile_dump(os.path.join(output_dir, 'SINGLE_RUN'))
+run.info('Lines in the dump of the single run', len(expected_dump))
+
+results = []
+
+# checkpoints:
+for num_threads in ['1', '2']:
+    profile_dir = os.path.join(output_dir, 'RESUMED_%s' % num_threads)
+
+    execute([sys.executable, '-c', crashing_profiler, '1', anvi_profile, '-i', bam_path + '.bam', '-c', contigs_db_path, '-o', profile_dir,
+             '-S', 'sandbox', '--checkpoint', '-T', num_threads], log_file_path)
+
+    checkpoints_dir = os.path.join(profile_dir, 'CHECKPOINTS')
+    if not os.path.exists(checkpoints_dir) or not os.listdir(checkpoints_dir):
+        run.info('Resumed run (%s threads)' % num_threads, 'No checkpoints left behind by the crash', mc = 'red')
+        results.append(False)
+        continue
+
+    profile(profile_dir, '--resume', '-T', num_threads)
+
+    results.append(test('Resumed run (%s threads)' % num_threads, profile_dir, expected_dump))
+
+    if os.path.exists(checkpoints_dir):
+        run.info('Resumed run (%s threads)' % num_threads, 'Checkpoints were not removed', mc = 'red')
+        results.append(False)
+
+# shards:
+for num_shards in [2, 3]:
+    runinfo_paths = []
+    for shard in range(1, num_shards + 1):
+        shard_dir = os.path.join(output_dir, 'SHARD_%d_OF_%d' % (shard, num_shards))
+        profile(shard_dir, '--shard', '%d/%d' % (shard, num_shards))
+        runinfo_paths.append(os.path.join(shard_dir, 'RUNINFO.cp'))
+
+    profile_dir = os.path.join(output_dir, 'MERGED_%d_SHARDS' % num_shards)
+    execute(['anvi-merge-shards'] + runinfo_paths + ['-c', contigs_db_path, '-o', profile_dir], log_file_path)
+
+    results.append(test('Merged %d shards' % num_shards, profile_dir, expected_dump))
+
+if not all(results):
+    run.info('Result', 'Profiles differ (see %s for the log)' % log_file_path, mc = 'red')
+    sys.exit(1)
+
+shutil.rmtree(output_dir)
+run.info('Result', 'All profiles are identical', mc = 'green')